@@ -0,0 +1,374 @@
+import os
+import sys
+import json
+import time
+import zlib
+import base64
+import logging
+import argparse
+import datetime
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses, parseaddr
+from sqlalchemy import select, func
+import database
+import bodystore
+import metrics
+from envelope import parse_recipients
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Rows prune_queue.py is about to delete are first appended to an archive, so
+# "was this decision email delivered?" can still be answered after retention
+# without keeping rows in email_queue. Unset ARCHIVE_DIR to prune without
+# archiving.
+#
+# Layout, one directory per day the rows were created:
+#
+#   ARCHIVE_DIR/2030-01-31/20300302T030000-123.jsonl.gz   rows, one JSON object per line
+#   ARCHIVE_DIR/2030-01-31/20300302T030000-123.idx        one JSON line per member
+#
+# Each run writes new files and never modifies old ones, which suits the
+# GCS FUSE bucket. A data file is a series of independently compressed
+# members (gzip members or zstd frames); the index line of a member records
+# its offset, length, id range and the recipients and Message-IDs in it, so a
+# search only decompresses the members that can match.
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR')
+# Also store the raw message (base64) with each row
+ARCHIVE_BODIES = os.environ.get('ARCHIVE_BODIES', '0') == '1'
+# gzip is always available; zstd needs the optional `zstandard` package
+ARCHIVE_CODEC = os.environ.get('ARCHIVE_CODEC', 'gzip')
+# Rows read per query, and how much of each (compressed) body is read for
+# its headers
+FETCH_SIZE = 100
+HEAD_BYTES = 64 * 1024
+# Start a new member once this much has been written to the current one
+MEMBER_BYTES = 8 * 1024 * 1024
+
+EXTENSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+ARCHIVED = metrics.counter('rows_archived', "Rows archived by prune_queue.py before deletion")
+
+def _compressor(codec):
+    if codec == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=bodystore.ZSTD_LEVEL).compressobj()
+    raise ValueError(f"Unknown archive codec {codec!r}")
+
+def _decompressor(codec):
+    if codec == 'gzip':
+        return zlib.decompressobj(31)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unknown archive codec {codec!r}")
+
+def message_key(message_id):
+    return 'mid:' + message_id.strip().strip('<>').strip().lower()
+
+def recipient_keys(recipients):
+    # Keys of the bare, lowercased addresses in a recipients string. In
+    # OJS's -t mode recipients come from the headers, e.g.
+    # "Jane Doe <jane@uni.edu>, bob@uni.edu".
+    return {'to:' + addr.strip().lower() for _, addr in getaddresses([recipients]) if addr.strip()}
+
+def recipient_key(address):
+    return 'to:' + (parseaddr(address)[1] or address).strip().lower()
+
+
+class Segment:
+    # The data and index files one run writes for one day. Rows are
+    # compressed as they arrive, so memory doesn't grow with the member.
+    def __init__(self, path, codec):
+        self.codec = codec
+        self.index_path = path[:-len(EXTENSIONS[codec])] + '.idx'
+        self._file = open(path, 'ab')
+        self._compressor = None
+
+    def add(self, record, keys):
+        if self._compressor is None:
+            self._compressor = _compressor(self.codec)
+            self._start = self._file.seek(0, os.SEEK_END)
+            self._keys = set()
+            self._rows = 0
+            self._first_id = record['id']
+        self._file.write(self._compressor.compress(json.dumps(record, separators=(',', ':')).encode() + b'\n'))
+        self._keys.update(keys)
+        self._rows += 1
+        self._last_id = record['id']
+        if self._file.tell() - self._start >= MEMBER_BYTES:
+            self.end_member()
+
+    def end_member(self):
+        # Finish the member, make it durable, then index it. A crash before
+        # the index line leaves unindexed bytes that searches never read.
+        if self._compressor is None:
+            return
+        self._file.write(self._compressor.flush())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        entry = {
+            'offset': self._start, 'length': self._file.tell() - self._start, 'rows': self._rows,
+            'first_id': self._first_id, 'last_id': self._last_id, 'keys': sorted(self._keys),
+        }
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self._compressor = None
+
+    def close(self):
+        self.end_member()
+        self._file.close()
+
+
+class Archive:
+    def __init__(self, root, codec=None, bodies=None, run_id=None):
+        self.root = root
+        self.codec = codec or ARCHIVE_CODEC
+        self.bodies = ARCHIVE_BODIES if bodies is None else bodies
+        self.run_id = run_id or f"{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%S}-{os.getpid()}"
+        _compressor(self.codec)  # fail early on an unknown or unavailable codec
+        self._segments = {}
+
+    def _segment(self, day):
+        segment = self._segments.get(day)
+        if segment is None:
+            directory = os.path.join(self.root, day.isoformat())
+            os.makedirs(directory, exist_ok=True)
+            segment = Segment(os.path.join(directory, self.run_id + EXTENSIONS[self.codec]), self.codec)
+            self._segments[day] = segment
+        return segment
+
+    def add(self, record, keys):
+        created = datetime.datetime.fromisoformat(record['created_at']) if record['created_at'] else None
+        self._segment(created.date() if created else datetime.date.min).add(record, keys)
+
+    def commit(self):
+        # Called before the archived rows are deleted
+        for segment in self._segments.values():
+            segment.end_member()
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments = {}
+
+
+def _iso(value):
+    if value is None:
+        return None
+    return value.isoformat(sep=' ') if isinstance(value, datetime.datetime) else str(value)
+
+def read_headers(row):
+    # Headers of the row's message from the bounded prefix the query read:
+    # the legacy inline body's, or the stored body's, decompressed only as
+    # far as the blank line
+    if row.inline_head is not None:
+        head = bytes(row.inline_head)
+    elif row.head is not None:
+        head = b''
+        for piece in bodystore.iter_decode(row.codec, bytes(row.head)):
+            head += piece
+            if b'\r\n\r\n' in head or b'\n\n' in head:
+                break
+    else:
+        return {}
+    return BytesHeaderParser().parsebytes(head)
+
+def read_body(session, row):
+    # The whole raw message, fetched for this one row
+    if row.inline_size is not None:
+        q = database.email_queue
+        return bytes(session.execute(select(q.c.body).where(q.c.id == row.id)).scalar())
+    if row.codec is None:
+        return None
+    b = database.email_body
+    data = session.execute(select(b.c.data).where(b.c.hash == row.body_hash)).scalar()
+    return bodystore.decode(row.codec, data) if data is not None else None
+
+def archive_rows(session, archive, ids):
+    # Append the rows with these ids, in primary-key order, to the archive.
+    # The mysqlconnector driver buffers whole result sets (it has no
+    # server-side cursors), so rows are read FETCH_SIZE at a time, with only
+    # the first HEAD_BYTES of each body for its headers. Whole bodies are
+    # read one row at a time, and only with ARCHIVE_BODIES. Memory is
+    # bounded by FETCH_SIZE * HEAD_BYTES plus one body, whatever the chunk size.
+    if not ids:
+        return 0
+    q = database.email_queue
+    b = database.email_body
+    r = database.email_recipient
+    columns = [c for c in q.c if c.name != 'body']
+
+    ids = sorted(ids)
+    count = 0
+    for start in range(0, len(ids), FETCH_SIZE):
+        page = ids[start:start + FETCH_SIZE]
+
+        # Per-recipient outcomes of partly delivered rows (few, and small)
+        outcomes = {}
+        for email_id, address, status, error in session.execute(
+            select(r.c.email_id, r.c.address, r.c.status, r.c.error_message).where(r.c.email_id.in_(page))
+        ):
+            outcomes.setdefault(email_id, []).append({'address': address, 'status': status, 'error': error})
+
+        rows = session.execute(
+            select(*columns,
+                   func.substr(q.c.body, 1, HEAD_BYTES).label('inline_head'),
+                   func.length(q.c.body).label('inline_size'),
+                   b.c.codec, b.c.size,
+                   func.substr(b.c.data, 1, HEAD_BYTES).label('head'))
+            .select_from(q.outerjoin(b, b.c.hash == q.c.body_hash))
+            .where(q.c.id.in_(page))
+            .order_by(q.c.id)
+        ).fetchall()
+        for row in rows:
+            headers = read_headers(row)
+            recipients = parse_recipients(row.recipients)
+            record = {
+                'id': row.id,
+                'created_at': _iso(row.created_at),
+                'status': row.status,
+                'attempt_count': row.attempt_count,
+                'last_attempt_at': _iso(row.last_attempt_at),
+                'error_message': row.error_message,
+                'sender': row.sender,
+                'recipients': recipients,
+                'recipient_outcomes': outcomes.get(row.id),
+                'message_id': headers.get('Message-ID'),
+                'subject': headers.get('Subject'),
+                'priority': row.priority,
+                'digest_id': row.digest_id,
+                'body_hash': row.body_hash,
+                'size': row.message_size if row.message_size is not None else
+                        row.inline_size if row.inline_size is not None else row.size,
+                'has_attachments': row.has_attachments,
+            }
+            if archive.bodies:
+                raw = read_body(session, row)
+                record['body'] = base64.b64encode(raw).decode() if raw is not None else None
+            keys = sorted(recipient_keys(row.recipients))
+            if record['message_id']:
+                keys.append(message_key(record['message_id']))
+            archive.add(record, keys)
+            count += 1
+    archive.commit()
+    ARCHIVED.inc(count)
+    return count
+
+def archive_partition(session, archive, name, chunk_size, deadline=None):
+    # Archive a whole email_queue partition before it is dropped, walking
+    # the primary key chunk by chunk. Returns (rows archived, whether the
+    # whole partition was archived before the time.monotonic() deadline).
+    q = database.email_queue
+    total = 0
+    last_id = 0
+    while True:
+        if deadline is not None and time.monotonic() >= deadline:
+            session.commit()
+            return total, False
+
+        ids = session.execute(
+            select(q.c.id).with_hint(q, f"PARTITION ({name})", 'mysql')
+            .where(q.c.id > last_id).order_by(q.c.id).limit(chunk_size)
+        ).scalars().all()
+        if not ids:
+            session.commit()
+            return total, True
+        total += archive_rows(session, archive, ids)
+        session.commit()
+        last_id = ids[-1]
+
+
+def _days(root, since, until):
+    try:
+        names = sorted(os.listdir(root))
+    except FileNotFoundError:
+        return []
+    days = []
+    for name in names:
+        try:
+            day = datetime.date.fromisoformat(name)
+        except ValueError:
+            continue
+        if (since is None or day >= since) and (until is None or day <= until):
+            days.append(os.path.join(root, name))
+    return days
+
+def _read_member(path, codec, offset, length):
+    decompressor = _decompressor(codec)
+    pending = b''
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remaining = length
+        while remaining:
+            block = f.read(min(remaining, bodystore.CHUNK_SIZE))
+            if not block:
+                break
+            remaining -= len(block)
+            *lines, pending = (pending + decompressor.decompress(block)).split(b'\n')
+            for line in lines:
+                yield json.loads(line)
+    if pending.strip():
+        yield json.loads(pending)
+
+def search(root, recipient=None, message_id=None, since=None, until=None):
+    # Yields archived rows for a recipient and/or Message-ID, optionally
+    # limited to rows created between two dates. Only index files and the
+    # members whose keys match are read.
+    wanted = []
+    if recipient:
+        wanted.append(recipient_key(recipient))
+    if message_id:
+        wanted.append(message_key(message_id))
+    seen = set()
+    for directory in _days(root, since, until):
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.idx'):
+                continue
+            base = os.path.join(directory, name[:-len('.idx')])
+            codec = next((c for c, ext in EXTENSIONS.items() if os.path.exists(base + ext)), None)
+            if codec is None:
+                continue
+            with open(base + '.idx') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    keys = set(entry['keys'])
+                    if not all(key in keys for key in wanted):
+                        continue
+                    for record in _read_member(base + EXTENSIONS[codec], codec, entry['offset'], entry['length']):
+                        record_keys = recipient_keys(', '.join(record['recipients']))
+                        if record['message_id']:
+                            record_keys.add(message_key(record['message_id']))
+                        # A row archived twice (crash between archiving and deleting) is reported once
+                        if record['id'] in seen or not all(key in record_keys for key in wanted):
+                            continue
+                        seen.add(record['id'])
+                        yield record
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search the archive of pruned emails.")
+    parser.add_argument('--dir', default=ARCHIVE_DIR, help="Archive directory (default: ARCHIVE_DIR)")
+    parser.add_argument('--recipient', help="Envelope recipient address")
+    parser.add_argument('--message-id', help="Message-ID header, with or without <>")
+    parser.add_argument('--since', type=datetime.date.fromisoformat, help="Only rows created on or after this date (YYYY-MM-DD)")
+    parser.add_argument('--until', type=datetime.date.fromisoformat, help="Only rows created on or before this date (YYYY-MM-DD)")
+    parser.add_argument('--with-body', action='store_true', help="Include archived message bodies in the output")
+    args = parser.parse_args()
+
+    if not args.dir:
+        parser.error("no archive directory; set ARCHIVE_DIR or pass --dir")
+    if not (args.recipient or args.message_id):
+        parser.error("give --recipient and/or --message-id")
+
+    found = 0
+    for record in search(args.dir, args.recipient, args.message_id, args.since, args.until):
+        if not args.with_body:
+            record.pop('body', None)
+        print(json.dumps(record))
+        found += 1
+    if not found:
+        logger.info("No archived emails matched.")
+        sys.exit(1)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Simulation of recipient-domain scheduling in send_batch.py.
+#
+# Queues a large mailing to one domain (the same body to every recipient)
+# ahead of a trickle of individual messages to other domains, then drains the
+# queue through the real SenderWorker into benchmarks/fake_smtp.py. The fake
+# server rate-limits the big domain with 450 replies. Two runs are compared:
+#
+#   fifo    no merging, no per-domain caps or backoff (claim order only)
+#   domain  merged transactions, per-domain concurrency cap and backoff
+#
+# and for each it reports how long the other domains' mail waited, how many
+# SMTP transactions and 450 deferrals it took, and the total run time.
+#
+#   python benchmarks/bench_domains.py --bulk 300 --others 60 --json results.json
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+
+RELAY_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, RELAY_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_smtp import FakeSMTPServer
+
+BIG_DOMAIN = 'big.example.edu'
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+def seed(engine, bulk, others, domains):
+    import database
+    import bodystore
+    notice = bodystore.encode(b"Subject: New issue published\r\n\r\n" + b"Table of contents\r\n" * 100)
+    with engine.begin() as conn:
+        conn.execute(database.email_body.insert().values(
+            hash=notice.hash, codec=notice.codec, size=notice.size, data=notice.data
+        ))
+        conn.execute(database.email_queue.insert(), [
+            {'sender': 'journal@example.org', 'recipients': f'reader{i}@{BIG_DOMAIN}',
+             'body_hash': notice.hash, 'status': 'pending'}
+            for i in range(bulk)
+        ])
+        for i in range(others):
+            body = bodystore.encode(f"Subject: Review request {i}\r\n\r\nPlease review.\r\n".encode())
+            conn.execute(database.email_body.insert().values(
+                hash=body.hash, codec=body.codec, size=body.size, data=body.data
+            ))
+            conn.execute(database.email_queue.insert().values(
+                sender='journal@example.org', recipients=f'author{i}@uni{i % domains}.example.org',
+                body_hash=body.hash, status='pending'
+            ))
+
+def run_scenario(name, args):
+    from sqlalchemy import create_engine, select, func
+    import database
+    import send_batch as sb
+    # The fake server speaks plain SMTP without STARTTLS or AUTH
+    sb.authenticate = lambda server: None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'queue.db')
+        os.environ.update(DB_DRIVER='sqlite', DB_NAME=db_path)
+        engine = create_engine(f"sqlite:///{db_path}", connect_args={'timeout': 30})
+        database.metadata.create_all(engine)
+        seed(engine, args.bulk, args.others, args.domains)
+
+        if name == 'fifo':
+            sb.MAX_RECIPIENTS = 1
+            scheduler = sb.DomainScheduler(rate_per_minute=0, concurrency=0, backoff_seconds=0)
+        else:
+            sb.MAX_RECIPIENTS = args.max_recipients
+            scheduler = sb.DomainScheduler(rate_per_minute=0, concurrency=args.concurrency,
+                                           backoff_seconds=args.backoff)
+
+        fake = FakeSMTPServer(latency=args.latency, domain_limits={BIG_DOMAIN: args.domain_limit},
+                              domain_window=args.domain_window)
+        with fake:
+            os.environ.update(SMTP_HOST=fake.address[0], SMTP_PORT=str(fake.address[1]))
+            Session = database.get_session(engine)
+            bucket = sb.TokenBucket(600000, 1000)
+            controller = sb.ThrottleController(600000, bucket, max_rate=600000)
+
+            def work(n):
+                worker = sb.SenderWorker(engine, Session, f"bench-{n}", bucket, controller,
+                                         args.batch_size, None, scheduler)
+                worker.run(idle_timeout=args.backoff + 1, poll_interval=0.05, throttle_pause=0.5)
+
+            start = time.monotonic()
+            threads = [threading.Thread(target=work, args=(n,)) for n in range(args.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - start
+
+        with engine.connect() as conn:
+            q = database.email_queue
+            left = conn.execute(select(func.count()).select_from(q).where(q.c.status != 'sent')).scalar()
+        engine.dispose()
+
+    others = [t for t, rcpt in fake.delivered if not rcpt.endswith(BIG_DOMAIN)]
+    bulk = [t for t, rcpt in fake.delivered if rcpt.endswith(BIG_DOMAIN)]
+    return {
+        'elapsed_s': elapsed,
+        'transactions': fake.transactions,
+        'deferrals_450': fake.deferred,
+        'not_sent': left,
+        'others_p50_s': percentile(others, 50),
+        'others_p95_s': percentile(others, 95),
+        'others_max_s': percentile(others, 100),
+        'bulk_done_s': percentile(bulk, 100),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate domain-aware scheduling against a fake SMTP server.")
+    parser.add_argument('--bulk', type=int, default=300, help="Messages to the big domain, queued first")
+    parser.add_argument('--others', type=int, default=60, help="Individual messages to other domains")
+    parser.add_argument('--domains', type=int, default=12, help="Number of other domains")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.01, help="Seconds the fake server takes per transaction")
+    parser.add_argument('--domain-limit', type=int, default=100, help="Recipients the big domain accepts per window")
+    parser.add_argument('--domain-window', type=float, default=2.0, help="Seconds in the big domain's window")
+    parser.add_argument('--max-recipients', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--backoff', type=float, default=2.0, help="Seconds a deferring domain is left alone")
+    parser.add_argument('--json', help="Write results to this file")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    results = {name: run_scenario(name, args) for name in ('fifo', 'domain')}
+
+    columns = list(results['fifo'])
+    print(f"{'metric':<16}" + ''.join(f"{name:>12}" for name in results))
+    for column in columns:
+        cells = ''
+        for name in results:
+            value = results[name][column]
+            cells += f"{'-':>12}" if value is None else f"{value:>12.2f}" if isinstance(value, float) else f"{value:>12}"
+        print(f"{column:<16}{cells}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Start-up and latency benchmark for the sendmail shim (enqueue.py).
+#
+# Runs enqueue.py as a fresh process per message, the way PHP invokes it,
+# against a throwaway SQLite database, once through the DB-API fast path and
+# once through SQLAlchemy (ENQUEUE_FASTPATH=0), and once in spool mode
+# (ENQUEUE_SPOOL_DIR). A bare `python -c pass` run is included as the
+# interpreter start-up floor.
+#
+#   python benchmarks/bench_enqueue.py --count 100 --json results.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+RELAY_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, RELAY_DIR)
+
+def sample(n):
+    # A distinct Message-ID per invocation, so enqueue deduplication doesn't
+    # drop every run after the first and the insert path is what's measured
+    return (
+        b"From: journal@example.org\r\n"
+        b"To: reviewer@example.edu\r\n"
+        b"Subject: Review reminder\r\n"
+        + f"Message-ID: <bench-{n}-{os.getpid()}@example.org>\r\n".encode() +
+        b"Content-Type: text/plain; charset=utf-8\r\n"
+        b"\r\n" + b"Please submit your review.\r\n" * 200
+    )
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+def run(cmd, env, count, stdin=None):
+    # stdin: function of the invocation number returning the message, if any
+    timings = []
+    for n in range(count):
+        data = stdin(n) if stdin else b''
+        start = time.perf_counter()
+        subprocess.run(cmd, input=data, env=env, check=True, cwd=RELAY_DIR)
+        timings.append(time.perf_counter() - start)
+    return {
+        'count': count,
+        'mean_ms': statistics.mean(timings) * 1000,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'total_s': sum(timings),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark enqueue.py start-up and per-message latency.")
+    parser.add_argument('--count', type=int, default=50, help="Invocations per variant")
+    parser.add_argument('--args', action='store_true', help="Pass -f and a recipient so headers need no parsing")
+    parser.add_argument('--json', help="Write results to this file")
+    args = parser.parse_args()
+
+    from sqlalchemy import create_engine
+    import database
+    import spool
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'queue.db')
+        engine = create_engine(f"sqlite:///{db_path}")
+        database.metadata.create_all(engine)
+        engine.dispose()
+
+        spool_dir = os.path.join(tmp, 'spool')
+        spool.ensure_dirs(spool_dir)
+
+        env = dict(os.environ, DB_DRIVER='sqlite', DB_NAME=db_path)
+        cmd = [sys.executable, 'enqueue.py', '-t', '-i']
+        if args.args:
+            cmd += ['-f', 'journal@example.org', 'reviewer@example.edu']
+
+        results = {
+            'interpreter': run([sys.executable, '-c', 'pass'], env, args.count),
+            'fastpath': run(cmd, dict(env, ENQUEUE_FASTPATH='1'), args.count, lambda n: sample(f"fast{n}")),
+            'sqlalchemy': run(cmd, dict(env, ENQUEUE_FASTPATH='0'), args.count, lambda n: sample(f"sa{n}")),
+            'spool': run(cmd, dict(env, ENQUEUE_SPOOL_DIR=spool_dir), args.count, lambda n: sample(f"spool{n}")),
+        }
+
+    print(f"{'variant':<12} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'total s':>9}")
+    for name, r in results.items():
+        print(f"{name:<12} {r['mean_ms']:>9.1f} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} {r['total_s']:>9.2f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# End-to-end throughput and latency benchmark for the relay.
+#
+# A producer thread feeds generated OJS-like mail through the enqueue path
+# (in-process through enqueue_stream, or one `python enqueue.py` per message
+# with --enqueue subprocess) while a pool of SenderWorkers (or send_async.py
+# with --engine async) drains the queue into benchmarks/fake_smtp.py, which
+# can add latency, answer 421 and refuse recipients. An optional backlog is inserted straight into email_queue first.
+# Message sizes, recipient counts and recipient domains are drawn from a
+# seeded generator, so a run is repeatable. Enqueue wakes the senders over
+# a UDP wake-up channel (see wakeup.py), so idle workers don't poll.
+#
+# Reported: messages per second, p50/p95/p99 enqueue-to-delivery latency,
+# SQL statements per message on the enqueue and send sides, and peak RSS.
+# Save a run with --json and pass it to a later run with --compare to see
+# the change on each figure.
+#
+#   python benchmarks/bench_relay.py --messages 500 --json before.json
+#   python benchmarks/bench_relay.py --messages 500 --compare before.json
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+
+RELAY_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, RELAY_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_smtp import FakeSMTPServer
+
+# (weight, low bytes, high bytes): plain notifications, HTML notifications,
+# reviewer files and the occasional full manuscript
+SIZES = [(75, 1500, 4000), (18, 8000, 30000), (6, 100000, 500000), (1, 1000000, 5000000)]
+# (weight, low, high) recipients per message: one author or reviewer,
+# co-authors, editorial announcements
+RECIPIENTS = [(88, 1, 1), (8, 2, 3), (4, 5, 20)]
+# Recipient domains; a few large providers and a long tail of universities
+DOMAINS = ['gmail.com'] * 8 + ['outlook.com'] * 3 + ['yahoo.com'] * 2 + [f'uni{n}.example.edu' for n in range(30)]
+
+WORDS = ("the manuscript submission review editor journal revisions requested decision "
+         "accept reviewer author please log in to complete your assignment deadline "
+         "issue published article galley copyediting production thank you").split()
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+def weighted(rng, table):
+    _, low, high = rng.choices(table, weights=[row[0] for row in table])[0]
+    return rng.randint(low, high)
+
+def make_message(rng, n):
+    # A generated email of realistic size and recipient count. Text is drawn
+    # from a small vocabulary so it compresses about as well as real mail.
+    recipients = ', '.join(f"user{rng.randrange(100000)}@{rng.choice(DOMAINS)}"
+                           for _ in range(weighted(rng, RECIPIENTS)))
+    size = weighted(rng, SIZES)
+    headers = (f"From: journal@example.org\r\n"
+               f"To: {recipients}\r\n"
+               f"Subject: Notification {n}\r\n"
+               f"Message-ID: <bench-{n}-{rng.randrange(1 << 30)}@example.org>\r\n"
+               f"X-Bench-Id: {n}\r\n"
+               f"Content-Type: text/plain; charset=utf-8\r\n\r\n")
+    lines = []
+    length = len(headers)
+    while length < size:
+        line = ' '.join(rng.choices(WORDS, k=12)) + '\r\n'
+        lines.append(line)
+        length += len(line)
+    return recipients, (headers + ''.join(lines)).encode()
+
+def seed_backlog(engine, messages):
+    import database
+    import bodystore
+    import envelope
+    with engine.begin() as conn:
+        for recipients, raw in messages:
+            body = bodystore.encode(raw)
+            conn.execute(database.insert_ignore(engine, database.email_body, {
+                'hash': body.hash, 'codec': body.codec, 'size': body.size, 'data': body.data
+            }))
+            conn.execute(database.email_queue.insert().values(
+                sender='journal@example.org', recipients=recipients, body_hash=body.hash, status='pending',
+                **envelope.describe(envelope.HeaderBlock(raw), recipients, body.size)
+            ))
+
+class StatementCounter:
+    # Counts SQL statements: SQLAlchemy's through a cursor event, the DB-API
+    # fast path's through sqlite3's trace callback (which also reports
+    # transaction control, left out here so both sides count alike)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'enqueue': 0, 'send': 0}
+
+    def add(self, side):
+        with self.lock:
+            self.counts[side] += 1
+
+    def attach(self, engine):
+        from sqlalchemy import event
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, parameters, context, executemany):
+            self.add('send')
+
+    def trace(self, statement):
+        if statement.split(None, 1)[0].upper() not in ('BEGIN', 'COMMIT', 'ROLLBACK'):
+            self.add('enqueue')
+
+def produce(args, messages, enqueued, statements, env):
+    # Enqueue every message, paced to --arrival-rate; records time.time() of each
+    import rawdb
+    import enqueue
+
+    if args.enqueue == 'inprocess':
+        connect = rawdb.connect
+
+        def traced_connect():
+            conn = connect()
+            conn.set_trace_callback(statements.trace)
+            return conn
+        rawdb.connect = traced_connect
+
+    interval = 1.0 / args.arrival_rate if args.arrival_rate else 0
+    start = time.monotonic()
+    for n, (_, raw) in enumerate(messages):
+        if interval:
+            delay = start + n * interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        enqueued[str(args.backlog + n)] = time.time()
+        if args.enqueue == 'inprocess':
+            enqueue.enqueue_stream(io.BytesIO(raw))
+        else:
+            subprocess.run([sys.executable, 'enqueue.py', '-t', '-i'], input=raw, env=env, check=True, cwd=RELAY_DIR)
+
+def run(args, tmp):
+    from sqlalchemy import create_engine, text
+    import database
+    import metrics
+    import wakeup
+    import send_batch as sb
+
+    # The fake server speaks plain SMTP without STARTTLS or AUTH
+    sb.authenticate = lambda server: None
+    sb.MAX_RECIPIENTS = args.max_recipients
+    metrics.LOG_ENABLED = False
+
+    rng = random.Random(args.seed)
+    generated = [make_message(rng, n) for n in range(args.backlog + args.messages)]
+    backlog, live = generated[:args.backlog], generated[args.backlog:]
+
+    # Every enqueue (in this process or a child) signals the senders
+    wakeup_channel = wakeup.UDPChannel('127.0.0.1', 0)
+    wakeup.WAKEUP = 'udp:%s:%d' % wakeup_channel.listen()
+    # Workers must not give up between two arrivals
+    idle_timeout = max(args.idle_timeout, 3.0 / args.arrival_rate) if args.arrival_rate else args.idle_timeout
+
+    db_path = os.path.join(tmp, 'queue.db')
+    os.environ.update(DB_DRIVER='sqlite', DB_NAME=db_path, RELAY_WAKEUP=wakeup.WAKEUP)
+    env = dict(os.environ, ENQUEUE_FASTPATH='1')
+    engine = create_engine(f"sqlite:///{db_path}", connect_args={'timeout': 30})
+    with engine.begin() as conn:
+        # Lets the producer insert while a sender holds a read transaction
+        conn.execute(text("PRAGMA journal_mode=WAL"))
+    database.metadata.create_all(engine)
+
+    enqueued = {}
+    seeded_at = time.time()
+    seed_backlog(engine, backlog)
+    enqueued.update((str(n), seeded_at) for n in range(args.backlog))
+
+    statements = StatementCounter()
+    statements.attach(engine)
+
+    fake = FakeSMTPServer(latency=args.latency, throttle_rate=args.throttle_rate,
+                          refuse_rate=args.refuse_rate, seed=args.seed)
+    with fake:
+        os.environ.update(SMTP_HOST=fake.address[0], SMTP_PORT=str(fake.address[1]))
+        Session = database.get_session(engine)
+        bucket = sb.TokenBucket(args.rate, max(1, args.workers * args.batch_size))
+        controller = sb.ThrottleController(args.rate, bucket, max_rate=args.rate)
+        scheduler = sb.DomainScheduler(rate_per_minute=0, concurrency=args.workers, backoff_seconds=1)
+
+        def work(n):
+            worker = sb.SenderWorker(engine, Session, f"bench-{n}", bucket, controller,
+                                     args.batch_size, None, scheduler, wakeup_channel)
+            worker.run(idle_timeout=idle_timeout, poll_interval=args.poll_interval,
+                       throttle_pause=args.throttle_pause)
+
+        def work_async(n):
+            import asyncio
+            import send_async
+            sender = send_async.AsyncSender(engine, Session, 'bench-async', bucket, controller, args.workers,
+                                            args.batch_size, scheduler=scheduler, wakeup_channel=wakeup_channel)
+            asyncio.run(sender.run(idle_timeout, args.poll_interval, args.throttle_pause))
+
+        start = time.monotonic()
+        started_at = time.time()
+        if args.engine == 'async':
+            threads = [threading.Thread(target=work_async, args=(0,))]
+        else:
+            threads = [threading.Thread(target=work, args=(n,)) for n in range(args.workers)]
+        for thread in threads:
+            thread.start()
+        produce(args, live, enqueued, statements, env)
+        enqueue_done = time.monotonic() - start
+        for thread in threads:
+            thread.join()
+
+    engine.dispose()
+    wakeup_channel.close()
+
+    received = fake.received
+    latencies = [received[n] - enqueued[n] for n in received if n in enqueued]
+    # The workers linger for --idle-timeout after the last delivery
+    elapsed = (max(received.values()) - started_at) if received else time.monotonic() - start
+    total = len(generated)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'messages': total,
+        'delivered': len(received),
+        'elapsed_s': elapsed,
+        'messages_per_s': len(received) / elapsed if elapsed else None,
+        'enqueue_per_s': len(live) / enqueue_done if live and enqueue_done else None,
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p95_s': percentile(latencies, 95),
+        'latency_p99_s': percentile(latencies, 99),
+        'smtp_transactions': fake.transactions,
+        'throttled_421': fake.throttled,
+        'refused_550': fake.refused,
+        'enqueue_statements_per_msg': statements.counts['enqueue'] / len(live)
+                                      if live and args.enqueue == 'inprocess' else None,
+        'send_statements_per_msg': statements.counts['send'] / total if total else None,
+        # Senders, fake server and (in-process) enqueue together
+        'peak_rss_mb': usage.ru_maxrss * scale / 1e6,
+    }
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RELAY_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def cell(value):
+    if value is None:
+        return f"{'-':>12}"
+    return f"{value:>12.3f}" if isinstance(value, float) else f"{value:>12}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark enqueue-to-delivery throughput and latency against a fake SMTP server.")
+    parser.add_argument('--messages', type=int, default=500, help="Messages the producer enqueues while the senders run")
+    parser.add_argument('--backlog', type=int, default=0, help="Messages inserted into email_queue before the senders start")
+    parser.add_argument('--arrival-rate', type=float, default=0, help="Messages per second to enqueue (0 = as fast as possible)")
+    parser.add_argument('--enqueue', choices=('inprocess', 'subprocess'), default='inprocess',
+                        help="Call enqueue_stream directly, or run enqueue.py per message as PHP does")
+    parser.add_argument('--engine', choices=('threads', 'async'), default='threads',
+                        help="send_batch.py's worker threads, or send_async.py's event loop")
+    parser.add_argument('--workers', type=int, default=2, help="Worker threads, or sessions of the async engine")
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--max-recipients', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=600000, help="Send rate cap in messages per minute")
+    parser.add_argument('--latency', type=float, default=0.005, help="Seconds the fake server takes per transaction")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of transactions answered with 421")
+    parser.add_argument('--throttle-pause', type=float, default=0.5, help="Seconds a worker pauses after a 421")
+    parser.add_argument('--refuse-rate', type=float, default=0.0, help="Fraction of recipients refused with 550")
+    parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds an idle sender waits for a wake-up before polling")
+    parser.add_argument('--idle-timeout', type=float, default=2.0, help="Seconds the senders wait on an empty queue before exiting")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="Write results to this file")
+    parser.add_argument('--compare', help="Results file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    # Refusals and throttling are expected here
+    logging.disable(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Don't coalesce wake-ups; read when wakeup.py is imported
+        os.environ.update(RELAY_WAKEUP_COALESCE='0', RELAY_WAKEUP_STAMP=os.path.join(tmp, 'wakeup.stamp'))
+        results = run(args, tmp)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    print(f"{'metric':<28}{'value':>12}" + (f"{'baseline':>12}{'change':>10}" if baseline else ''))
+    for name, value in results.items():
+        line = f"{name:<28}{cell(value)}"
+        if baseline:
+            before = baseline.get(name)
+            line += cell(before)
+            if isinstance(value, (int, float)) and isinstance(before, (int, float)) and before:
+                line += f"{(value - before) / before * 100:>+9.1f}%"
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'environment': environment(), 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
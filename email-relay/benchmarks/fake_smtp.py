@@ -0,0 +1,162 @@
+# Minimal in-process ESMTP sink for benchmarks.
+#
+# Accepts everything by default and records what it received. It can add a
+# fixed latency to each transaction and emulate a receiving domain's rate
+# limit: once a domain has taken `domain_limit` recipients within the last
+# `domain_window` seconds, further RCPTs for it get "450 4.2.1" until the
+# window moves on. It can also answer a fraction of transactions with
+# "421 4.7.0" (and hang up, as Gmail does) and refuse a fraction of
+# recipients with "550 5.1.1", drawn from a seeded random generator. No TLS
+# or AUTH, so patch send_batch.authenticate to a no-op.
+
+import time
+import random
+import threading
+import socketserver
+from collections import defaultdict, deque
+
+
+class FakeSMTPServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, domain_limits=None, domain_window=60.0,
+                 throttle_rate=0.0, refuse_rate=0.0, seed=0, track_header='X-Bench-Id'):
+        self.latency = latency
+        self.domain_limits = domain_limits or {}
+        self.domain_window = domain_window
+        self.throttle_rate = throttle_rate
+        self.refuse_rate = refuse_rate
+        self.track_header = track_header.lower().encode() + b':'
+        self.random = random.Random(seed)
+        self.started_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.transactions = 0
+        self.deferred = 0
+        self.throttled = 0
+        self.refused = 0
+        # [(seconds since start, recipient)]
+        self.delivered = []
+        # {track_header value: time.time() of the first delivery}
+        self.received = {}
+        self._accepted = defaultdict(deque)
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server._session(self.rfile, self.wfile)
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _allow(self, rcpt):
+        domain = rcpt.rpartition('@')[2].rstrip('>').lower()
+        limit = self.domain_limits.get(domain)
+        if not limit:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            accepted = self._accepted[domain]
+            while accepted and now - accepted[0] >= self.domain_window:
+                accepted.popleft()
+            if len(accepted) >= limit:
+                self.deferred += 1
+                return False
+            accepted.append(now)
+            return True
+
+    def _chance(self, rate):
+        if not rate:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def _session(self, rfile, wfile):
+        def reply(line):
+            wfile.write(line.encode() + b'\r\n')
+            wfile.flush()
+
+        reply('220 fake ESMTP')
+        rcpts = []
+        while True:
+            line = rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+
+            if verb == 'EHLO':
+                wfile.write(b'250-fake\r\n250-SIZE 52428800\r\n250 8BITMIME\r\n')
+                wfile.flush()
+            elif verb == 'HELO':
+                reply('250 fake')
+            elif verb == 'MAIL':
+                rcpts = []
+                if self._chance(self.throttle_rate):
+                    with self.lock:
+                        self.throttled += 1
+                    reply('421 4.7.0 Try again later, closing connection')
+                    return
+                reply('250 2.1.0 OK')
+            elif verb == 'RCPT':
+                rcpt = command.split(':', 1)[1].split()[0].strip('<>')
+                if self._chance(self.refuse_rate):
+                    with self.lock:
+                        self.refused += 1
+                    reply('550 5.1.1 No such user')
+                elif self._allow(rcpt):
+                    rcpts.append(rcpt)
+                    reply('250 2.1.5 OK')
+                else:
+                    reply('450 4.2.1 Too many messages for this domain, try again later')
+            elif verb == 'DATA':
+                reply('354 Go ahead')
+                tracked = None
+                in_headers = True
+                while True:
+                    data = rfile.readline()
+                    if data in (b'.\r\n', b''):
+                        break
+                    if in_headers:
+                        if data in (b'\r\n', b'\n'):
+                            in_headers = False
+                        elif data.lower().startswith(self.track_header):
+                            tracked = data.split(b':', 1)[1].strip().decode('ascii', 'replace')
+                if self.latency:
+                    time.sleep(self.latency)
+                now = time.monotonic() - self.started_at
+                with self.lock:
+                    self.transactions += 1
+                    self.delivered.extend((now, rcpt) for rcpt in rcpts)
+                    if tracked is not None:
+                        self.received.setdefault(tracked, time.time())
+                reply('250 2.0.0 Queued')
+            elif verb == 'RSET':
+                rcpts = []
+                reply('250 OK')
+            elif verb == 'NOOP':
+                reply('250 OK')
+            elif verb == 'QUIT':
+                reply('221 Bye')
+                return
+            else:
+                reply('502 Command not implemented')
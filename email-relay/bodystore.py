@@ -0,0 +1,132 @@
+import os
+import zlib
+import hashlib
+from collections import namedtuple
+
+# Message bodies live in the content-addressed email_body table, keyed by the
+# SHA-256 of the raw message and stored compressed; email_queue rows point at
+# them through body_hash. Identical bodies (mass notifications) are stored once.
+#
+# zlib is always available. zstd is used when BODY_CODEC=zstd and the optional
+# `zstandard` package is installed. Rows record their codec, so switching
+# codecs never breaks reading older bodies.
+#
+# Imported by enqueue.py, so keep module-level imports light.
+
+CODEC = os.environ.get('BODY_CODEC', 'zlib')
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+CHUNK_SIZE = 65536
+
+EncodedBody = namedtuple('EncodedBody', ['hash', 'codec', 'size', 'data'])
+
+
+class BodyEncoder:
+    # Hashes and compresses a message incrementally, so the raw bytes never
+    # need to be held in memory all at once.
+    def __init__(self, codec=None):
+        self.codec = codec or CODEC
+        self._hash = hashlib.sha256()
+        self._size = 0
+        self._parts = []
+        if self.codec == 'zstd':
+            import zstandard
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif self.codec == 'zlib':
+            self._compressor = zlib.compressobj(ZLIB_LEVEL)
+        else:
+            raise ValueError(f"Unknown body codec {self.codec!r}")
+
+    def update(self, chunk):
+        self._hash.update(chunk)
+        self._size += len(chunk)
+        out = self._compressor.compress(chunk)
+        if out:
+            self._parts.append(out)
+
+    def finish(self):
+        self._parts.append(self._compressor.flush())
+        return EncodedBody(self._hash.hexdigest(), self.codec, self._size, b''.join(self._parts))
+
+
+def encode(raw, codec=None):
+    encoder = BodyEncoder(codec)
+    encoder.update(raw)
+    return encoder.finish()
+
+def encode_stream(stream, codec=None, chunk_size=CHUNK_SIZE):
+    encoder = BodyEncoder(codec)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return encoder.finish()
+        encoder.update(chunk)
+
+def _decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unknown body codec {codec!r}")
+
+def iter_decode(codec, data, chunk_size=CHUNK_SIZE):
+    # Yields the raw message in pieces without materializing all of it.
+    # data is the compressed bytes, or an iterable of consecutive pieces of
+    # them (e.g. read from the database as they are needed)
+    decompressor = _decompressor(codec)
+    pieces = data
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        pieces = (data[start:start + chunk_size] for start in range(0, len(data), chunk_size))
+    for piece in pieces:
+        out = decompressor.decompress(piece)
+        if out:
+            yield out
+    if codec == 'zlib':
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+def decode(codec, data):
+    return b''.join(iter_decode(codec, data))
+
+def store(session, body):
+    # Upsert an EncodedBody through SQLAlchemy. A dedup hit only bumps
+    # last_used_at (which also protects it from garbage collection) and
+    # doesn't ship the data again.
+    from sqlalchemy import update, func
+    import database
+    b = database.email_body
+
+    result = session.execute(
+        update(b).where(b.c.hash == body.hash).values(last_used_at=func.now())
+    )
+    if result.rowcount:
+        return False
+
+    # Insert; if a concurrent enqueue got there first, just touch it
+    values = {'hash': body.hash, 'codec': body.codec, 'size': body.size, 'data': body.data}
+    session.execute(database.upsert(session.get_bind(), b, values, {'last_used_at': func.now()}))
+    return True
+
+def store_many(session, bodies):
+    # Bulk version of store() for the spool flusher: one lookup, one touch of
+    # the bodies already stored and one multi-row insert of the rest
+    from sqlalchemy import select, update, func
+    import database
+    b = database.email_body
+
+    bodies = {body.hash: body for body in bodies}
+    if not bodies:
+        return 0
+    existing = set(session.execute(select(b.c.hash).where(b.c.hash.in_(list(bodies)))).scalars())
+    if existing:
+        session.execute(update(b).where(b.c.hash.in_(list(existing))).values(last_used_at=func.now()))
+
+    missing = [
+        {'hash': body.hash, 'codec': body.codec, 'size': body.size, 'data': body.data}
+        for body in bodies.values() if body.hash not in existing
+    ]
+    if missing:
+        session.execute(database.upsert(session.get_bind(), b, missing, {'last_used_at': func.now()}))
+    return len(missing)
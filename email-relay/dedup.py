@@ -0,0 +1,61 @@
+import os
+import hashlib
+
+# Idempotency keys for enqueue. OJS sometimes runs the sendmail path twice
+# for one email (a retried or timed-out request, a scheduled task that
+# regenerates a notification); the second copy should cost one primary key
+# lookup in email_dedup instead of another delivery from our throttled
+# budget. The key is the Message-ID together with the envelope recipients,
+# or a hash of sender, recipients and body when there is no Message-ID.
+# Keys are expired by prune_queue.py, which also logs how many duplicates
+# each one suppressed.
+#
+# Imported by enqueue.py, so keep module-level imports light.
+
+ENABLED = os.environ.get('ENQUEUE_DEDUP', '1') != '0'
+
+def key(message_id, sender, recipients, body_hash):
+    message_id = (message_id or '').strip().strip('<>').strip()
+    if message_id:
+        material = f"id\0{message_id}\0{recipients}"
+    else:
+        material = f"body\0{sender}\0{recipients}\0{body_hash}"
+    return hashlib.sha256(material.encode('utf-8', 'replace')).hexdigest()
+
+def claim(session, dedup_key):
+    # True if the key is new (and is now taken, as part of the caller's
+    # transaction); False if it was seen before, counting the hit
+    from sqlalchemy import update
+    import database
+    d = database.email_dedup
+
+    result = session.execute(database.insert_ignore(session.get_bind(), d, {'dedup_key': dedup_key}))
+    if result.rowcount:
+        return True
+    session.execute(update(d).where(d.c.dedup_key == dedup_key).values(hits=d.c.hits + 1))
+    return False
+
+def claim_many(session, keys):
+    # Bulk version of claim() for the spool flusher. Returns the set of keys
+    # that were new; repeats within `keys` count as hits too.
+    from sqlalchemy import select, update, bindparam
+    import database
+    d = database.email_dedup
+
+    keys = list(keys)
+    existing = set(session.execute(select(d.c.dedup_key).where(d.c.dedup_key.in_(set(keys)))).scalars())
+    new, hits = set(), {}
+    for dedup_key in keys:
+        if dedup_key in existing or dedup_key in new:
+            hits[dedup_key] = hits.get(dedup_key, 0) + 1
+        else:
+            new.add(dedup_key)
+
+    if new:
+        session.execute(database.insert_ignore(session.get_bind(), d, [{'dedup_key': k} for k in new]))
+    if hits:
+        session.execute(
+            update(d).where(d.c.dedup_key == bindparam('b_key')).values(hits=d.c.hits + bindparam('b_hits')),
+            [{'b_key': k, 'b_hits': n} for k, n in hits.items()]
+        )
+    return new
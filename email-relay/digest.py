@@ -0,0 +1,215 @@
+import os
+import re
+import datetime
+import priority
+import envelope
+
+# Optional coalescing of notification storms. A bulk editorial action (e.g.
+# the automate-transition and automate-revisions jobs) can send one person
+# dozens of separate notifications within minutes, each costing a slot of the
+# throttled send budget. With DIGEST_WINDOW_SECONDS set, enqueue holds
+# eligible messages for that long; once a hold runs out the sender merges all
+# held messages to that recipient into one digest before claiming.
+#
+# Eligible: a single recipient, a lane in DIGEST_LANES (never high), no
+# "X-Relay-Digest: no" header and a subject not matching
+# DIGEST_EXCLUDE_SUBJECTS. The originals are kept with status 'merged' and
+# digest_id pointing at the digest row.
+#
+# Imported by enqueue.py, so keep module-level imports light.
+
+WINDOW_SECONDS = float(os.environ.get('DIGEST_WINDOW_SECONDS', 0))
+LANES = {priority.LANES[name.strip()] for name in os.environ.get('DIGEST_LANES', 'normal,bulk').split(',') if name.strip()}
+EXCLUDE_SUBJECTS = os.environ.get('DIGEST_EXCLUDE_SUBJECTS', '')
+# Most messages in one digest; any more wait for the next one
+MAX_MESSAGES = int(os.environ.get('DIGEST_MAX_MESSAGES', 25))
+# Recipients handled per coalesce() call
+GROUPS_PER_PASS = 50
+# Characters of each message's text quoted in the digest summary
+SUMMARY_CHARS = 4000
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def eligible(headers, lane, recipients):
+    # headers needs only .get()
+    if not WINDOW_SECONDS or lane == priority.HIGH or lane not in LANES:
+        return False
+    if not recipients.strip() or ',' in recipients:
+        return False
+    if (headers.get('X-Relay-Digest') or '').strip().lower() in ('no', 'never', 'false', '0'):
+        return False
+    if EXCLUDE_SUBJECTS and re.search(EXCLUDE_SUBJECTS, headers.get('Subject') or '', re.IGNORECASE):
+        return False
+    return True
+
+def hold_until(now=None):
+    return (now or utcnow()) + datetime.timedelta(seconds=WINDOW_SECONDS)
+
+
+def summary_text(msg):
+    # Plain-text rendering of one message for the digest summary
+    import html
+    part = msg.get_body(preferencelist=('plain', 'html'))
+    if part is None:
+        return ''
+    try:
+        text = part.get_content()
+    except (LookupError, UnicodeError):
+        return ''
+    if part.get_content_subtype() == 'html':
+        text = re.sub(r'(?is)<(script|style).*?</\1>', '', text)
+        text = re.sub(r'(?i)<br\s*/?>|</p>|</div>|</li>|</tr>', '\n', text)
+        text = html.unescape(re.sub(r'<[^>]+>', '', text))
+    text = re.sub(r'\n\s*\n\s*\n+', '\n\n', text.strip())
+    if len(text) > SUMMARY_CHARS:
+        text = text[:SUMMARY_CHARS].rstrip() + ' [...]'
+    return text
+
+def build(raws, sender, recipients):
+    # multipart/mixed: a readable summary of every message, then the
+    # originals as a multipart/digest of message/rfc822 parts
+    import email
+    from email import policy
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.message import MIMEMessage
+    from email.mime.text import MIMEText
+    from email.utils import formatdate, make_msgid
+
+    parsed = [email.message_from_bytes(raw, policy=policy.default) for raw in raws]
+    first = parsed[0]
+
+    sections = []
+    for n, msg in enumerate(parsed, 1):
+        subject = str(msg.get('Subject', '(no subject)'))
+        sections.append(f"{n}. {subject}\n{'=' * (len(subject) + len(str(n)) + 2)}\n\n{summary_text(msg)}")
+    summary = (f"You have {len(parsed)} notifications. Each original message is attached below.\n\n"
+               + '\n\n\n'.join(sections) + '\n')
+
+    digest = MIMEMultipart('digest')
+    for raw in raws:
+        digest.attach(MIMEMessage(email.message_from_bytes(raw)))
+
+    outer = MIMEMultipart('mixed')
+    outer['From'] = str(first.get('From', sender))
+    outer['To'] = str(first.get('To', recipients))
+    first_subject = str(first.get('Subject', '')).strip()
+    outer['Subject'] = f"{len(parsed)} notifications: {first_subject} and {len(parsed) - 1} more"
+    outer['Date'] = formatdate()
+    outer['Message-ID'] = make_msgid(domain=sender.rpartition('@')[2].strip('> ') or None)
+    outer['X-Relay-Digest'] = str(len(parsed))
+    outer.attach(MIMEText(summary, 'plain', 'utf-8'))
+    outer.attach(digest)
+    return outer.as_bytes(policy=policy.SMTP)
+
+def load_raw(session, rows):
+    # Raw messages for the given queue rows, in order
+    from sqlalchemy import select
+    import database
+    import bodystore
+    b = database.email_body
+    hashes = {row.body_hash for row in rows if row.body_hash is not None}
+    stored = {}
+    if hashes:
+        for body in session.execute(select(b.c.hash, b.c.codec, b.c.data).where(b.c.hash.in_(hashes))):
+            stored[body.hash] = bodystore.decode(body.codec, body.data)
+    return [row.body if row.body_hash is None else stored.get(row.body_hash) for row in rows]
+
+def coalesce(session, now=None, max_messages=MAX_MESSAGES, groups=GROUPS_PER_PASS):
+    # Turn held messages whose hold has run out into digests, one short
+    # transaction per recipient. A recipient with a single held message just
+    # has it released. Returns the number of digests created.
+    import logging
+    from sqlalchemy import select, update, func, or_
+    import database
+    import bodystore
+    logger = logging.getLogger(__name__)
+    q = database.email_queue
+    now = now or utcnow()
+    unclaimed = or_(q.c.lease_expires_at.is_(None), q.c.lease_expires_at < now)
+
+    # Longest-waiting groups first, so a storm of new holds can't starve them
+    due = session.execute(
+        select(q.c.sender, q.c.recipients)
+        .where(q.c.status == 'pending')
+        .where(q.c.coalesce_until <= now)
+        .where(unclaimed)
+        .group_by(q.c.sender, q.c.recipients)
+        .order_by(func.min(q.c.coalesce_until))
+        .limit(groups)
+    ).fetchall()
+    session.commit()
+
+    created = 0
+    for sender, recipients in due:
+        try:
+            # Every held message to this recipient, due or not
+            rows = session.execute(
+                select(q.c.id, q.c.body, q.c.body_hash, q.c.priority)
+                .where(q.c.status == 'pending')
+                .where(q.c.coalesce_until.is_not(None))
+                .where(q.c.sender == sender)
+                .where(q.c.recipients == recipients)
+                .where(unclaimed)
+                .order_by(q.c.id)
+                .limit(max_messages)
+            ).fetchall()
+            ids = [row.id for row in rows]
+            raws = load_raw(session, rows) if len(rows) > 1 else []
+            if len(rows) < 2 or any(raw is None for raw in raws):
+                session.execute(update(q).where(q.c.id.in_(ids)).values(coalesce_until=None))
+                session.commit()
+                continue
+
+            raw = build(raws, sender, recipients)
+            body = bodystore.encode(raw)
+            bodystore.store(session, body)
+            digest_id = session.execute(q.insert().values(
+                sender=sender,
+                recipients=recipients,
+                body_hash=body.hash,
+                priority=min(row.priority for row in rows),
+                status='pending',
+                next_attempt_at=now,
+                **envelope.describe(envelope.HeaderBlock(raw), recipients, body.size)
+            )).inserted_primary_key[0]
+            merged = session.execute(
+                update(q)
+                .where(q.c.id.in_(ids))
+                .where(q.c.status == 'pending')
+                .where(unclaimed)
+                .values(status='merged', digest_id=digest_id, coalesce_until=None)
+            )
+            if merged.rowcount != len(ids):
+                # Another sender got some of them first
+                session.rollback()
+                continue
+            session.commit()
+            created += 1
+            logger.info(f"Merged email ID {', '.join(map(str, ids))} into digest {digest_id}.")
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Failed to build a digest for {recipients}: {e}")
+    return created
+
+if __name__ == "__main__":
+    import sys
+    import logging
+    import argparse
+    import database
+    logger = logging.getLogger(__name__)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Merge held notifications into per-recipient digests.")
+    parser.add_argument('--groups', type=int, default=GROUPS_PER_PASS, help="Recipients to handle in this run")
+    args = parser.parse_args()
+
+    engine = database.get_engine()
+    session = database.get_session(engine)()
+    try:
+        count = coalesce(session, groups=args.groups)
+        logger.info(f"Created {count} digests.")
+    except Exception as e:
+        logger.error(f"Error building digests: {e}")
+        sys.exit(1)
+    finally:
+        session.close()
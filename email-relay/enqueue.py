@@ -1,13 +1,69 @@
+import io
+import os
 import sys
-import email
-import argparse
-from email.policy import default
-import database
+import rawdb
+import spool
+import bodystore
+import priority
+import dedup
+import digest
+import envelope
+from envelope import HeaderBlock
+import wakeup
+import profiling
+
+# This script is exec'd by PHP once per outgoing email, so start-up time
+# matters. `email` and `database` (which pulls in SQLAlchemy) are imported
+# lazily: the default fast path streams stdin through the body encoder (hash
+# and compress, see bodystore.py) into DB-API INSERTs and only reads the
+# header block line by line when -f or recipient arguments are missing.
+# Set ENQUEUE_FASTPATH=0 to go through SQLAlchemy instead.
+FASTPATH = os.environ.get('ENQUEUE_FASTPATH', '1') != '0'
+
+# How much of stdin to read up front when headers don't need parsing
+PEEK_SIZE = 65536
+
+# Spool mode: when set, messages are written to this maildir-style directory
+# and loaded into email_queue in bulk by flush_spool.py, so the shim never
+# opens a database connection. Falls back to a direct insert if the spool is
+# unavailable.
+SPOOL_DIR = os.environ.get('ENQUEUE_SPOOL_DIR')
+
+
+class PrefixedReader(io.RawIOBase):
+    # Replays bytes already consumed from `stream` (e.g. the header block)
+    # and then continues with the rest of it.
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._prefix:
+            n = min(len(b), len(self._prefix))
+            b[:n] = self._prefix[:n]
+            self._prefix = self._prefix[n:]
+        else:
+            data = self._stream.read(len(b))
+            n = len(data)
+            b[:n] = data
+        self.bytes_read += n
+        return n
 
-def enqueue_email(raw_email, args_sender=None, args_recipients=None):
-    # Parse the email
-    msg = email.message_from_bytes(raw_email, policy=default)
 
+def read_header_block(stream):
+    # Consume stdin up to and including the blank line that ends the headers
+    lines = []
+    while True:
+        line = stream.readline()
+        lines.append(line)
+        if line in (b'\r\n', b'\n', b''):
+            return b''.join(lines)
+
+def resolve_envelope(msg, args_sender=None, args_recipients=None):
     # Determine sender: value from -f flag takes precedence, otherwise From header
     sender = args_sender if args_sender else msg.get('From', '')
 
@@ -28,34 +84,136 @@ def enqueue_email(raw_email, args_sender=None, args_recipients=None):
         # Let's insert anyway, send_batch will just skip or fail.
         pass
 
+    return sender, recipients
+
+def report_duplicate(message_id):
+    print(f"Duplicate of an email already queued (Message-ID {message_id or 'none'}); not queued again.",
+          file=sys.stderr)
+
+def enqueue_stream(stream, args_sender=None, args_recipients=None, spool_dir=None, requested_priority=None):
+    # Fast path: returns False without inserting when stdin is empty
+    if args_sender and args_recipients:
+        msg = None
+        prefix = stream.read(PEEK_SIZE)
+    else:
+        prefix = read_header_block(stream)
+        msg = HeaderBlock(prefix)
+
+    if not prefix:
+        return False
+
+    # msg is only consulted for values the arguments don't provide
+    sender, recipients = resolve_envelope(msg, args_sender, args_recipients)
+    headers = msg or HeaderBlock(prefix)
+    lane = priority.classify(headers, recipients, requested_priority)
+    message_id = headers.get('Message-ID')
+    hold = digest.eligible(headers, lane, recipients)
+    body = PrefixedReader(prefix, stream)
+
+    if spool_dir:
+        try:
+            with profiling.phase('spool_write'):
+                spool.write_message(spool_dir, body, sender[:255], recipients, lane, message_id, hold)
+            with profiling.phase('wakeup'):
+                wakeup.notify()
+            return True
+        except OSError as e:
+            if body.bytes_read:
+                # Part of stdin is already gone; we can't retry elsewhere
+                raise
+            print(f"Spool unavailable ({e}); inserting directly.", file=sys.stderr)
+
+    with profiling.phase('encode'):
+        encoded = bodystore.encode_stream(body)
+    with profiling.phase('connect'):
+        conn = rawdb.connect()
+    try:
+        if dedup.ENABLED and not rawdb.claim_dedup_key(conn, dedup.key(message_id, sender, recipients, encoded.hash)):
+            conn.commit()
+            report_duplicate(message_id)
+            return True
+        rawdb.store_body(conn, encoded)
+        row = {
+            'sender': sender[:255],
+            'recipients': recipients,
+            'body_hash': encoded.hash,
+            'priority': lane,
+            'status': 'pending',
+            **envelope.describe(headers, recipients, encoded.size)
+        }
+        if hold:
+            # As a string, which every DB-API driver binds
+            row['coalesce_until'] = row['next_attempt_at'] = digest.hold_until().strftime('%Y-%m-%d %H:%M:%S')
+        with profiling.phase('insert'):
+            rawdb.insert(conn, 'email_queue', row)
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Error enqueuing email: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        conn.close()
+    with profiling.phase('wakeup'):
+        wakeup.notify()
+    return True
+
+def enqueue_email(raw_email, args_sender=None, args_recipients=None, requested_priority=None):
+    with profiling.phase('import'):
+        import email
+        from email.policy import default
+        import database
+
+    # Parse the email
+    with profiling.phase('parse'):
+        msg = email.message_from_bytes(raw_email, policy=default)
+        sender, recipients = resolve_envelope(msg, args_sender, args_recipients)
+        lane = priority.classify(msg, recipients, requested_priority)
+
     engine = database.get_engine()
     Session = database.get_session(engine)
     session = Session()
 
     try:
+        with profiling.phase('encode'):
+            body = bodystore.encode(raw_email)
+        message_id = msg.get('Message-ID')
+        if dedup.ENABLED and not dedup.claim(session, dedup.key(message_id, sender, recipients, body.hash)):
+            session.commit()
+            report_duplicate(message_id)
+            return
         stmt = database.email_queue.insert().values(
             sender=sender[:255],
             recipients=recipients,
-            body=raw_email,
-            status='pending'
+            body_hash=body.hash,
+            priority=lane,
+            status='pending',
             # created_at handled by server_default
+            **envelope.describe(msg, recipients, body.size)
         )
-        session.execute(stmt)
-        session.commit()
+        if digest.eligible(msg, lane, recipients):
+            hold = digest.hold_until()
+            stmt = stmt.values(coalesce_until=hold, next_attempt_at=hold)
+        with profiling.phase('insert'):
+            bodystore.store(session, body)
+            session.execute(stmt)
+            session.commit()
     except Exception as e:
         session.rollback()
         print(f"Error enqueuing email: {e}", file=sys.stderr)
         sys.exit(1)
     finally:
         session.close()
+    wakeup.notify()
 
 if __name__ == "__main__":
     # Robust manual argument parsing to mimic sendmail quirkiness
-    # We care about: -f (sender), -t (scan headers), and positional args (recipients)
+    # We care about: -f (sender), -t (scan headers), and positional args (recipients),
+    # plus our own -O RelayPriority=<high|normal|bulk> option (sendmail's -O syntax).
     # We ignore others like -i, -oi, -o..., -v etc.
 
     args_sender = None
     args_recipients = []
+    args_priority = None
 
     idx = 1
     files_to_read = []
@@ -76,6 +234,15 @@ if __name__ == "__main__":
             elif arg.startswith('-f'):
                 # -fSender
                 args_sender = arg[2:]
+            elif arg.startswith('-O'):
+                # -O Option=value or -OOption=value; only RelayPriority is ours
+                option = arg[2:]
+                if not option and idx + 1 < len(sys.argv):
+                    idx += 1
+                    option = sys.argv[idx]
+                name, _, value = option.partition('=')
+                if name.strip().lower() == 'relaypriority':
+                    args_priority = value
             elif arg == '--':
                 # End of flags
                 idx += 1
@@ -92,10 +259,14 @@ if __name__ == "__main__":
 
         idx += 1
 
+    profiling.start('enqueue')
     try:
-        raw_content = sys.stdin.buffer.read()
-        if raw_content:
-            enqueue_email(raw_content, args_sender, args_recipients)
+        if FASTPATH:
+            enqueue_stream(sys.stdin.buffer, args_sender, args_recipients, SPOOL_DIR, args_priority)
+        else:
+            raw_content = sys.stdin.buffer.read()
+            if raw_content:
+                enqueue_email(raw_content, args_sender, args_recipients, args_priority)
     except Exception as e:
         print(f"Critical error reading input: {e}", file=sys.stderr)
         sys.exit(1)
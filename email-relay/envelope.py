@@ -0,0 +1,62 @@
+# Envelope metadata recorded on each email_queue row when it is queued:
+# message size, recipient count, recipient domains and whether it carries
+# attachments. The sender budgets claims by size and checks the SMTP SIZE
+# limit from it without touching the stored body.
+#
+# Imported by enqueue.py, so keep it free of heavy imports.
+
+class HeaderBlock:
+    # The header block at the start of a raw message, without the import
+    # cost of the email package: stops at the blank line that ends it,
+    # unfolds continuation lines and keeps raw (undecoded) values. This is
+    # all the envelope, priority.classify(), dedup and digest need.
+    def __init__(self, raw):
+        ends = [i for i in (raw.find(b'\r\n\r\n'), raw.find(b'\n\n')) if i >= 0]
+        block = raw[:min(ends)] if ends else raw
+        self._headers = {}
+        name = None
+        for line in block.decode('utf-8', 'replace').splitlines():
+            if not line.strip():
+                break
+            if line[0] in ' \t' and name is not None:
+                self._headers[name][-1] += ' ' + line.strip()
+            elif ':' in line:
+                name, value = line.split(':', 1)
+                name = name.strip().lower()
+                self._headers.setdefault(name, []).append(value.strip())
+
+    def get(self, name, failobj=None):
+        values = self._headers.get(name.lower())
+        return values[0] if values else failobj
+
+    def get_all(self, name, failobj=None):
+        return list(self._headers.get(name.lower(), [])) or failobj
+
+
+def parse_recipients(recipients):
+    return [r.strip() for r in recipients.split(',') if r.strip()]
+
+def recipient_domain(addr):
+    # Also copes with "Name <user@example.org>" taken from headers
+    return addr.rpartition('@')[2].strip().rstrip('>').lower()
+
+def has_attachments(content_type):
+    # Judged from the top-level Content-Type alone, so the body is never
+    # parsed: mail clients and PHPMailer (OJS) put attachments in a
+    # multipart/mixed message, and a single part that isn't text is one itself
+    if not content_type:
+        return False
+    media_type = content_type.split(';', 1)[0].strip().lower()
+    if media_type.startswith('multipart/'):
+        return media_type == 'multipart/mixed'
+    return not media_type.startswith('text/')
+
+def describe(headers, recipients, size):
+    # Column values for email_queue; headers is anything with get(name)
+    addrs = parse_recipients(recipients or '')
+    return {
+        'message_size': size,
+        'recipient_count': len(addrs),
+        'recipient_domains': ','.join(sorted({recipient_domain(addr) for addr in addrs})),
+        'has_attachments': has_attachments(headers.get('Content-Type')),
+    }
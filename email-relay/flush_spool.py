@@ -0,0 +1,177 @@
+import os
+import time
+import logging
+import datetime
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+import database
+import spool
+import bodystore
+import priority
+import dedup
+import digest
+from envelope import HeaderBlock, describe as describe_envelope
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.environ.get('ENQUEUE_SPOOL_DIR')
+
+# Each batch becomes one multi-row INSERT, bounded by count and total size
+# (keep well under MySQL's max_allowed_packet)
+FLUSH_BATCH_SIZE = int(os.environ.get('SPOOL_FLUSH_BATCH_SIZE', 200))
+FLUSH_BATCH_BYTES = int(os.environ.get('SPOOL_FLUSH_BATCH_BYTES', 16 * 1024 * 1024))
+
+# Files claimed into cur/ longer ago than this belong to an interrupted flush
+STALE_CLAIM_SECONDS = 600
+
+def claim(spool_dir, names):
+    # Move files from new/ to cur/. A file another flusher renamed first is
+    # skipped. The mtime is reset to record when it was claimed.
+    claimed = []
+    for name in names:
+        dst = os.path.join(spool_dir, 'cur', name)
+        try:
+            os.rename(os.path.join(spool_dir, 'new', name), dst)
+        except FileNotFoundError:
+            continue
+        os.utime(dst)
+        claimed.append(name)
+    return claimed
+
+def stale_claims(spool_dir, stale_after=STALE_CLAIM_SECONDS):
+    cur = os.path.join(spool_dir, 'cur')
+    now = time.time()
+    stale = []
+    for name in sorted(os.listdir(cur)):
+        try:
+            if now - os.path.getmtime(os.path.join(cur, name)) >= stale_after:
+                stale.append(name)
+        except FileNotFoundError:
+            continue
+    return stale
+
+def batches(spool_dir, sub, names, batch_size, batch_bytes):
+    batch, size = [], 0
+    for name in names:
+        try:
+            file_size = os.path.getsize(os.path.join(spool_dir, sub, name))
+        except FileNotFoundError:
+            continue
+        if batch and (len(batch) >= batch_size or size + file_size > batch_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append(name)
+        size += file_size
+    if batch:
+        yield batch
+
+def load_batch(session, spool_dir, names):
+    # Insert claimed files with one multi-row INSERT, then delete them. Files
+    # whose spool_ref is already in the queue were committed by an earlier,
+    # interrupted flush and are only deleted.
+    q = database.email_queue
+    existing = set(session.execute(select(q.c.spool_ref).where(q.c.spool_ref.in_(names))).scalars())
+
+    rows = []
+    bodies = []
+    keys = []
+    for name in names:
+        if name in existing:
+            continue
+        envelope, raw = spool.read_message(os.path.join(spool_dir, 'cur', name))
+        queued_at = datetime.datetime.strptime(envelope['queued_at'], '%Y-%m-%d %H:%M:%S')
+        body = bodystore.encode(raw)
+        bodies.append(body)
+        keys.append(dedup.key(envelope.get('message_id'), envelope['sender'], envelope['recipients'], body.hash))
+        rows.append({
+            'sender': envelope['sender'],
+            'recipients': envelope['recipients'],
+            'body_hash': body.hash,
+            'priority': envelope.get('priority', priority.NORMAL),
+            'status': 'pending',
+            'created_at': queued_at,
+            'next_attempt_at': queued_at,
+            'spool_ref': name,
+            'coalesce_until': None,
+            **describe_envelope(HeaderBlock(raw), envelope['recipients'], body.size),
+        })
+        if envelope.get('hold'):
+            rows[-1]['coalesce_until'] = rows[-1]['next_attempt_at'] = digest.hold_until(queued_at)
+
+    if rows and dedup.ENABLED:
+        # Keep the first copy of each message; later ones are dropped
+        new = dedup.claim_many(session, keys)
+        kept_rows, kept_bodies = [], []
+        for row, body, key in zip(rows, bodies, keys):
+            if key in new:
+                new.discard(key)
+                kept_rows.append(row)
+                kept_bodies.append(body)
+        if len(kept_rows) < len(rows):
+            logger.info(f"Dropped {len(rows) - len(kept_rows)} duplicate spooled emails.")
+        rows, bodies = kept_rows, kept_bodies
+
+    if rows:
+        bodystore.store_many(session, bodies)
+        session.execute(q.insert().values(rows))
+    session.commit()
+
+    for name in names:
+        try:
+            os.remove(os.path.join(spool_dir, 'cur', name))
+        except FileNotFoundError:
+            pass
+    return len(rows)
+
+def load_spool(session, spool_dir, batch_size=FLUSH_BATCH_SIZE, batch_bytes=FLUSH_BATCH_BYTES):
+    spool.ensure_dirs(spool_dir)
+    loaded = 0
+
+    # First finish whatever an interrupted flush left behind
+    pending = [('cur', stale_claims(spool_dir))]
+    pending.append(('new', sorted(os.listdir(os.path.join(spool_dir, 'new')))))
+
+    for sub, names in pending:
+        for batch in batches(spool_dir, sub, names, batch_size, batch_bytes):
+            if sub == 'new':
+                batch = claim(spool_dir, batch)
+                if not batch:
+                    continue
+            try:
+                loaded += load_batch(session, spool_dir, batch)
+            except IntegrityError:
+                # Another flusher loaded some of these concurrently; retry
+                # one file at a time so the rest still get in
+                session.rollback()
+                for name in batch:
+                    try:
+                        loaded += load_batch(session, spool_dir, [name])
+                    except IntegrityError:
+                        session.rollback()
+    if loaded:
+        logger.info(f"Loaded {loaded} spooled emails into the queue.")
+    return loaded
+
+def flush_spool(spool_dir=None):
+    spool_dir = spool_dir or SPOOL_DIR
+    if not spool_dir:
+        logger.error("No spool directory configured (ENQUEUE_SPOOL_DIR).")
+        return 0
+
+    engine = database.get_engine()
+    Session = database.get_session(engine)
+    session = Session()
+
+    try:
+        return load_spool(session, spool_dir)
+    except Exception as e:
+        logger.error(f"Error flushing spool: {e}")
+        session.rollback()
+        return 0
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    flush_spool()
@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# In-process metrics for the relay scripts: counters, histograms and gauges,
+# all named email_relay_*.
+#
+# Every increment, observation and gauge reading is written to stdout as a
+# one-line JSON log entry:
+#   {"severity": "INFO", "message": "metric ...", "metric": name, "value": v, "labels": {...}}
+# Cloud Logging parses these into jsonPayload, so log-based metrics can be
+# defined on them: a counter metric filtered on jsonPayload.metric, or a
+# distribution metric on jsonPayload.value for the histograms. Set
+# METRICS_LOG=0 to turn the entries off.
+#
+# The accumulated values can also be rendered as OpenMetrics text; when
+# METRICS_FILE is set, emit() writes them there at the end of a run.
+
+PREFIX = 'email_relay_'
+LOG_ENABLED = os.environ.get('METRICS_LOG', '1') != '0'
+METRICS_FILE = os.environ.get('METRICS_FILE')
+
+# Seconds; suits SMTP round trips and database queries alike
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_write_lock = threading.Lock()
+
+def log_entry(name, value, labels=None, stream=None):
+    if not LOG_ENABLED:
+        return
+    entry = {'severity': 'INFO', 'message': f"metric {name}={value:g}", 'metric': name, 'value': value}
+    if labels:
+        entry['labels'] = {k: str(v) for k, v in labels.items()}
+    line = json.dumps(entry) + '\n'
+    with _write_lock:
+        (stream or sys.stdout).write(line)
+        (stream or sys.stdout).flush()
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _labels_text(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return f"{value:g}" if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        lines = [f"# TYPE {self.name} {self.kind}", f"# HELP {self.name} {self.documentation}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._samples(key, value))
+        return lines
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_key(labels))
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            key = _key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+        log_entry(self.name, amount, labels)
+
+    def _samples(self, key, value):
+        return [f"{self.name}_total{_labels_text(key)} {_number(value)}"]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_key(labels)] = value
+        log_entry(self.name, value, labels)
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_labels_text(key)} {_number(value)}"]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        with self._lock:
+            key = _key(labels)
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+        log_entry(self.name, value, labels)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state['counts']):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_labels_text(key, [('le', _number(float(bound)))])} {cumulative}")
+        lines.append(f"{self.name}_count{_labels_text(key)} {state['count']}")
+        lines.append(f"{self.name}_sum{_labels_text(key)} {_number(state['sum'])}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, documentation, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, *args)
+            return metric
+
+    def counter(self, name, documentation):
+        return self._get(Counter, name, documentation)
+
+    def gauge(self, name, documentation):
+        return self._get(Gauge, name, documentation)
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, buckets)
+
+    def render(self):
+        # OpenMetrics text exposition of everything recorded so far
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.extend(metric.render())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def emit(self, path=None):
+        # Write the OpenMetrics text to path (default METRICS_FILE), if any
+        path = path or METRICS_FILE
+        if not path:
+            return False
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+        return True
+
+    def reset(self):
+        with self._lock:
+            for metric in self._metrics.values():
+                metric.reset()
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
@@ -1,22 +1,260 @@
 import logging
+import argparse
+import datetime
+from sqlalchemy import inspect, text, Column, Enum
+from sqlalchemy.schema import CreateColumn
 import database
+import profiling
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def migrate():
+def backfill_message_size(conn):
+    # The sender's byte budget needs the size of rows still to be sent: that
+    # of their stored body, or of the inline body of legacy rows
+    stored = "NULL"
+    if inspect(conn).has_table('email_body'):
+        stored = "(SELECT size FROM email_body WHERE email_body.hash = email_queue.body_hash)"
+    conn.execute(text(
+        f"UPDATE email_queue SET message_size = COALESCE({stored}, LENGTH(body)) WHERE status = 'pending'"
+    ))
+
+# Data fix-ups to run right after a column has been added to an existing
+# table: SQL, or a function given the connection
+BACKFILLS = {
+    # Keep the existing queue order: pending rows become due at their original
+    # (or last) attempt time instead of all at once.
+    'email_queue.next_attempt_at': (
+        "UPDATE email_queue SET next_attempt_at = COALESCE(last_attempt_at, created_at) "
+        "WHERE status = 'pending' OR next_attempt_at IS NULL"
+    ),
+    # Existing rows all go in the normal lane
+    'email_queue.priority': "UPDATE email_queue SET priority = 1 WHERE priority IS NULL",
+    'email_queue.message_size': backfill_message_size,
+    'email_queue.deferral_count': "UPDATE email_queue SET deferral_count = 0 WHERE deferral_count IS NULL",
+}
+
+def add_missing_columns(engine):
+    # create_all() only creates missing tables, so bring existing tables up to
+    # date by adding any column declared in database.py that they lack.
+    added = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in database.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col['name'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if engine.dialect.name == 'sqlite' and column.server_default is not None:
+                    # SQLite can't add a column with a non-constant default
+                    # (e.g. CURRENT_TIMESTAMP) to a populated table
+                    column = Column(column.name, column.type, nullable=column.nullable)
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+                name = f"{table.name}.{column.name}"
+                backfill = BACKFILLS.get(name)
+                if callable(backfill):
+                    backfill(conn)
+                elif backfill:
+                    conn.execute(text(backfill))
+                added.append(name)
+    return added
+
+# Columns that used to be NOT NULL and are now optional
+RELAXED_COLUMNS = [
+    # Bodies moved to email_body; only legacy rows keep one inline
+    'email_queue.body',
+]
+
+def relax_columns(engine):
+    relaxed = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for name in RELAXED_COLUMNS:
+            table_name, column_name = name.split('.')
+            if not inspector.has_table(table_name):
+                continue
+            reflected = {col['name']: col for col in inspector.get_columns(table_name)}
+            if column_name not in reflected or reflected[column_name]['nullable']:
+                continue
+            if engine.dialect.name == 'sqlite':
+                # No ALTER COLUMN; only matters for old local databases
+                logger.warning(f"Cannot make {name} nullable on SQLite; recreate the table.")
+                continue
+            column = database.metadata.tables[table_name].c[column_name]
+            ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            conn.execute(text(f"ALTER TABLE {table_name} MODIFY COLUMN {ddl}"))
+            relaxed.append(name)
+    return relaxed
+
+def widen_enums(engine):
+    # MySQL ENUM columns that gained values in database.py (e.g. the 'merged'
+    # status); SQLite stores them as plain strings
+    if engine.dialect.name != 'mysql':
+        return []
+    widened = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in database.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            reflected = {col['name']: col['type'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if not isinstance(column.type, Enum) or column.name not in reflected:
+                    continue
+                if set(column.type.enums) <= set(getattr(reflected[column.name], 'enums', ())):
+                    continue
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} MODIFY COLUMN {ddl}"))
+                widened.append(f"{table.name}.{column.name}")
+    return widened
+
+def add_missing_indexes(engine):
+    added = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in database.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+                    added.append(index.name)
+    return added
+
+# Optional layout: email_queue RANGE-partitioned by month on created_at so
+# prune_queue.py can drop whole expired months instead of deleting rows.
+# MySQL requires the partitioning column in every unique key, so the primary
+# key becomes (id, created_at) and unique indexes gain created_at as well.
+PARTITION_MONTHS_AHEAD = 3
+
+def month_start(dt):
+    return datetime.datetime(dt.year, dt.month, 1)
+
+def add_months(dt, months):
+    years, month = divmod(dt.month - 1 + months, 12)
+    return datetime.datetime(dt.year + years, month + 1, 1)
+
+def monthly_partitions(first_month, last_month):
+    # [(name, exclusive upper bound)] for every month in [first_month, last_month]
+    partitions = []
+    month = month_start(first_month)
+    while month <= last_month:
+        upper = add_months(month, 1)
+        partitions.append((f"p{month:%Y%m}", upper))
+        month = upper
+    return partitions
+
+def partition_definitions(partitions):
+    definitions = [
+        f"PARTITION {name} VALUES LESS THAN (UNIX_TIMESTAMP('{upper:%Y-%m-%d %H:%M:%S}'))"
+        for name, upper in partitions
+    ]
+    # Catch-all so inserts never fail when nobody added next month in time
+    definitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return ",\n    ".join(definitions)
+
+def get_partitions(engine):
+    # [(name, upper bound or None for MAXVALUE)], empty when not partitioned
+    if engine.dialect.name != 'mysql':
+        return []
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT partition_name, partition_description FROM information_schema.partitions "
+            "WHERE table_schema = DATABASE() AND table_name = 'email_queue' AND partition_name IS NOT NULL "
+            "ORDER BY partition_ordinal_position"
+        )).fetchall()
+    partitions = []
+    for name, description in rows:
+        if description == 'MAXVALUE':
+            partitions.append((name, None))
+        else:
+            upper = datetime.datetime.fromtimestamp(int(description), datetime.timezone.utc).replace(tzinfo=None)
+            partitions.append((name, upper))
+    return partitions
+
+def ensure_future_partitions(engine, months_ahead=PARTITION_MONTHS_AHEAD):
+    # Split pmax so there is a dedicated partition for each of the next months
+    partitions = get_partitions(engine)
+    bounds = [upper for _, upper in partitions if upper is not None]
+    if not bounds:
+        return []
+    last_month = add_months(month_start(datetime.datetime.utcnow()), months_ahead)
+    new = monthly_partitions(max(bounds), last_month)
+    if new:
+        with engine.begin() as conn:
+            conn.execute(text(
+                f"ALTER TABLE email_queue REORGANIZE PARTITION pmax INTO (\n    {partition_definitions(new)}\n)"
+            ))
+    return [name for name, _ in new]
+
+def partition_email_queue(engine, months_ahead=PARTITION_MONTHS_AHEAD):
+    if engine.dialect.name != 'mysql':
+        raise RuntimeError("The partitioned layout is only supported on MySQL.")
+
+    if get_partitions(engine):
+        return ensure_future_partitions(engine, months_ahead)
+
+    with engine.connect() as conn:
+        oldest = conn.execute(text("SELECT MIN(created_at) FROM email_queue")).scalar()
+    now = datetime.datetime.utcnow()
+    partitions = monthly_partitions(oldest or now, add_months(month_start(now), months_ahead))
+
+    # Rebuilds the table; run it in a quiet period
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE email_queue DROP PRIMARY KEY, ADD PRIMARY KEY (id, created_at)"))
+        conn.execute(text(
+            "ALTER TABLE email_queue DROP INDEX idx_spool_ref, ADD UNIQUE INDEX idx_spool_ref (spool_ref, created_at)"
+        ))
+        conn.execute(text(
+            f"ALTER TABLE email_queue PARTITION BY RANGE (UNIX_TIMESTAMP(created_at)) (\n    {partition_definitions(partitions)}\n)"
+        ))
+    return [name for name, _ in partitions]
+
+def migrate(partition=False, months_ahead=PARTITION_MONTHS_AHEAD):
     logger.info("Starting database migration for email relay...")
     engine = database.get_engine()
 
     # Create tables if they don't exist
     try:
         # metadata.create_all checks for existence before creating
-        database.metadata.create_all(engine)
-        logger.info("Successfully ensured 'email_queue' table exists.")
+        with profiling.phase('create_tables'):
+            database.metadata.create_all(engine)
+        logger.info("Successfully ensured email relay tables exist.")
+
+        with profiling.phase('add_columns'):
+            for column in add_missing_columns(engine):
+                logger.info(f"Added column {column}.")
+        with profiling.phase('alter_columns'):
+            for column in relax_columns(engine):
+                logger.info(f"Made column {column} nullable.")
+            for column in widen_enums(engine):
+                logger.info(f"Added values to column {column}.")
+        with profiling.phase('add_indexes'):
+            for index in add_missing_indexes(engine):
+                logger.info(f"Created index {index}.")
+
+        with profiling.phase('partitions'):
+            if partition:
+                created = partition_email_queue(engine, months_ahead)
+                logger.info(f"email_queue is partitioned by month; created partitions: {', '.join(created) or 'none'}.")
+            else:
+                for name in ensure_future_partitions(engine, months_ahead):
+                    logger.info(f"Added partition {name}.")
     except Exception as e:
         logger.critical(f"Failed to run migrations: {e}")
         raise e
 
 if __name__ == "__main__":
-    migrate()
+    parser = argparse.ArgumentParser(description="Create or upgrade the email relay tables.")
+    parser.add_argument('--partition', action='store_true', help="Convert email_queue to monthly RANGE partitions (MySQL)")
+    parser.add_argument('--months-ahead', type=int, default=PARTITION_MONTHS_AHEAD, help="Future monthly partitions to keep ready")
+    parser.add_argument('--profile', nargs='?', const='phases', metavar='MODES',
+                        help="Profile this run: phases (default), cprofile, tracemalloc; see profiling.py")
+    args = parser.parse_args()
+    profiling.start('migrate', args.profile)
+    migrate(args.partition, args.months_ahead)
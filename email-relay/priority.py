@@ -0,0 +1,61 @@
+import os
+import re
+
+# Priority lanes. Every row in email_queue has one, set at enqueue time; the
+# sender claims from all lanes with weighted fairness (see
+# send_batch.claim_batch), so a password reset isn't stuck behind thousands
+# of bulk notifications and bulk mail still keeps moving.
+#
+# Imported by enqueue.py, so keep module-level imports light.
+
+HIGH = 0
+NORMAL = 1
+BULK = 2
+LANES = {'high': HIGH, 'normal': NORMAL, 'bulk': BULK}
+
+# Share of a claimed batch each lane gets while all of them have work,
+# as "high,normal,bulk"
+WEIGHTS = dict(zip((HIGH, NORMAL, BULK),
+                   (int(w) for w in os.environ.get('SEND_LANE_WEIGHTS', '6,3,1').split(','))))
+
+# Subjects of OJS templates someone is waiting on: password reset, account
+# validation and registration
+HIGH_SUBJECTS = re.compile(
+    os.environ.get('RELAY_HIGH_PRIORITY_SUBJECTS', r'password|validate your account|registration'),
+    re.IGNORECASE
+)
+# A message to more recipients than this is a mailing
+BULK_RECIPIENTS = 20
+
+def parse(value):
+    # Lane from "high"/"normal"/"bulk" or its number; None if unrecognized
+    if value is None:
+        return None
+    value = str(value).strip().lower()
+    if value in LANES:
+        return LANES[value]
+    if value.isdigit() and int(value) in LANES.values():
+        return int(value)
+    return None
+
+def classify(headers, recipients='', requested=None):
+    # requested (the sendmail -O RelayPriority= option) wins, then an
+    # X-Relay-Priority header, then heuristics. headers needs only .get().
+    lane = parse(requested)
+    if lane is not None:
+        return lane
+    if headers is None:
+        return NORMAL
+
+    lane = parse(headers.get('X-Relay-Priority'))
+    if lane is not None:
+        return lane
+
+    precedence = (headers.get('Precedence') or '').strip().lower()
+    if precedence in ('bulk', 'list', 'junk') or headers.get('List-Unsubscribe') or headers.get('List-Id'):
+        return BULK
+    if recipients.count(',') + 1 > BULK_RECIPIENTS:
+        return BULK
+    if HIGH_SUBJECTS.search(headers.get('Subject') or ''):
+        return HIGH
+    return NORMAL
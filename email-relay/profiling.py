@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import nullcontext, contextmanager
+
+# Opt-in profiling for the relay entry points (enqueue.py, send_batch.py,
+# prune_queue.py, migrate.py). RELAY_PROFILE, or --profile where a script
+# has argparse, is a comma-separated list of:
+#
+#   phases       wall and CPU time per phase (claim, smtp_connect, ...)
+#   cprofile     also a cProfile dump, for pstats or snakeviz
+#   tracemalloc  also a tracemalloc snapshot and the peak traced memory
+#
+# ("1" means phases.) At the end of the run one JSON line goes to stderr,
+# which Cloud Logging parses like metrics.py's entries:
+#   {"severity": "INFO", "message": "profile send_batch ...", "profile": "send_batch",
+#    "wall_seconds": ..., "cpu_seconds": ..., "startup_seconds": ..., "phases": {...}}
+# startup_seconds is how long the process ran before profiling started:
+# interpreter start-up and module imports (python -X importtime breaks
+# those down). Phases may nest, and phases run by several worker threads
+# add up, so they don't have to sum to wall_seconds.
+#
+# Modules can add their own section to the summary with report(); database.py
+# adds "db", its connection and statement counts.
+#
+# Dumps go to RELAY_PROFILE_DIR (default: the temp directory) as
+# <script>-<timestamp>-<pid>.prof / .tracemalloc.
+#
+# Imported by enqueue.py, so keep module-level imports light. When profiling
+# is off, phase() costs a function call.
+
+PROFILE = os.environ.get('RELAY_PROFILE', '')
+PROFILE_DIR = os.environ.get('RELAY_PROFILE_DIR')
+
+MODES = ('phases', 'cprofile', 'tracemalloc')
+
+_NO_PHASE = nullcontext()
+
+def parse_modes(value):
+    modes = {m.strip().lower() for m in (value or '').split(',')} - {'', '0'}
+    if '1' in modes:
+        modes = (modes - {'1'}) | {'phases'}
+    unknown = modes - set(MODES)
+    if unknown:
+        raise ValueError(f"Unknown profiling mode(s): {', '.join(sorted(unknown))}")
+    return modes
+
+def process_age():
+    # Seconds since this process started (Linux), or None
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the command name, which may contain spaces
+            fields = f.read().rpartition(')')[2].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Profiler:
+    def __init__(self, name, modes, profile_dir=None):
+        self.name = name
+        self.modes = modes
+        self.profile_dir = profile_dir or PROFILE_DIR
+        self.phases = {}
+        self._lock = threading.Lock()
+        self._profile = None
+        self._finished = False
+
+    def start(self):
+        self.startup_seconds = process_age()
+        if 'tracemalloc' in self.modes:
+            import tracemalloc
+            tracemalloc.start()
+        if 'cprofile' in self.modes:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    @contextmanager
+    def phase(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            with self._lock:
+                totals = self.phases.setdefault(name, {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+                totals['count'] += 1
+                totals['wall_seconds'] += wall
+                totals['cpu_seconds'] += cpu
+
+    def _dump_path(self, suffix):
+        directory = self.profile_dir
+        if directory is None:
+            import tempfile
+            directory = tempfile.gettempdir()
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"{self.name}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}{suffix}")
+
+    def summary(self):
+        entry = {
+            'profile': self.name,
+            'wall_seconds': round(time.perf_counter() - self._wall, 6),
+            'cpu_seconds': round(time.process_time() - self._cpu, 6),
+            'startup_seconds': None if self.startup_seconds is None else round(self.startup_seconds, 6),
+            'phases': {
+                name: {k: round(v, 6) if isinstance(v, float) else v for k, v in totals.items()}
+                for name, totals in sorted(self.phases.items(), key=lambda item: -item[1]['wall_seconds'])
+            },
+        }
+        for name, collect in _reports.items():
+            entry[name] = collect()
+        slowest = ', '.join(f"{name} {totals['wall_seconds']:.3f}s" for name, totals in list(entry['phases'].items())[:3])
+        entry['message'] = (f"profile {self.name}: wall {entry['wall_seconds']:.3f}s, cpu {entry['cpu_seconds']:.3f}s"
+                            + (f"; slowest {slowest}" if slowest else ''))
+        return entry
+
+    def finish(self, stream=None):
+        # Write the dumps and the summary line; safe to call more than once
+        if self._finished:
+            return None
+        self._finished = True
+        entry = self.summary()
+        if self._profile is not None:
+            self._profile.disable()
+            entry['cprofile_path'] = self._dump_path('.prof')
+            self._profile.dump_stats(entry['cprofile_path'])
+        if 'tracemalloc' in self.modes:
+            import tracemalloc
+            entry['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+            entry['tracemalloc_path'] = self._dump_path('.tracemalloc')
+            tracemalloc.take_snapshot().dump(entry['tracemalloc_path'])
+            tracemalloc.stop()
+        stream = stream or sys.stderr
+        stream.write(json.dumps({'severity': 'INFO', 'message': entry.pop('message'), **entry}) + '\n')
+        stream.flush()
+        return entry
+
+
+current = None
+# Extra sections for the summary, e.g. database.py's connection and
+# statement counts: {key: function returning a JSON-serialisable value}
+_reports = {}
+
+def report(name, collect):
+    _reports[name] = collect
+
+def start(name, modes=None):
+    # Start profiling this run if RELAY_PROFILE (or `modes`, e.g. from a
+    # --profile flag) asks for it. The summary is written at exit.
+    global current
+    modes = parse_modes(PROFILE if modes is None else modes)
+    if not modes:
+        return None
+    current = Profiler(name, modes).start()
+    atexit.register(current.finish)
+    return current
+
+def phase(name):
+    # Context manager timing one phase of the run; a no-op unless profiling
+    if current is None:
+        return _NO_PHASE
+    return current.phase(name)
+
+def finish():
+    global current
+    profiler, current = current, None
+    return profiler.finish() if profiler is not None else None
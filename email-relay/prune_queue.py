@@ -1,48 +1,241 @@
+import os
+import time
 import logging
 import datetime
-from sqlalchemy import delete
+from sqlalchemy import select, delete, exists, text, func
+import archive
 import database
+import metrics
+import migrate
+import profiling
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def prune_queue():
+SENT_RETENTION_DAYS = 30
+FAILED_RETENTION_DAYS = 7
+
+# Delete in small chunks, each its own short transaction with a pause in
+# between, so pruning never holds long InnoDB locks or builds up undo that
+# competes with the sender's SKIP LOCKED claims and with OJS itself.
+CHUNK_SIZE = int(os.environ.get('PRUNE_CHUNK_SIZE', 1000))
+CHUNK_PAUSE = float(os.environ.get('PRUNE_CHUNK_PAUSE', 0.2))
+# Stop after this many seconds; whatever is left is pruned by the next run
+TIME_BUDGET = float(os.environ.get('PRUNE_TIME_BUDGET', 300))
+
+# Stored bodies no queue row references are removed once they haven't been
+# used for this long. The grace period covers a body whose queue row is still
+# being inserted (enqueue touches last_used_at before inserting it).
+BODY_GRACE_HOURS = float(os.environ.get('PRUNE_BODY_GRACE_HOURS', 1))
+
+# Enqueue dedup keys (see dedup.py) are kept this long, so a copy of an email
+# submitted again within the window is dropped
+DEDUP_RETENTION_HOURS = float(os.environ.get('PRUNE_DEDUP_RETENTION_HOURS', 24))
+
+PRUNED = metrics.counter('rows_pruned', "Rows removed by prune_queue.py, by kind")
+
+def prune_chunked(session, status, older_than, chunk_size, pause, deadline, archiver=None):
+    # Returns (rows deleted, whether everything eligible was deleted). With
+    # an archiver, each chunk is archived before it is deleted.
+    q = database.email_queue
+    total = 0
+    while True:
+        if time.monotonic() >= deadline:
+            return total, False
+
+        # Walks idx_status_created in order; deleted rows drop out of the range
+        ids = session.execute(
+            select(q.c.id)
+            .where(q.c.status == status)
+            .where(q.c.created_at < older_than)
+            .order_by(q.c.created_at, q.c.id)
+            .limit(chunk_size)
+        ).scalars().all()
+        if not ids:
+            session.commit()
+            return total, True
+
+        if archiver is not None:
+            with profiling.phase('archive'):
+                archive.archive_rows(session, archiver, ids)
+
+        result = session.execute(
+            delete(q)
+            .where(q.c.id.in_(ids))
+            .where(q.c.status == status)
+            .where(q.c.created_at < older_than)
+        )
+        r = database.email_recipient
+        session.execute(delete(r).where(r.c.email_id.in_(ids)))
+        session.commit()
+        total += result.rowcount
+
+        if len(ids) < chunk_size:
+            return total, True
+        time.sleep(pause)
+
+def collect_bodies(session, older_than, chunk_size, pause, deadline):
+    # Delete unreferenced email_body rows in chunks. Returns (count, done).
+    b = database.email_body
+    q = database.email_queue
+    # Anti-join through idx_body_hash
+    unreferenced = ~exists().where(q.c.body_hash == b.c.hash)
+    total = 0
+    while True:
+        if time.monotonic() >= deadline:
+            return total, False
+
+        hashes = session.execute(
+            select(b.c.hash)
+            .where(b.c.last_used_at < older_than)
+            .where(unreferenced)
+            .limit(chunk_size)
+        ).scalars().all()
+        if not hashes:
+            session.commit()
+            return total, True
+
+        # Re-check both conditions: an enqueue may have reused a body since
+        result = session.execute(
+            delete(b)
+            .where(b.c.hash.in_(hashes))
+            .where(b.c.last_used_at < older_than)
+            .where(unreferenced)
+        )
+        session.commit()
+        total += result.rowcount
+
+        if len(hashes) < chunk_size:
+            return total, True
+        time.sleep(pause)
+
+def expire_dedup_keys(session, older_than, chunk_size, pause, deadline):
+    # Delete dedup keys past retention in chunks, first logging the
+    # duplicates they caught. Returns (count, done).
+    d = database.email_dedup
+    emails, hits = session.execute(
+        select(func.count(), func.sum(d.c.hits)).where(d.c.created_at < older_than).where(d.c.hits > 0)
+    ).one()
+    if emails:
+        logger.info(f"Enqueue dedup dropped {hits} duplicate submissions of {emails} emails.")
+
+    total = 0
+    while True:
+        if time.monotonic() >= deadline:
+            session.commit()
+            return total, False
+
+        keys = session.execute(
+            select(d.c.dedup_key).where(d.c.created_at < older_than).limit(chunk_size)
+        ).scalars().all()
+        if not keys:
+            session.commit()
+            return total, True
+
+        result = session.execute(delete(d).where(d.c.dedup_key.in_(keys)))
+        session.commit()
+        total += result.rowcount
+
+        if len(keys) < chunk_size:
+            return total, True
+        time.sleep(pause)
+
+def drop_expired_partitions(engine, older_than, session=None, archiver=None, chunk_size=CHUNK_SIZE, deadline=None):
+    # With the partitioned layout (migrate.py --partition), whole months past
+    # retention are dropped instead of deleted row by row. A month that still
+    # holds pending rows is left to the chunked deletes. With an archiver, a
+    # month is archived before it is dropped; one whose archiving runs past
+    # the deadline is kept and archived again next run. Returns (dropped
+    # partition names, whether every expired month was handled).
+    dropped = []
+    for name, upper_bound in migrate.get_partitions(engine):
+        if upper_bound is None or upper_bound > older_than:
+            continue
+        if deadline is not None and time.monotonic() >= deadline:
+            return dropped, False
+        with engine.begin() as conn:
+            still_pending = conn.execute(text(
+                f"SELECT 1 FROM email_queue PARTITION ({name}) WHERE status = 'pending' LIMIT 1"
+            )).first()
+            if still_pending:
+                logger.warning(f"Keeping partition {name}: it still has pending emails.")
+                continue
+        if archiver is not None:
+            _, archived = archive.archive_partition(session, archiver, name, chunk_size, deadline)
+            if not archived:
+                return dropped, False
+        with engine.begin() as conn:
+            conn.execute(text(
+                f"DELETE r FROM email_recipient r JOIN email_queue PARTITION ({name}) q ON q.id = r.email_id"
+            ))
+            conn.execute(text(f"ALTER TABLE email_queue DROP PARTITION {name}"))
+        dropped.append(name)
+        logger.info(f"Dropped partition {name}.")
+    return dropped, True
+
+def prune_queue(chunk_size=CHUNK_SIZE, pause=CHUNK_PAUSE, time_budget=TIME_BUDGET, archive_dir=archive.ARCHIVE_DIR):
     engine = database.get_engine()
     Session = database.get_session(engine)
     session = Session()
 
+    deadline = time.monotonic() + time_budget
+    archiver = archive.Archive(archive_dir) if archive_dir else None
+
     try:
-        # Calculate thresholds using Python datetime for cross-db compatibility
-        now = datetime.datetime.now()
-        thirty_days_ago = now - datetime.timedelta(days=30)
-        seven_days_ago = now - datetime.timedelta(days=7)
-
-        # Prune sent emails older than 30 days
-        stmt_sent = (
-            delete(database.email_queue)
-            .where(database.email_queue.c.status == 'sent')
-            .where(database.email_queue.c.created_at < thirty_days_ago)
-        )
-        result_sent = session.execute(stmt_sent)
-        logger.info(f"Pruned {result_sent.rowcount} sent emails older than 30 days.")
+        # Calculate thresholds using Python datetime for cross-db compatibility,
+        # in UTC like the stored timestamps and the partition bounds
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        thirty_days_ago = now - datetime.timedelta(days=SENT_RETENTION_DAYS)
+        seven_days_ago = now - datetime.timedelta(days=FAILED_RETENTION_DAYS)
+
+        done_partitions = True
+        with profiling.phase('partitions'):
+            if migrate.get_partitions(engine):
+                migrate.ensure_future_partitions(engine)
+                _, done_partitions = drop_expired_partitions(engine, thirty_days_ago, session, archiver, chunk_size, deadline)
+
+        # Prune sent emails older than 30 days, and the originals of digests with them
+        with profiling.phase('prune_sent'):
+            pruned_sent, done_sent = prune_chunked(session, 'sent', thirty_days_ago, chunk_size, pause, deadline, archiver)
+        logger.info(f"Pruned {pruned_sent} sent emails older than 30 days.")
+        PRUNED.inc(pruned_sent, kind='sent')
+        with profiling.phase('prune_merged'):
+            pruned_merged, done_merged = prune_chunked(session, 'merged', thirty_days_ago, chunk_size, pause, deadline, archiver)
+        logger.info(f"Pruned {pruned_merged} emails merged into digests older than 30 days.")
+        PRUNED.inc(pruned_merged, kind='merged')
 
         # Prune failed emails older than 7 days
-        stmt_failed = (
-            delete(database.email_queue)
-            .where(database.email_queue.c.status == 'failed')
-            .where(database.email_queue.c.created_at < seven_days_ago)
-        )
-        result_failed = session.execute(stmt_failed)
-        logger.info(f"Pruned {result_failed.rowcount} failed emails older than 7 days.")
+        with profiling.phase('prune_failed'):
+            pruned_failed, done_failed = prune_chunked(session, 'failed', seven_days_ago, chunk_size, pause, deadline, archiver)
+        logger.info(f"Pruned {pruned_failed} failed emails older than 7 days.")
+        PRUNED.inc(pruned_failed, kind='failed')
 
-        session.commit()
+        # Remove bodies the pruned rows no longer need
+        body_cutoff = now - datetime.timedelta(hours=BODY_GRACE_HOURS)
+        with profiling.phase('collect_bodies'):
+            collected, done_bodies = collect_bodies(session, body_cutoff, chunk_size, pause, deadline)
+        logger.info(f"Removed {collected} unreferenced message bodies.")
+        PRUNED.inc(collected, kind='body')
+
+        dedup_cutoff = now - datetime.timedelta(hours=DEDUP_RETENTION_HOURS)
+        with profiling.phase('expire_dedup'):
+            expired, done_dedup = expire_dedup_keys(session, dedup_cutoff, chunk_size, pause, deadline)
+        logger.info(f"Expired {expired} enqueue dedup keys.")
+        PRUNED.inc(expired, kind='dedup_key')
+
+        if not (done_partitions and done_sent and done_merged and done_failed and done_bodies and done_dedup):
+            logger.warning(f"Prune time budget of {time_budget}s exhausted; the rest will be pruned next run.")
 
     except Exception as e:
         logger.error(f"Error pruning email queue: {e}")
         session.rollback()
     finally:
+        if archiver is not None:
+            archiver.close()
         session.close()
+        metrics.REGISTRY.emit()
 
 if __name__ == "__main__":
+    profiling.start('prune_queue')
     prune_queue()
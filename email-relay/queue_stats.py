@@ -0,0 +1,135 @@
+import os
+import sys
+import logging
+import argparse
+import datetime
+from sqlalchemy import select, func
+import database
+import metrics
+import priority
+import flush_spool
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Queue gauges for dashboards and alerting. Every query is a range over one
+# of email_queue's (status, ...) indexes, so the cost grows with the number
+# of pending rows, not with the size of the table:
+#
+#   pending per lane        idx_status_priority_next
+#   due now, most overdue   idx_status_next_attempt
+#   held for digests        idx_status_coalesce
+#   oldest pending          idx_status_created (a single index lookup)
+#   pending bytes           idx_status_body_hash outer-joined to email_body's key
+#   failed in the last day  idx_status_created
+
+PENDING = metrics.gauge('queue_pending', "Pending messages per priority lane")
+DUE = metrics.gauge('queue_due', "Pending messages whose next attempt is due")
+HELD = metrics.gauge('queue_held', "Pending messages held for a digest")
+OLDEST_AGE = metrics.gauge('queue_oldest_pending_age_seconds', "Age of the oldest pending message")
+OVERDUE = metrics.gauge('queue_max_overdue_seconds', "How long the most overdue pending message has been due")
+PENDING_BYTES = metrics.gauge('queue_pending_bytes', "Raw (uncompressed) size of pending messages")
+FAILED_RECENT = metrics.gauge('queue_failed_last_day', "Messages that failed permanently in the last 24 hours")
+SPOOLED = metrics.gauge('spool_files', "Messages in the spool waiting to be loaded")
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def queries(now):
+    q = database.email_queue
+    b = database.email_body
+    pending = q.c.status == 'pending'
+    return {
+        'pending': select(q.c.priority, func.count()).where(pending).group_by(q.c.priority),
+        'due': select(func.count()).select_from(q).where(pending).where(q.c.next_attempt_at <= now),
+        'held': select(func.count()).select_from(q).where(pending).where(q.c.coalesce_until.is_not(None)),
+        'oldest': select(func.min(q.c.created_at)).where(pending),
+        'overdue': select(func.min(q.c.next_attempt_at)).where(pending),
+        # Raw message size: message_size, or for rows queued before it
+        # existed the stored body's size or the legacy inline body's length
+        'bytes': (select(func.sum(func.coalesce(q.c.message_size, b.c.size, func.length(q.c.body))))
+                  .select_from(q.outerjoin(b, b.c.hash == q.c.body_hash))
+                  .where(pending)),
+        'failed': (select(func.count()).select_from(q)
+                   .where(q.c.status == 'failed')
+                   .where(q.c.created_at >= now - datetime.timedelta(days=1))),
+    }
+
+def seconds_since(then, now):
+    if then is None:
+        return 0.0
+    if isinstance(then, str):
+        # SQLite returns aggregates of TIMESTAMP columns as text
+        then = datetime.datetime.fromisoformat(then)
+    return max(0.0, (now - then).total_seconds())
+
+def spool_depth(spool_dir):
+    try:
+        return len(os.listdir(os.path.join(spool_dir, 'new')))
+    except FileNotFoundError:
+        return 0
+
+def collect(session, now=None, spool_dir=None):
+    # Run the queries and record the gauges; returns {name: value}, with
+    # per-lane values under 'pending'
+    now = now or utcnow()
+    stmts = queries(now)
+    lanes = {lane: 0 for lane in priority.LANES.values()}
+    lanes.update(dict(session.execute(stmts['pending']).fetchall()))
+    stats = {
+        'pending': {name: lanes[lane] for name, lane in priority.LANES.items()},
+        'due': session.execute(stmts['due']).scalar(),
+        'held': session.execute(stmts['held']).scalar(),
+        'oldest_pending_age_seconds': seconds_since(session.execute(stmts['oldest']).scalar(), now),
+        'max_overdue_seconds': seconds_since(session.execute(stmts['overdue']).scalar(), now),
+        'pending_bytes': session.execute(stmts['bytes']).scalar() or 0,
+        'failed_last_day': session.execute(stmts['failed']).scalar(),
+    }
+    session.commit()
+
+    for name, count in stats['pending'].items():
+        PENDING.set(count, lane=name)
+    DUE.set(stats['due'])
+    HELD.set(stats['held'])
+    OLDEST_AGE.set(stats['oldest_pending_age_seconds'])
+    OVERDUE.set(stats['max_overdue_seconds'])
+    PENDING_BYTES.set(stats['pending_bytes'])
+    FAILED_RECENT.set(stats['failed_last_day'])
+    if spool_dir:
+        stats['spool_files'] = spool_depth(spool_dir)
+        SPOOLED.set(stats['spool_files'])
+    return stats
+
+def format_text(stats):
+    lines = [f"{'pending':<28}{sum(stats['pending'].values())}"]
+    lines += [f"  {lane:<26}{count}" for lane, count in stats['pending'].items()]
+    for name, value in stats.items():
+        if name != 'pending':
+            lines.append(f"{name:<28}{value:g}" if isinstance(value, float) else f"{name:<28}{value}")
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report email queue depth, age and size.")
+    parser.add_argument('--format', choices=('text', 'json', 'openmetrics'), default='text',
+                        help="text for people; json writes one structured log entry per gauge; openmetrics prints the exposition")
+    args = parser.parse_args()
+
+    # Only the json format wants the per-gauge log entries
+    metrics.LOG_ENABLED = args.format == 'json'
+
+    engine = database.get_engine()
+    session = database.get_session(engine)()
+    try:
+        stats = collect(session, spool_dir=flush_spool.SPOOL_DIR)
+    except Exception as e:
+        logger.error(f"Error collecting queue stats: {e}")
+        sys.exit(1)
+    finally:
+        session.close()
+
+    if args.format == 'text':
+        print(format_text(stats))
+    elif args.format == 'openmetrics':
+        sys.stdout.write(metrics.REGISTRY.render())
+    metrics.REGISTRY.emit()
@@ -0,0 +1,99 @@
+import io
+import os
+
+# Minimal DB-API access for the sendmail shim (enqueue.py). The shim lives
+# for a single message, so importing SQLAlchemy and building an engine costs
+# more than the INSERT itself; this talks to the driver directly instead.
+# Connection settings are the same DB_* environment variables database.py uses.
+
+def driver():
+    return os.environ.get('DB_DRIVER', 'mysql')
+
+def connect():
+    name = os.environ.get('DB_NAME', 'ojs')
+
+    if driver() == 'sqlite':
+        # Local benchmarks and tests: DB_NAME is the database file
+        import sqlite3
+        return sqlite3.connect(name)
+
+    import mysql.connector
+    from mysql.connector.constants import ClientFlag
+    socket = os.environ.get('DB_SOCKET')
+    if socket:
+        # Cloud SQL proxy socket: no TCP or TLS handshake per message
+        address = {'unix_socket': socket}
+    else:
+        address = {'host': os.environ.get('DB_HOST', 'localhost'), 'port': int(os.environ.get('DB_PORT', '3306'))}
+    return mysql.connector.connect(
+        user=os.environ.get('DB_USER', 'ojs'),
+        password=os.environ.get('DB_PASSWORD', 'ojs'),
+        database=name,
+        **address,
+        # The pure-Python protocol supports streaming file-like parameters
+        # with COM_STMT_SEND_LONG_DATA; it also imports faster than the C extension.
+        use_pure=True,
+        # UPDATE rowcount = rows matched, not rows changed (as in SQLAlchemy)
+        client_flags=[ClientFlag.FOUND_ROWS]
+    )
+
+def execute(conn, sql, params=()):
+    # Run one statement written with %s placeholders; returns the rowcount
+    if driver() == 'sqlite':
+        sql = sql.replace('%s', '?')
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+def insert(conn, table, row, suffix=''):
+    # INSERT one row. Values that are file-like (have .read) are streamed to
+    # MySQL in chunks through a prepared statement instead of being read into
+    # memory first; other drivers get them materialized.
+    columns = list(row)
+    values = list(row.values())
+
+    if driver() == 'sqlite':
+        placeholder = '?'
+        values = [v.read() if hasattr(v, 'read') else v for v in values]
+        cursor = conn.cursor()
+    else:
+        placeholder = '%s'
+        cursor = conn.cursor(prepared=True)
+
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join([placeholder] * len(columns))})"
+    if suffix:
+        sql = f"{sql} {suffix}"
+    try:
+        cursor.execute(sql, values)
+        return cursor.lastrowid
+    finally:
+        cursor.close()
+
+def store_body(conn, body):
+    # Same upsert as bodystore.store(): touch the body if it is already
+    # stored, otherwise insert it (tolerating a concurrent insert)
+    if execute(conn, "UPDATE email_body SET last_used_at = CURRENT_TIMESTAMP WHERE hash = %s", [body.hash]):
+        return False
+
+    if driver() == 'sqlite':
+        on_conflict = "ON CONFLICT (hash) DO UPDATE SET last_used_at = CURRENT_TIMESTAMP"
+    else:
+        on_conflict = "ON DUPLICATE KEY UPDATE last_used_at = CURRENT_TIMESTAMP"
+    insert(conn, 'email_body', {
+        'hash': body.hash,
+        'codec': body.codec,
+        'size': body.size,
+        'data': io.BytesIO(body.data),
+    }, on_conflict)
+    return True
+
+def claim_dedup_key(conn, key):
+    # Same as dedup.claim(): True if the key is new, otherwise count the hit
+    verb = 'INSERT OR IGNORE' if driver() == 'sqlite' else 'INSERT IGNORE'
+    if execute(conn, f"{verb} INTO email_dedup (dedup_key) VALUES (%s)", [key]):
+        return True
+    execute(conn, "UPDATE email_dedup SET hits = hits + 1 WHERE dedup_key = %s", [key])
+    return False
@@ -1,12 +1,62 @@
 CREATE TABLE IF NOT EXISTS email_queue (
     id INT AUTO_INCREMENT PRIMARY KEY,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    status ENUM('pending', 'sent', 'failed') DEFAULT 'pending',
+    status ENUM('pending', 'sent', 'failed', 'merged') DEFAULT 'pending',
     attempt_count INT DEFAULT 0,
     last_attempt_at TIMESTAMP NULL,
     error_message TEXT,
     sender VARCHAR(255) NOT NULL,
     recipients TEXT NOT NULL,
-    body MEDIUMBLOB NOT NULL,
-    INDEX idx_status_created (status, created_at)
+    body MEDIUMBLOB NULL,
+    body_hash CHAR(64) NULL,
+    claimed_by VARCHAR(64) NULL,
+    lease_expires_at TIMESTAMP NULL,
+    next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    spool_ref VARCHAR(128) NULL,
+    priority SMALLINT DEFAULT 1,
+    coalesce_until TIMESTAMP NULL,
+    digest_id INT NULL,
+    message_size INT NULL,
+    recipient_count INT NULL,
+    recipient_domains TEXT NULL,
+    has_attachments BOOLEAN NULL,
+    deferral_count SMALLINT DEFAULT 0,
+    INDEX idx_status_created (status, created_at),
+    INDEX idx_status_next_attempt (status, next_attempt_at),
+    INDEX idx_status_priority_next (status, priority, next_attempt_at),
+    INDEX idx_status_coalesce (status, coalesce_until),
+    INDEX idx_status_body_hash (status, body_hash),
+    UNIQUE INDEX idx_spool_ref (spool_ref),
+    INDEX idx_body_hash (body_hash)
+);
+
+CREATE TABLE IF NOT EXISTS email_body (
+    hash CHAR(64) PRIMARY KEY,
+    codec VARCHAR(8) NOT NULL,
+    size INT NOT NULL,
+    data MEDIUMBLOB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS email_recipient (
+    email_id INT NOT NULL,
+    address VARCHAR(255) NOT NULL,
+    status ENUM('pending', 'sent', 'failed') NOT NULL,
+    error_message TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (email_id, address)
+);
+
+CREATE TABLE IF NOT EXISTS email_dedup (
+    dedup_key CHAR(64) PRIMARY KEY,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    hits INT NOT NULL DEFAULT 0,
+    INDEX idx_dedup_created (created_at)
+);
+
+CREATE TABLE IF NOT EXISTS relay_state (
+    name VARCHAR(64) PRIMARY KEY,
+    value VARCHAR(255) NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
 );
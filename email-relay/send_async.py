@@ -0,0 +1,668 @@
+import os
+import ssl
+import time
+import base64
+import socket
+import asyncio
+import smtplib
+import logging
+import argparse
+import datetime
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select
+import database
+import bodystore
+import digest
+import wakeup
+import send_batch
+from send_batch import (Throttled, DomainDeferred, RecipientLedger, OutcomeBuffer, DomainScheduler,
+                        plan_deliveries, settled_recipients, claim_batch, release_claims, load_body,
+                        size_limit, too_large, is_domain_deferral, is_throttle, load_spooled, init_rate_control, save_rate,
+                        smtp_data, utcnow, worker_identity)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Asyncio sender engine, an alternative to send_batch.py's thread-per-
+# connection workers. One event loop keeps many SMTP sessions busy at once
+# (a session waiting on a round trip costs nothing), paced by the same token
+# bucket and adaptive rate control. Claims, outcome writes and body reads are
+# send_batch.py's own functions, run on a small thread pool, so retries,
+# leases and statuses in email_queue are exactly the same and both engines
+# can drain one queue side by side.
+#
+# Memory is bounded by a byte budget: a delivery waits until the bodies in
+# flight leave room for its own (see delivery_cost()). One body larger than
+# the whole budget is still sent, alone.
+
+SESSIONS = int(os.environ.get('SEND_ASYNC_SESSIONS', 10))
+MAX_BYTES = int(os.environ.get('SEND_ASYNC_MAX_BYTES', 64 * 1024 * 1024))
+DB_THREADS = int(os.environ.get('SEND_ASYNC_DB_THREADS', 4))
+# Seconds to wait for any one SMTP reply
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', 60))
+# Sessions in a row that can't connect before the engine gives up
+MAX_CONNECT_FAILURES = send_batch.MAX_RECONNECTS
+
+
+class AsyncSMTP:
+    # The part of smtplib.SMTP the sender uses, on asyncio streams. Raises
+    # smtplib's exceptions, so send_batch.is_throttle() and friends apply.
+    _local_hostname = None
+
+    def __init__(self, host, port, timeout=SMTP_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.esmtp = False
+        self.extensions = {}
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    @classmethod
+    def local_hostname(cls):
+        if cls._local_hostname is None:
+            cls._local_hostname = socket.getfqdn()
+        return cls._local_hostname
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        code, msg = await self.reply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, msg)
+        await self.ehlo()
+
+    async def reply(self):
+        if self.reader is None:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                # The session is in an unknown state; don't reuse it
+                self.close()
+                raise
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            try:
+                code = int(line[:3])
+            except ValueError:
+                self.close()
+                raise smtplib.SMTPServerDisconnected(f"Malformed reply {line[:64]!r}")
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return code, b'\n'.join(lines)
+
+    async def send(self, data):
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+        self.writer.write(data)
+        try:
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            self.close()
+            raise smtplib.SMTPServerDisconnected(str(e)) from e
+
+    async def command(self, line):
+        await self.send(line.encode('ascii') + b'\r\n')
+        return await self.reply()
+
+    async def ehlo(self):
+        code, msg = await self.command(f"EHLO {self.local_hostname()}")
+        self.extensions = {}
+        if code != 250:
+            code, msg = await self.command(f"HELO {self.local_hostname()}")
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, msg)
+            self.esmtp = False
+            return
+        self.esmtp = True
+        for line in msg.decode('latin-1').split('\n')[1:]:
+            keyword, _, params = line.partition(' ')
+            self.extensions[keyword.lower()] = params.strip()
+
+    def has_extn(self, name):
+        return name.lower() in self.extensions
+
+    async def starttls(self, context=None):
+        code, msg = await self.command('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, msg)
+        await self.writer.start_tls(context or ssl.create_default_context(), server_hostname=self.host)
+        await self.ehlo()
+
+    async def login(self, user, password):
+        methods = self.extensions.get('auth', '').upper().split()
+        if 'PLAIN' in methods:
+            token = base64.b64encode(f"\0{user}\0{password}".encode()).decode('ascii')
+            code, msg = await self.command(f"AUTH PLAIN {token}")
+        elif 'LOGIN' in methods:
+            code, msg = await self.command('AUTH LOGIN')
+            if code == 334:
+                code, msg = await self.command(base64.b64encode(user.encode()).decode('ascii'))
+            if code == 334:
+                code, msg = await self.command(base64.b64encode(password.encode()).decode('ascii'))
+        else:
+            raise smtplib.SMTPNotSupportedError("No suitable authentication method found.")
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, msg)
+
+    async def rset(self):
+        # Like send_batch.reset(): a connection that is already gone is fine
+        try:
+            await self.command('RSET')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def sendmail(self, from_addr, to_addrs, size, chunks):
+        # send_batch.sendmail_streaming() on this connection: same envelope
+        # handling, return value and exceptions
+        options = f" SIZE={size}" if self.esmtp and self.has_extn('size') else ''
+        code, resp = await self.command(f"MAIL FROM:{smtplib.quoteaddr(from_addr)}{options}")
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                await self.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+        refused = {}
+        for addr in to_addrs:
+            code, resp = await self.command(f"RCPT TO:{smtplib.quoteaddr(addr)}")
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+            if code == 421:
+                self.close()
+                raise smtplib.SMTPRecipientsRefused(refused)
+        if len(refused) == len(to_addrs):
+            await self.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, resp = await self.command('DATA')
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        for piece in smtp_data(chunks):
+            await self.send(piece)
+        code, resp = await self.reply()
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                await self.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def open_session():
+    # A connected and authenticated AsyncSMTP (cf. send_batch.open_smtp()
+    # and authenticate())
+    client = AsyncSMTP(os.environ.get('SMTP_HOST', 'smtp-relay.gmail.com'), int(os.environ.get('SMTP_PORT', 587)))
+    with send_batch.SMTP_CONNECT_SECONDS.time():
+        await client.connect()
+    smtp_user = os.environ.get('SMTP_USER')
+    smtp_pass = os.environ.get('SMTP_PASSWORD')
+    try:
+        with send_batch.SMTP_AUTH_SECONDS.time():
+            if client.has_extn('starttls'):
+                await client.starttls()
+            elif smtp_user and smtp_pass:
+                # Never send the password in the clear
+                raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+            if smtp_user and smtp_pass:
+                await client.login(smtp_user, smtp_pass)
+    except BaseException:
+        client.close()
+        raise
+    return client
+
+
+class ByteBudget:
+    # Bytes of message bodies held by deliveries in flight
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._changed = asyncio.Condition()
+
+    async def acquire(self, n):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.used == 0 or self.used + n <= self.limit)
+            self.used += n
+
+    async def release(self, n):
+        async with self._changed:
+            self.used -= n
+            self._changed.notify_all()
+
+
+def delivery_cost(size):
+    # Memory a delivery of a body of `size` bytes holds: the stored copy
+    # (compressed, at most `size`) plus the decoded message, or only a
+    # chunk of it when it is streamed
+    if size <= send_batch.STREAM_THRESHOLD:
+        return 2 * size
+    return size + bodystore.CHUNK_SIZE
+
+async def acquire_token(bucket):
+    # send_batch.TokenBucket.acquire() without blocking the loop
+    while True:
+        wait = bucket.try_acquire()
+        if not wait:
+            return
+        await asyncio.sleep(wait)
+
+async def deliver(client, delivery, ledger, body):
+    # send_batch.deliver() over an AsyncSMTP: records the outcome in the
+    # ledger and returns the number of rows it settled as sent
+    ids = [row.id for row in delivery.rows]
+    if too_large(delivery, ledger, body, size_limit(client.extensions)):
+        return 0
+    try:
+        with send_batch.SMTP_SEND_SECONDS.time():
+            if body.codec is None:
+                chunks = [body.data]
+            elif body.size <= send_batch.STREAM_THRESHOLD:
+                chunks = [bodystore.decode(body.codec, body.data)]
+            else:
+                chunks = bodystore.iter_decode(body.codec, body.data)
+            refused = await client.sendmail(delivery.sender, delivery.to_addrs, body.size, chunks)
+
+    except smtplib.SMTPServerDisconnected:
+        # The session is gone, not the message
+        raise
+
+    except Exception as e:
+        if is_domain_deferral(e):
+            raise DomainDeferred(str(e)) from e
+
+        if is_throttle(e):
+            logger.warning(f"Throttled while sending email ID {', '.join(map(str, ids))}: {e}")
+            ledger.deferred(delivery, str(e)[:65000])
+            raise Throttled(str(e)) from e
+
+        logger.error(f"Failed to send email ID {', '.join(map(str, ids))}: {e}")
+        ledger.failed(delivery, str(e)[:65000])
+        return 0
+
+    logger.info(f"Sent email ID {', '.join(map(str, ids))}")
+    return ledger.sent(delivery, refused)
+
+
+class Batch:
+    # One claimed batch: its ledger, outcomes and the bodies its deliveries use.
+    # With a journal_path, sends are journaled as in send_batch.py's workers
+    # (batches overlap, so each has its own journal).
+    def __init__(self, emails, journal_path=None):
+        self.emails = emails
+        self.outcomes = OutcomeBuffer(journal_path)
+        self.ledger = RecipientLedger(self.outcomes, emails)
+        self.sizes = {}
+        self.tasks = []
+        # Set once every delivery has been started or postponed
+        self.dispatched = asyncio.Event()
+        self._bodies = {}
+
+    def release_body(self, body_hash):
+        entry = self._bodies.get(body_hash)
+        if entry is not None:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._bodies[body_hash]
+
+
+class AsyncSender:
+    def __init__(self, engine, Session, worker_id, bucket, controller, sessions=SESSIONS,
+                 batch_size=send_batch.BATCH_SIZE, max_bytes=MAX_BYTES, db_threads=DB_THREADS,
+                 scheduler=None, wakeup_channel=None, journal_dir=send_batch.JOURNAL_DIR):
+        self.engine = engine
+        self.Session = Session
+        self.worker_id = worker_id
+        self.bucket = bucket
+        self.controller = controller
+        self.sessions = sessions
+        self.batch_size = batch_size
+        self.scheduler = scheduler or DomainScheduler()
+        self.wakeup = wakeup_channel or wakeup.channel()
+        self.journal_dir = journal_dir
+        self._batch_numbers = itertools.count()
+        self._last_journal_scan = None
+        self.budget = ByteBudget(max_bytes)
+        self.db_pool = ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix='sender-db')
+        self.delivered = 0
+        self.rate_dirty = False
+        self.connect_failures = 0
+        self.error = None
+        self._idle = []
+        self._slots = None
+        self._resume_at = 0.0
+
+    def _journal_path(self):
+        if not self.journal_dir:
+            return None
+        return os.path.join(self.journal_dir, f"{self.worker_id}-{next(self._batch_numbers)}.journal")
+
+    async def db(self, fn, *args):
+        # Run fn(session, *args) on the database thread pool
+        def call():
+            session = self.Session()
+            try:
+                return fn(session, *args)
+            finally:
+                session.close()
+        return await asyncio.get_running_loop().run_in_executor(self.db_pool, call)
+
+    # Database steps, run through db()
+
+    def _claim(self, session):
+        lease_seconds = send_batch.LEASE_SECONDS + int(self.batch_size * 60 / self.bucket.rate_per_minute)
+        # Settle abandoned journals (of either engine) well before their rows'
+        # leases can expire; journals of batches in flight are locked
+        if self.journal_dir and (self._last_journal_scan is None
+                                 or time.monotonic() - self._last_journal_scan >= send_batch.JOURNAL_SCAN_INTERVAL):
+            self._last_journal_scan = time.monotonic()
+            send_batch.recover_journals(session, self.journal_dir)
+        if digest.WINDOW_SECONDS:
+            try:
+                digest.coalesce(session)
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Error building digests: {e}")
+        with send_batch.CLAIM_SECONDS.time():
+            return claim_batch(session, self.engine, self.worker_id, self.batch_size, lease_seconds)
+
+    def _body_sizes(self, session, hashes):
+        b = database.email_body
+        sizes = dict(session.execute(select(b.c.hash, b.c.size).where(b.c.hash.in_(hashes))).fetchall())
+        session.commit()
+        return sizes
+
+    def _write(self, session, outcomes, rate):
+        try:
+            if rate is not None:
+                save_rate(session, rate)
+            outcomes.write(session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        outcomes.clear()
+
+    def _release(self, session, ids):
+        release_claims(session, self.worker_id, ids)
+
+    # SMTP sessions
+
+    async def _checkout(self):
+        while self._idle:
+            client = self._idle.pop()
+            if client.connected:
+                return client
+        try:
+            client = await open_session()
+        except Exception as e:
+            self.connect_failures += 1
+            if self.connect_failures >= MAX_CONNECT_FAILURES and self.error is None:
+                logger.critical(f"Could not connect to the SMTP server {self.connect_failures} times in a row; giving up.")
+                self.error = e
+            raise
+        self.connect_failures = 0
+        return client
+
+    def _checkin(self, client):
+        if client.connected:
+            self._idle.append(client)
+
+    async def _body(self, batch, email_row):
+        # Loaded whole: the byte budget already accounts for it, and reading
+        # it piece by piece would block the loop on the database
+        if email_row.body_hash is None:
+            return await self.db(load_body, email_row)
+        entry = batch._bodies.get(email_row.body_hash)
+        if entry is None:
+            entry = batch._bodies[email_row.body_hash] = [
+                asyncio.ensure_future(self.db(load_body, email_row)), 0
+            ]
+        entry[1] += 1
+        return await entry[0]
+
+    async def _deliver(self, batch, delivery):
+        # Send one delivery, holding a session slot and its share of the byte
+        # budget. A dropped session is retried on a new one; a delivery that
+        # still can't go out is left unresolved and released with its batch.
+        first = delivery.rows[0]
+        size = first.message_size if first.message_size is not None else batch.sizes.get(first.body_hash, 0)
+        cost = delivery_cost(size)
+        await self.budget.acquire(cost)
+        try:
+            body = await self._body(batch, first)
+            if body is None:
+                ids = ', '.join(str(row.id) for row in delivery.rows)
+                logger.error(f"Body {first.body_hash} of email ID {ids} is missing.")
+                batch.ledger.lost(delivery, "Message body missing")
+                return
+
+            for _ in range(send_batch.MAX_RECONNECTS):
+                pause = self._resume_at - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                await acquire_token(self.bucket)
+                try:
+                    client = await self._checkout()
+                except Exception as e:
+                    logger.error(f"Failed to connect to SMTP server: {e}")
+                    return
+                try:
+                    sent = await deliver(client, delivery, batch.ledger, body)
+                except smtplib.SMTPServerDisconnected as e:
+                    logger.warning(f"SMTP session dropped ({e}); reconnecting.")
+                    client.close()
+                    continue
+                except Throttled:
+                    client.close()
+                    self.controller.on_throttle()
+                    self.rate_dirty = True
+                    # Gmail usually closes the session after a 421; every session waits
+                    self._resume_at = time.monotonic() + self.throttle_pause
+                    logger.warning(f"Backing off to {self.controller.rate:g} emails/min; "
+                                   f"pausing {self.throttle_pause}s after throttle reply.")
+                    return
+                except DomainDeferred as e:
+                    self._checkin(client)
+                    seconds = self.scheduler.back_off(delivery.domain)
+                    ids = ', '.join(str(row.id) for row in delivery.rows)
+                    logger.warning(f"{delivery.domain} deferred email ID {ids} ({e}); leaving it alone for {seconds:g}s.")
+                    self._postpone(batch, delivery, seconds)
+                    return
+                self._checkin(client)
+                if sent:
+                    self.delivered += sent
+                    if self.controller.on_success():
+                        self.rate_dirty = True
+                        logger.info(f"Raising send rate to {self.controller.rate:g} emails/min.")
+                return
+        finally:
+            batch.release_body(first.body_hash)
+            self.scheduler.finish(delivery.domain)
+            await self.budget.release(cost)
+            self._slots.release()
+
+    def _postpone(self, batch, delivery, seconds):
+        until = utcnow() + datetime.timedelta(seconds=seconds)
+        batch.ledger.postponed(delivery, f"Recipient domain {delivery.domain} is busy", until)
+
+    async def _dispatch(self, batch):
+        # Plan the batch and start its deliveries, round-robin across domains
+        # as in send_batch.DomainScheduler.schedule(). Returns once all are
+        # started or postponed.
+        settled = await self.db(settled_recipients, batch.emails)
+        queues = dict(plan_deliveries(batch.emails, send_batch.MAX_RECIPIENTS, settled))
+        for queue in queues.values():
+            for delivery in queue:
+                batch.ledger.expect(delivery)
+        self.delivered += batch.ledger.settle_unplanned()
+
+        # Rows queued before message_size existed
+        hashes = {row.body_hash for row in batch.emails if row.message_size is None and row.body_hash is not None}
+        if hashes:
+            batch.sizes = await self.db(self._body_sizes, hashes)
+
+        scheduler = self.scheduler
+        while queues:
+            await self._slots.acquire()
+            started = False
+            soonest = None
+            for domain in list(queues):
+                wait = scheduler.try_start(domain)
+                if not wait:
+                    started = True
+                    delivery = queues[domain].popleft()
+                    # To the back of the round
+                    remaining = queues.pop(domain)
+                    if remaining:
+                        queues[domain] = remaining
+                    batch.tasks.append(asyncio.ensure_future(self._deliver(batch, delivery)))
+                    break
+                elif wait > scheduler.max_wait or scheduler.is_paused(domain):
+                    for delivery in queues.pop(domain):
+                        self._postpone(batch, delivery, wait)
+                else:
+                    soonest = wait if soonest is None else min(soonest, wait)
+            if not started:
+                self._slots.release()
+                if queues and soonest is not None:
+                    await asyncio.sleep(soonest)
+
+    async def _finish(self, batch):
+        # Wait for the batch's deliveries, then write its outcomes and hand
+        # back whatever is still unresolved
+        try:
+            await asyncio.gather(*batch.tasks, return_exceptions=True)
+        finally:
+            batch.ledger.abandon()
+            rate = self.controller.rate if self.rate_dirty else None
+            self.rate_dirty = False
+            try:
+                await self.db(self._write, batch.outcomes, rate)
+            finally:
+                # A journal whose outcomes weren't written is kept for recovery
+                batch.outcomes.close()
+                await self.db(self._release, batch.ledger.unresolved)
+
+    async def _process(self, batch):
+        try:
+            await self._dispatch(batch)
+        finally:
+            batch.dispatched.set()
+            await self._finish(batch)
+
+    async def run(self, idle_timeout=0, poll_interval=send_batch.DEFAULT_POLL_INTERVAL,
+                  throttle_pause=send_batch.THROTTLE_PAUSE):
+        # Claim and deliver until the queue has been empty for idle_timeout
+        # seconds (0: until it is first found empty). The next batch is
+        # claimed as soon as every delivery of the last one has started.
+        # Returns the number of messages delivered.
+        loop = asyncio.get_running_loop()
+        self.throttle_pause = throttle_pause
+        self._slots = asyncio.Semaphore(self.sessions)
+        in_flight = set()
+        idle_since = time.monotonic()
+        try:
+            while self.error is None:
+                emails = await self.db(self._claim)
+                if emails:
+                    logger.info(f"[{self.worker_id}] Processing batch of {len(emails)} emails at {self.controller.rate:g} emails/min.")
+                    batch = Batch(emails, self._journal_path())
+                    task = asyncio.ensure_future(self._process(batch))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                    # Claim the next one once this one is under way
+                    await batch.dispatched.wait()
+                    idle_since = time.monotonic()
+                    continue
+
+                if in_flight:
+                    # Retries of the batches in flight may become claimable
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    idle_since = time.monotonic()
+                    continue
+                if await loop.run_in_executor(self.db_pool, load_spooled, self.Session):
+                    continue
+                if time.monotonic() - idle_since >= idle_timeout:
+                    if idle_timeout:
+                        logger.info(f"[{self.worker_id}] Queue idle for {idle_timeout}s; exiting after {self.delivered} emails.")
+                    else:
+                        logger.info("No pending emails to process.")
+                    break
+                await loop.run_in_executor(None, self.wakeup.wait, poll_interval)
+
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+            if self.error is not None:
+                raise self.error
+            return self.delivered
+        finally:
+            for task in in_flight:
+                task.cancel()
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+            while self._idle:
+                await self._idle.pop().quit()
+            self.db_pool.shutdown(wait=True)
+
+
+def run(sessions=SESSIONS, daemon=False, rate_per_minute=send_batch.DEFAULT_RATE_PER_MINUTE,
+        burst=send_batch.DEFAULT_BURST, idle_timeout=send_batch.DEFAULT_IDLE_TIMEOUT,
+        poll_interval=send_batch.DEFAULT_POLL_INTERVAL, batch_size=send_batch.BATCH_SIZE,
+        throttle_pause=send_batch.THROTTLE_PAUSE, max_bytes=MAX_BYTES):
+    # send_batch.run_pool() for the asyncio engine
+    engine = database.get_engine()
+    Session = database.get_session(engine)
+    bucket, controller = init_rate_control(Session, rate_per_minute, burst)
+    scheduler = DomainScheduler(send_batch.DOMAIN_RATE_PER_MINUTE, send_batch.DOMAIN_BURST,
+                                send_batch.DOMAIN_CONCURRENCY, send_batch.DOMAIN_MAX_WAIT,
+                                send_batch.DOMAIN_BACKOFF_SECONDS)
+    load_spooled(Session)
+    sender = AsyncSender(engine, Session, f"{worker_identity()}-a", bucket, controller, sessions,
+                         batch_size, max_bytes, scheduler=scheduler, journal_dir=send_batch.JOURNAL_DIR)
+    if daemon:
+        logger.info(f"Starting asyncio sender with {sessions} sessions: {controller.rate:g}/min, burst {burst}, idle timeout {idle_timeout}s.")
+    try:
+        return asyncio.run(sender.run(idle_timeout if daemon else 0, poll_interval, throttle_pause))
+    finally:
+        send_batch.metrics.REGISTRY.emit()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send queued emails over many concurrent SMTP sessions.")
+    parser.add_argument('--daemon', action='store_true', help="Keep running and drain the queue at a paced rate")
+    parser.add_argument('--sessions', type=int, default=SESSIONS, help="Concurrent SMTP sessions")
+    parser.add_argument('--max-bytes', type=int, default=MAX_BYTES, help="Bytes of message bodies held in flight at once")
+    parser.add_argument('--rate', type=float, default=send_batch.DEFAULT_RATE_PER_MINUTE, help="Send rate in messages per minute")
+    parser.add_argument('--burst', type=int, default=send_batch.DEFAULT_BURST, help="Token bucket burst size")
+    parser.add_argument('--idle-timeout', type=float, default=send_batch.DEFAULT_IDLE_TIMEOUT, help="Exit after the queue has been empty this many seconds")
+    parser.add_argument('--poll-interval', type=float, default=send_batch.DEFAULT_POLL_INTERVAL, help="Seconds between polls of an empty queue")
+    args = parser.parse_args()
+
+    try:
+        run(args.sessions, args.daemon, args.rate, args.burst, args.idle_timeout, args.poll_interval,
+            max_bytes=args.max_bytes)
+    except Exception as e:
+        logger.critical(f"Critical error in batch processing: {e}")
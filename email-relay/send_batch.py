@@ -1,8 +1,26 @@
 import os
+import time
+import errno
+import fcntl
+import random
+import socket
 import smtplib
 import logging
-from sqlalchemy import select, update, func, case
+import argparse
+import datetime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, update, func, case, and_, or_, bindparam, Integer
 import database
+import flush_spool
+import bodystore
+import priority
+import digest
+import wakeup
+import metrics
+import profiling
+from envelope import parse_recipients, recipient_domain
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -10,97 +28,1448 @@ logger = logging.getLogger(__name__)
 
 BATCH_SIZE = 10
 MAX_ATTEMPTS = 3
+# A claim also stops once its messages add up to this many bytes (from
+# email_queue.message_size), so a batch of large attachments can't fill the
+# container's memory; a single larger message is still claimed, alone.
+BATCH_BYTES = int(os.environ.get('SEND_BATCH_BYTES', 24 * 1024 * 1024))
 
-def send_batch():
-    engine = database.get_engine()
-    Session = database.get_session(engine)
-    session = Session()
+# Daemon mode pacing. Defaults can be overridden through the environment
+# (so Cloud Run Job definitions don't need new args) or via CLI flags.
+DEFAULT_RATE_PER_MINUTE = float(os.environ.get('SEND_RATE_PER_MINUTE', 20))
+DEFAULT_BURST = int(os.environ.get('SEND_BURST', 10))
+DEFAULT_IDLE_TIMEOUT = float(os.environ.get('SEND_IDLE_TIMEOUT', 300))
+DEFAULT_POLL_INTERVAL = float(os.environ.get('SEND_POLL_INTERVAL', 5))
+
+# Give up if the SMTP server keeps dropping us without any progress in between
+MAX_RECONNECTS = 5
+
+# Adaptive (AIMD) rate control. On a throttle reply (421 or 4.7.x) the rate is multiplied
+# by THROTTLE_DECREASE_FACTOR and sending pauses for THROTTLE_PAUSE seconds;
+# every THROTTLE_SUCCESS_WINDOW consecutive successes add THROTTLE_INCREASE_STEP.
+MIN_RATE_PER_MINUTE = float(os.environ.get('SEND_MIN_RATE_PER_MINUTE', 1))
+MAX_RATE_PER_MINUTE = float(os.environ.get('SEND_MAX_RATE_PER_MINUTE', 60))
+THROTTLE_DECREASE_FACTOR = 0.5
+THROTTLE_INCREASE_STEP = 1.0
+THROTTLE_SUCCESS_WINDOW = 20
+THROTTLE_PAUSE = float(os.environ.get('SEND_THROTTLE_PAUSE', 60))
+# A throttled row is due again after THROTTLE_PAUSE. After MAX_DEFERRALS
+# throttle deferrals in a row, the next one counts as a failed attempt, so a
+# message the server keeps putting off still backs off and eventually fails.
+MAX_DEFERRALS = int(os.environ.get('SEND_MAX_DEFERRALS', 5))
+
+# relay_state key holding the last safe rate
+RATE_STATE_KEY = 'send_rate_per_minute'
+
+# Worker pool. Each worker owns one SMTP connection and claims rows through a
+# short lease so no database transaction stays open across network I/O. The
+# lease is extended by the time a full batch takes at the current rate.
+DEFAULT_WORKERS = int(os.environ.get('SEND_WORKERS', 1))
+LEASE_SECONDS = int(os.environ.get('SEND_LEASE_SECONDS', 300))
+
+# Retry scheduling: a failed row becomes eligible again after
+# RETRY_BASE_SECONDS * 2^(attempt - 1), capped at RETRY_MAX_SECONDS and
+# jittered by +/-50% so failures from one burst don't retry in lockstep.
+RETRY_BASE_SECONDS = float(os.environ.get('SEND_RETRY_BASE_SECONDS', 300))
+RETRY_MAX_SECONDS = float(os.environ.get('SEND_RETRY_MAX_SECONDS', 6 * 3600))
+
+# Batched status write-back. Outcomes are flushed every FLUSH_SIZE messages or
+# FLUSH_SECONDS, whichever comes first. When SEND_JOURNAL_DIR is set, each
+# successful send is fsync'd to a per-worker journal file before it is
+# buffered so a crash between send and flush never leads to a second send;
+# point it at persistent storage (e.g. the GCS FUSE private bucket). A worker
+# holds an flock on its journal and touches it every JOURNAL_HEARTBEAT
+# seconds, so other workers can tell a live journal from an abandoned one.
+FLUSH_SIZE = int(os.environ.get('SEND_FLUSH_SIZE', 50))
+FLUSH_SECONDS = float(os.environ.get('SEND_FLUSH_SECONDS', 10))
+JOURNAL_DIR = os.environ.get('SEND_JOURNAL_DIR')
+JOURNAL_SCAN_INTERVAL = 60
+JOURNAL_HEARTBEAT = max(1.0, FLUSH_SECONDS / 2)
+
+# Bodies larger than this (uncompressed) are decompressed and written to the
+# SMTP DATA stream piece by piece instead of being built in memory for
+# sendmail()
+STREAM_THRESHOLD = int(os.environ.get('SEND_STREAM_THRESHOLD', 1024 * 1024))
+# Such bodies are also read from email_body in pieces of this many
+# (compressed) bytes as they are sent, rather than fetched whole
+BLOB_READ_SIZE = 1024 * 1024
+
+# Per recipient domain limits, shared by all workers (see DomainScheduler);
+# 0 disables a limit, so by default only the global rate applies. A domain
+# that won't be ready within DOMAIN_MAX_WAIT seconds has its rows postponed
+# instead of holding up the rest of the batch.
+DOMAIN_RATE_PER_MINUTE = float(os.environ.get('SEND_DOMAIN_RATE_PER_MINUTE', 0))
+DOMAIN_BURST = int(os.environ.get('SEND_DOMAIN_BURST', 5))
+DOMAIN_CONCURRENCY = int(os.environ.get('SEND_DOMAIN_CONCURRENCY', 2))
+DOMAIN_MAX_WAIT = float(os.environ.get('SEND_DOMAIN_MAX_WAIT', 10))
+# How long to leave a domain alone after it defers every recipient (greylisting)
+DOMAIN_BACKOFF_SECONDS = float(os.environ.get('SEND_DOMAIN_BACKOFF_SECONDS', 300))
+# Most recipients in one SMTP transaction, kept under the relay's
+# per-message limit. Larger envelopes are split into chunks; rows with the
+# same sender and body to the same domain are merged up to it (1 sends to
+# each recipient separately).
+MAX_RECIPIENTS = int(os.environ.get('SEND_MAX_RECIPIENTS', 50))
+
+
+# Structured metrics (see metrics.py); queue depth and age come from queue_stats.py
+SENT = metrics.counter('messages_sent', "Messages accepted by the SMTP relay")
+FAILED = metrics.counter('messages_failed', "Messages given up on after their last attempt")
+RETRIED = metrics.counter('messages_retried', "Failed attempts that will be retried")
+THROTTLED = metrics.counter('messages_throttled', "Messages deferred by a throttle reply")
+POSTPONED = metrics.counter('messages_postponed', "Messages held back by the domain scheduler")
+SMTP_CONNECT_SECONDS = metrics.histogram('smtp_connect_seconds', "Time to open an SMTP connection")
+SMTP_AUTH_SECONDS = metrics.histogram('smtp_auth_seconds', "Time for STARTTLS and login")
+SMTP_SEND_SECONDS = metrics.histogram('smtp_send_seconds', "Time for one SMTP transaction")
+CLAIM_SECONDS = metrics.histogram('db_claim_seconds', "Time to claim a batch from email_queue")
+SEND_RATE = metrics.gauge('send_rate_per_minute', "Current adaptive send rate")
+
+
+class Throttled(Exception):
+    # Raised by deliver() after a message was deferred because of a rate-limit reply
+    pass
+
+
+class DomainDeferred(Exception):
+    # Raised by deliver() when the recipient domain deferred every recipient
+    pass
+
+
+class TokenBucket:
+    # Tokens accrue continuously at rate_per_minute up to `burst`;
+    # acquire() blocks until one is available and consumes it.
+    def __init__(self, rate_per_minute, burst, clock=time.monotonic, sleep=time.sleep):
+        if rate_per_minute <= 0:
+            raise ValueError("rate_per_minute must be positive")
+        self.rate_per_minute = rate_per_minute
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._last
+        self._last = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate_per_minute / 60.0)
+
+    def set_rate(self, rate_per_minute):
+        with self._lock:
+            # Settle tokens earned at the old rate before switching
+            self._refill()
+            self.rate_per_minute = rate_per_minute
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            self._sleep(wait)
+
+    def try_acquire(self):
+        # Non-blocking: 0 when a token was taken, otherwise the seconds
+        # until one will be available
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) * 60.0 / self.rate_per_minute
+
+
+class ThrottleController:
+    # Additive-increase / multiplicative-decrease control of the send rate.
+    # Keeps an optional TokenBucket in sync with the current rate; `share` is
+    # the fraction of the rate this process may use when several Cloud Run
+    # tasks send in parallel.
+    def __init__(self, rate_per_minute, bucket=None,
+                 min_rate=MIN_RATE_PER_MINUTE, max_rate=MAX_RATE_PER_MINUTE,
+                 decrease_factor=THROTTLE_DECREASE_FACTOR, increase_step=THROTTLE_INCREASE_STEP,
+                 success_window=THROTTLE_SUCCESS_WINDOW, share=1.0):
+        self.share = share
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step
+        self.success_window = success_window
+        self.bucket = bucket
+        self.successes = 0
+        self.rate = None
+        self._lock = threading.Lock()
+        self._set_rate(rate_per_minute)
+
+    def _set_rate(self, rate):
+        rate = min(self.max_rate, max(self.min_rate, rate))
+        changed = rate != self.rate
+        self.rate = rate
+        if changed:
+            SEND_RATE.set(rate)
+        if self.bucket is not None:
+            self.bucket.set_rate(rate * self.share)
+        return changed
+
+    def on_success(self):
+        # Returns True when the rate changed
+        with self._lock:
+            self.successes += 1
+            if self.successes < self.success_window:
+                return False
+            self.successes = 0
+            return self._set_rate(self.rate + self.increase_step)
+
+    def on_throttle(self):
+        with self._lock:
+            self.successes = 0
+            return self._set_rate(self.rate * self.decrease_factor)
+
+
+class Delivery:
+    # One SMTP transaction: a row, plus any later rows merged into it
+    def __init__(self, domain, email_row, to_addrs):
+        self.domain = domain
+        self.sender = email_row.sender
+        self.rows = []
+        self.to_addrs = []
+        self.recipients = {}
+        self.add(email_row, to_addrs)
+
+    def add(self, email_row, to_addrs):
+        self.rows.append(email_row)
+        self.to_addrs.extend(to_addrs)
+        self.recipients[email_row.id] = to_addrs
+
+
+class RecipientLedger:
+    # Outcomes for the rows of one claimed batch, collected across the
+    # deliveries that carry their recipients; a large envelope is split over
+    # several. A row is settled once all of them are over. If only some of
+    # its recipients got through, each recipient's status is recorded (see
+    # database.email_recipient) so the retry goes only to those still
+    # pending: 4xx refusals and chunks that didn't go out. Recipients refused
+    # with a 5xx are not retried.
+    def __init__(self, outcomes, emails):
+        self.outcomes = outcomes
+        self.rows = {row.id: row for row in emails}
+        # Rows not settled yet; released for other workers on bail-out
+        self.unresolved = set(self.rows)
+        self._open = {}
+        self._addrs = {}
+        self._accepted = {}
+        self._refused = {}
+        self._event = {}
+
+    def expect(self, delivery):
+        for email_row in delivery.rows:
+            self._open[email_row.id] = self._open.get(email_row.id, 0) + 1
+            self._addrs.setdefault(email_row.id, []).extend(delivery.recipients[email_row.id])
+
+    def settle_unplanned(self):
+        # Rows left without a delivery: an earlier attempt settled every
+        # recipient. Returns the number settled as sent.
+        return sum(self._settle(email_id) for email_id in list(self.unresolved) if email_id not in self._open)
+
+    def sent(self, delivery, refused):
+        # The transaction went through; refused is sendmail()'s
+        # {addr: (code, resp)}. Returns the number of rows settled as sent.
+        settled = 0
+        for email_row in delivery.rows:
+            for addr in delivery.recipients[email_row.id]:
+                if addr in refused:
+                    self._refused.setdefault(email_row.id, {})[addr] = refused[addr]
+                else:
+                    self._accepted.setdefault(email_row.id, set()).add(addr)
+            settled += self._done(email_row.id)
+        return settled
+
+    def failed(self, delivery, error):
+        # Counts against the rows' attempts
+        self._record(delivery, ('failed', error))
+
+    def deferred(self, delivery, error):
+        # Throttled: no attempt used, unless the row was already deferred
+        # MAX_DEFERRALS times in a row
+        self._record(delivery, ('deferred', error))
+
+    def postponed(self, delivery, error, next_attempt_at):
+        # Held back by the domain scheduler: no attempt used, retried later
+        self._record(delivery, ('postponed', error, next_attempt_at))
+
+    def lost(self, delivery, error):
+        # Can never be sent, e.g. its stored body is missing
+        self._record(delivery, ('lost', error))
+
+    def abandon(self):
+        # Bailing out mid-batch: settle rows that already have an outcome for
+        # some of their recipients. The rest stay unresolved.
+        for email_id in list(self.unresolved):
+            if self._open.get(email_id) and (email_id in self._accepted or email_id in self._refused
+                                             or email_id in self._event):
+                self._settle(email_id, "Delivery interrupted")
+
+    def _record(self, delivery, event):
+        for email_row in delivery.rows:
+            # A failure outweighs a deferral of another chunk
+            if email_row.id not in self._event or event[0] in ('failed', 'lost'):
+                self._event[email_row.id] = event
+            self._done(email_row.id)
+
+    def _done(self, email_id):
+        self._open[email_id] -= 1
+        return 0 if self._open[email_id] else self._settle(email_id)
+
+    def _settle(self, email_id, interrupted=None):
+        # Returns 1 if the row was settled as sent
+        self.unresolved.discard(email_id)
+        email_row = self.rows[email_id]
+        accepted = self._accepted.get(email_id, set())
+        refused = self._refused.get(email_id, {})
+        event = self._event.get(email_id)
+        if event is None and interrupted:
+            event = ('interrupted', interrupted)
+
+        if accepted:
+            statuses = {addr: ('sent', None) for addr in accepted}
+            for addr, (code, resp) in refused.items():
+                if isinstance(resp, bytes):
+                    resp = resp.decode('utf-8', 'replace')
+                statuses[addr] = ('failed' if code >= 500 else 'pending', f"{code} {resp}")
+            for addr in self._addrs[email_id]:
+                if addr not in statuses:
+                    statuses[addr] = ('pending', event[1] if event else None)
+            if len(statuses) > len(accepted) or getattr(email_row, 'retried', False):
+                self.outcomes.recipients(email_id, statuses)
+            if all(status != 'pending' for status, _ in statuses.values()):
+                self.outcomes.sent(email_id)
+                return 1
+        elif not refused and event is None:
+            # Nothing was left to send
+            self.outcomes.sent(email_id)
+            return 1
+
+        if event is None:
+            record_failure(self.outcomes, email_row, f"Recipients refused: {refused}"[:65000])
+        elif event[0] == 'failed':
+            record_failure(self.outcomes, email_row, event[1])
+        elif event[0] == 'deferred':
+            deferrals = (getattr(email_row, 'deferral_count', 0) or 0) + 1
+            if deferrals > MAX_DEFERRALS:
+                record_failure(self.outcomes, email_row, f"Deferred {deferrals} times in a row: {event[1]}"[:65000])
+            else:
+                self.outcomes.deferred(email_id, event[1], utcnow() + datetime.timedelta(seconds=THROTTLE_PAUSE))
+        elif event[0] == 'interrupted':
+            self.outcomes.deferred(email_id, event[1], throttled=False)
+        elif event[0] == 'postponed':
+            self.outcomes.postponed(email_id, event[1], event[2])
+        else:
+            self.outcomes.failed(email_id, 'failed', event[1], None)
+        return 0
+
+
+class DomainScheduler:
+    # Spreads deliveries across recipient domains so one big mailing to a
+    # single university can't trip its greylisting or rate limits and hold up
+    # everyone else's mail. Tracks a token bucket, in-flight transactions and
+    # a backoff deadline per domain; one instance is shared by all workers.
+    CONCURRENCY_POLL = 0.05
 
-    # Get SMTP credentials
+    def __init__(self, rate_per_minute=DOMAIN_RATE_PER_MINUTE, burst=DOMAIN_BURST,
+                 concurrency=DOMAIN_CONCURRENCY, max_wait=DOMAIN_MAX_WAIT,
+                 backoff_seconds=DOMAIN_BACKOFF_SECONDS, clock=time.monotonic, sleep=time.sleep):
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.concurrency = concurrency
+        self.max_wait = max_wait
+        self.backoff_seconds = backoff_seconds
+        self._clock = clock
+        self._sleep = sleep
+        self._buckets = {}
+        self._in_flight = {}
+        self._paused_until = {}
+        self._lock = threading.Lock()
+
+    def try_start(self, domain):
+        # 0 when a transaction to `domain` may start now (call finish() once
+        # it is over), otherwise the seconds until it probably can
+        with self._lock:
+            wait = self._paused_until.get(domain, 0) - self._clock()
+            if wait > 0:
+                return wait
+            if self.concurrency and self._in_flight.get(domain, 0) >= self.concurrency:
+                return self.CONCURRENCY_POLL
+            if self.rate_per_minute:
+                if domain not in self._buckets:
+                    self._buckets[domain] = TokenBucket(self.rate_per_minute, self.burst, clock=self._clock)
+                wait = self._buckets[domain].try_acquire()
+                if wait:
+                    return wait
+            self._in_flight[domain] = self._in_flight.get(domain, 0) + 1
+            return 0
+
+    def finish(self, domain):
+        with self._lock:
+            self._in_flight[domain] -= 1
+
+    def back_off(self, domain):
+        # Returns the seconds the domain is paused for
+        with self._lock:
+            self._paused_until[domain] = self._clock() + self.backoff_seconds
+        return self.backoff_seconds
+
+    def is_paused(self, domain):
+        with self._lock:
+            return self._paused_until.get(domain, 0) > self._clock()
+
+    def schedule(self, queues, postpone):
+        # Round-robin over {domain: deque of Delivery}, one transaction per
+        # domain per turn. Yields deliveries that have been started; the
+        # caller must finish() them. A domain that is backing off, or won't
+        # be ready within max_wait seconds, has its remaining deliveries
+        # handed to postpone(delivery, seconds) instead.
+        queues = dict(queues)
+        while queues:
+            started = False
+            soonest = None
+            for domain in list(queues):
+                wait = self.try_start(domain)
+                if not wait:
+                    started = True
+                    delivery = queues[domain].popleft()
+                    if not queues[domain]:
+                        del queues[domain]
+                    yield delivery
+                elif wait > self.max_wait or self.is_paused(domain):
+                    for delivery in queues.pop(domain):
+                        postpone(delivery, wait)
+                else:
+                    soonest = wait if soonest is None else min(soonest, wait)
+            if queues and not started and soonest is not None:
+                self._sleep(soonest)
+
+
+def plan_deliveries(emails, max_recipients=MAX_RECIPIENTS, settled=None):
+    # Group claimed rows into {domain: deque of Delivery}, keeping claim order
+    # within each domain. A row whose recipients are all in one domain joins
+    # an earlier transaction with the same sender, stored body and domain, as
+    # long as it stays within max_recipients and repeats no recipient. A row
+    # with more recipients than that is split into chunks, sorted by domain.
+    # settled: {email id: addresses an earlier attempt already dealt with}
+    settled = settled or {}
+    queues = {}
+    mergeable = {}
+    for email_row in emails:
+        done = settled.get(email_row.id, ())
+        to_addrs = [addr for addr in parse_recipients(email_row.recipients) if addr not in done]
+        if done and not to_addrs:
+            continue
+        if len(to_addrs) > max_recipients:
+            to_addrs.sort(key=recipient_domain)
+            for start in range(0, len(to_addrs), max_recipients):
+                chunk = to_addrs[start:start + max_recipients]
+                domain = recipient_domain(chunk[0])
+                queues.setdefault(domain, deque()).append(Delivery(domain, email_row, chunk))
+            continue
+
+        recorded = getattr(email_row, 'recipient_domains', None)
+        if recorded is not None and not done:
+            # Recorded at enqueue (see envelope.py)
+            domains = set(recorded.split(','))
+        else:
+            domains = {recipient_domain(addr) for addr in to_addrs}
+        domain = recipient_domain(to_addrs[0]) if to_addrs else ''
+
+        key = None
+        if len(domains) == 1 and email_row.body_hash is not None:
+            key = (email_row.sender, email_row.body_hash, domain)
+        delivery = mergeable.get(key)
+        if (delivery is not None and len(delivery.to_addrs) + len(to_addrs) <= max_recipients
+                and not set(to_addrs) & set(delivery.to_addrs)):
+            delivery.add(email_row, to_addrs)
+            continue
+
+        delivery = Delivery(domain, email_row, to_addrs)
+        queues.setdefault(domain, deque()).append(delivery)
+        if key is not None:
+            mergeable[key] = delivery
+    return queues
+
+
+def is_domain_deferral(exc):
+    # Every recipient got a transient refusal other than 421 (which ends the
+    # whole session): greylisting or a limit at the receiving domain, so only
+    # that domain needs to back off.
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 and code != 421 for code in codes)
+    return False
+
+def is_rate_limit(code, resp):
+    # 421 (the server is closing the session) or a 4.7.x enhanced status,
+    # e.g. Gmail's "421 4.7.0 Try again later" or "450 4.7.28"
+    if code == 421:
+        return True
+    if isinstance(resp, bytes):
+        resp = resp.decode('utf-8', 'replace')
+    return 400 <= code < 500 and str(resp).lstrip().startswith('4.7.')
+
+def is_throttle(exc):
+    # A rate-limit reply: defer without burning the retry budget. Other 4xx
+    # replies (e.g. "451 4.3.0" on DATA) are about the message and are
+    # retried as failed attempts, with backoff.
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        replies = list(exc.recipients.values())
+        return bool(replies) and all(is_rate_limit(code, resp) for code, resp in replies)
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return is_rate_limit(exc.smtp_code, exc.smtp_error)
+    return False
+
+def load_rate(session, default):
+    row = session.execute(
+        select(database.relay_state.c.value).where(database.relay_state.c.name == RATE_STATE_KEY)
+    ).fetchone()
+    if row is None:
+        return default
+    try:
+        return float(row.value)
+    except ValueError:
+        logger.warning(f"Ignoring invalid stored send rate {row.value!r}")
+        return default
+
+def save_rate(session, rate):
+    result = session.execute(
+        update(database.relay_state)
+        .where(database.relay_state.c.name == RATE_STATE_KEY)
+        .values(value=str(rate), updated_at=func.now())
+    )
+    if result.rowcount == 0:
+        session.execute(database.relay_state.insert().values(name=RATE_STATE_KEY, value=str(rate)))
+
+def open_smtp():
     smtp_host = os.environ.get('SMTP_HOST', 'smtp-relay.gmail.com')
     smtp_port = int(os.environ.get('SMTP_PORT', 587))
+    with SMTP_CONNECT_SECONDS.time(), profiling.phase('smtp_connect'):
+        return smtplib.SMTP(smtp_host, smtp_port)
+
+def authenticate(server):
     smtp_user = os.environ.get('SMTP_USER')
     smtp_pass = os.environ.get('SMTP_PASSWORD')
 
+    with SMTP_AUTH_SECONDS.time(), profiling.phase('smtp_auth'):
+        server.starttls()
+        if smtp_user and smtp_pass:
+            server.login(smtp_user, smtp_pass)
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def retry_at(attempt_count, now=None):
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** max(0, attempt_count - 1))
+    delay *= random.uniform(0.5, 1.5)
+    return (now or utcnow()) + datetime.timedelta(seconds=delay)
+
+def worker_identity():
+    # Unique per process, including across parallel Cloud Run tasks
+    execution = os.environ.get('CLOUD_RUN_EXECUTION', socket.gethostname())
+    task = os.environ.get('CLOUD_RUN_TASK_INDEX', '0')
+    return f"{execution}-{task}-{os.getpid()}"[-56:]
+
+def weighted_pick(candidates, weights, limit):
+    # Interleave {lane: [ids]} by smooth weighted round-robin, so with all
+    # lanes busy each gets its weight's share of the `limit` picks, and the
+    # share of an empty lane goes to the others.
+    queues = {lane: deque(ids) for lane, ids in candidates.items() if ids}
+    credit = dict.fromkeys(queues, 0)
+    picked = []
+    while queues and len(picked) < limit:
+        total = sum(weights[lane] for lane in queues)
+        for lane in queues:
+            credit[lane] += weights[lane]
+        lane = max(queues, key=lambda l: (credit[l], -l))
+        credit[lane] -= total
+        picked.append(queues[lane].popleft())
+        if not queues[lane]:
+            del queues[lane]
+    return picked
+
+def within_budget(ids, sizes, max_bytes):
+    # The longest prefix of ids whose sizes fit in max_bytes, and at least
+    # the first id; rows of unknown size (queued before message_size
+    # existed) count as empty
+    total = 0
+    for n, email_id in enumerate(ids):
+        total += sizes.get(email_id) or 0
+        if n and total > max_bytes:
+            return ids[:n]
+    return ids
+
+def claim_batch(session, engine, worker_id, limit=BATCH_SIZE, lease_seconds=LEASE_SECONDS, weights=None,
+                max_bytes=BATCH_BYTES):
+    # Lease up to `limit` rows, and up to max_bytes of messages, to
+    # worker_id in one short transaction and return them. Rows whose lease
+    # expired (crashed worker) are claimable again.
+    q = database.email_queue
+    now = utcnow()
+    claimable = or_(q.c.lease_expires_at.is_(None), q.c.lease_expires_at < now)
+    if digest.WINDOW_SECONDS:
+        # Held for a digest: only digest.coalesce() may release or merge it,
+        # even once its hold has run out
+        claimable = and_(claimable, q.c.coalesce_until.is_(None))
+    weights = weights or priority.WEIGHTS
+
+    try:
+        # One range scan per lane on idx_status_priority_next (rows in backoff
+        # stay out of the way of fresh mail), then weighted fair picks
+        # across lanes. Candidates that aren't picked are unlocked at commit.
+        candidates = {}
+        sizes = {}
+        for lane in sorted(weights):
+            stmt = (
+                select(q.c.id, q.c.message_size)
+                .where(q.c.status == 'pending')
+                .where(q.c.priority == lane)
+                .where(q.c.next_attempt_at <= now)
+                .where(q.c.attempt_count < MAX_ATTEMPTS)
+                .where(claimable)
+                .order_by(q.c.next_attempt_at.asc(), q.c.id.asc())
+                .limit(limit)
+            )
+            # Add SKIP LOCKED only for MySQL to support concurrent workers safely.
+            # Check dialect name from engine.
+            if engine.dialect.name == 'mysql':
+                stmt = stmt.with_for_update(skip_locked=True)
+            rows = session.execute(stmt).fetchall()
+            candidates[lane] = [row.id for row in rows]
+            sizes.update((row.id, row.message_size) for row in rows)
+
+        ids = within_budget(weighted_pick(candidates, weights, limit), sizes, max_bytes)
+        if ids:
+            # Re-check claimability so that without SKIP LOCKED (SQLite) two
+            # workers racing for the same rows cannot both win them.
+            session.execute(
+                update(q)
+                .where(q.c.id.in_(ids))
+                .where(q.c.status == 'pending')
+                .where(claimable)
+                .values(claimed_by=worker_id, lease_expires_at=now + datetime.timedelta(seconds=lease_seconds))
+            )
+        session.commit()
+
+        if not ids:
+            return []
+
+        emails = session.execute(
+            # No blobs: bodies, including the inline body of legacy rows, are
+            # fetched one at a time through load_body()
+            # retried: an earlier attempt may have left per-recipient outcomes
+            select(q.c.id, q.c.body_hash, q.c.sender, q.c.recipients, q.c.attempt_count,
+                   q.c.message_size, q.c.recipient_domains, q.c.deferral_count,
+                   q.c.error_message.is_not(None).label('retried'))
+            .where(q.c.id.in_(ids))
+            .where(q.c.claimed_by == worker_id)
+            .order_by(q.c.priority.asc(), q.c.next_attempt_at.asc(), q.c.id.asc())
+        ).fetchall()
+        session.commit()
+        return emails
+    except Exception:
+        session.rollback()
+        raise
+
+def settled_recipients(session, emails):
+    # {email id: recipients already delivered or permanently refused} for
+    # claimed rows that an earlier attempt only partly delivered
+    ids = [row.id for row in emails if row.retried]
+    if not ids:
+        return {}
+    r = database.email_recipient
+    settled = {}
+    for email_id, address in session.execute(
+        select(r.c.email_id, r.c.address).where(r.c.email_id.in_(ids)).where(r.c.status != 'pending')
+    ):
+        settled.setdefault(email_id, set()).add(address)
+    session.commit()
+    return settled
+
+def release_claims(session, worker_id, ids):
+    # Hand unfinished rows back to the queue right away instead of waiting
+    # for their lease to expire
+    if not ids:
+        return
+    q = database.email_queue
     try:
-        # Construct Select Statement
-        stmt = (
-            select(database.email_queue.c.id, database.email_queue.c.body, database.email_queue.c.sender, database.email_queue.c.recipients, database.email_queue.c.attempt_count)
-            .where(database.email_queue.c.status == 'pending')
-            .where(database.email_queue.c.attempt_count < MAX_ATTEMPTS)
-            .order_by(database.email_queue.c.created_at.asc())
-            .limit(BATCH_SIZE)
+        session.execute(
+            update(q)
+            .where(q.c.id.in_(list(ids)))
+            .where(q.c.claimed_by == worker_id)
+            .values(claimed_by=None, lease_expires_at=None)
         )
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Failed to release claimed emails {sorted(ids)}: {e}")
 
-        # Add SKIP LOCKED only for MySQL to support concurrent workers safely.
-        # Check dialect name from engine.
-        if engine.dialect.name == 'mysql':
-            stmt = stmt.with_for_update(skip_locked=True)
+class OutcomeBuffer:
+    # Per-message results waiting to be written back. write() issues one
+    # UPDATE ... WHERE id IN (...) for all successes, a single executemany
+    # for failures and throttle deferrals, and one upsert of per-recipient
+    # outcomes of partly delivered messages.
+    def __init__(self, journal_path=None, max_size=FLUSH_SIZE, max_age=FLUSH_SECONDS, clock=time.monotonic):
+        self.journal_path = journal_path
+        self.max_size = max_size
+        self.max_age = max_age
+        self._clock = clock
+        self._journal = None
+        self._heartbeat = None
+        self.sent_ids = []
+        self.failures = []
+        self.recipient_rows = []
+        self._first_at = None
 
-        result = session.execute(stmt)
-        emails = result.fetchall()
+    def __len__(self):
+        return len(self.sent_ids) + len(self.failures)
 
-        if not emails:
-            logger.info("No pending emails to process.")
-            session.commit()
-            return
+    def _track(self):
+        if self._first_at is None:
+            self._first_at = self._clock()
+
+    def _open_journal(self):
+        self._journal = open(self.journal_path, 'a')
+        try:
+            fcntl.flock(self._journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._journal.close()
+            self._journal = None
+            raise RuntimeError(f"Journal {self.journal_path} is in use by another worker")
+        except OSError as e:
+            # No flock on this filesystem; the heartbeat alone marks it live
+            if e.errno not in (errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOLCK):
+                raise
+        stop = threading.Event()
+        thread = threading.Thread(target=self._beat, args=(stop,), name='journal-heartbeat', daemon=True)
+        thread.start()
+        self._heartbeat = (stop, thread)
+
+    def _beat(self, stop):
+        # Keep the journal's mtime fresh while the worker is alive, however
+        # long it waits for a send token or an SMTP reply
+        while not stop.wait(JOURNAL_HEARTBEAT):
+            try:
+                os.utime(self.journal_path)
+            except FileNotFoundError:
+                return
+
+    def sent(self, email_id):
+        if self.journal_path:
+            if self._journal is None:
+                self._open_journal()
+            self._journal.write(f"{email_id}\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        self._track()
+        self.sent_ids.append(email_id)
+        SENT.inc()
+
+    # b_deferral: 1 counts a throttle deferral, 0 resets the count after a
+    # real attempt, None leaves it alone
+    def failed(self, email_id, status, error, next_attempt_at):
+        (FAILED if status == 'failed' else RETRIED).inc()
+        self._track()
+        self.failures.append({'b_id': email_id, 'b_status': status, 'b_error': error, 'b_increment': 1,
+                              'b_next': next_attempt_at, 'b_deferral': 0})
+
+    def deferred(self, email_id, error, next_attempt_at=None, throttled=True):
+        # Back to the queue without consuming an attempt. throttled=False is
+        # a delivery cut short by another message's failure: not counted,
+        # and it keeps its place.
+        if throttled:
+            THROTTLED.inc()
+        self._track()
+        self.failures.append({'b_id': email_id, 'b_status': 'pending', 'b_error': error, 'b_increment': 0,
+                              'b_next': next_attempt_at, 'b_deferral': 1 if throttled else None})
+
+    def postponed(self, email_id, error, next_attempt_at):
+        # Held back by the domain scheduler: no attempt used, retried later
+        POSTPONED.inc()
+        self._track()
+        self.failures.append({'b_id': email_id, 'b_status': 'pending', 'b_error': error, 'b_increment': 0,
+                              'b_next': next_attempt_at, 'b_deferral': None})
 
-        logger.info(f"Processing batch of {len(emails)} emails.")
+    def recipients(self, email_id, statuses):
+        # statuses: {address: (status, error)}
+        self._track()
+        self.recipient_rows.extend(
+            {'email_id': email_id, 'address': address[:255], 'status': status,
+             'error_message': error[:65000] if error else None}
+            for address, (status, error) in statuses.items()
+        )
+
+    def due(self):
+        if not len(self):
+            return False
+        return len(self) >= self.max_size or self._clock() - self._first_at >= self.max_age
+
+    def due_in(self):
+        # Seconds until the buffered outcomes are due, or None if there are none
+        if not len(self):
+            return None
+        return max(0.0, self.max_age - (self._clock() - self._first_at))
+
+    def write(self, session):
+        q = database.email_queue
+        if self.sent_ids:
+            session.execute(
+                update(q)
+                .where(q.c.id.in_(self.sent_ids))
+                .values(status='sent', last_attempt_at=func.now(), claimed_by=None, lease_expires_at=None)
+            )
+        if self.failures:
+            session.execute(
+                update(q)
+                .where(q.c.id == bindparam('b_id'))
+                .values(
+                    attempt_count=q.c.attempt_count + bindparam('b_increment'),
+                    last_attempt_at=func.now(),
+                    error_message=bindparam('b_error'),
+                    status=bindparam('b_status'),
+                    next_attempt_at=func.coalesce(bindparam('b_next', type_=q.c.next_attempt_at.type), q.c.next_attempt_at),
+                    deferral_count=case(
+                        (bindparam('b_deferral', type_=Integer) == 1, func.coalesce(q.c.deferral_count, 0) + 1),
+                        (bindparam('b_deferral', type_=Integer) == 0, 0),
+                        else_=q.c.deferral_count,
+                    ),
+                    claimed_by=None,
+                    lease_expires_at=None
+                ),
+                self.failures
+            )
+        if self.recipient_rows:
+            session.execute(database.upsert(session.get_bind(), database.email_recipient, self.recipient_rows,
+                                            ['status', 'error_message', 'updated_at']))
+
+    def clear(self):
+        # Call once write() is committed
+        self.sent_ids = []
+        self.failures = []
+        self.recipient_rows = []
+        self._first_at = None
+        if self._journal is not None:
+            self._journal.truncate(0)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def close(self):
+        if self._heartbeat is not None:
+            stop, thread = self._heartbeat
+            stop.set()
+            thread.join()
+            self._heartbeat = None
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            if not len(self):
+                try:
+                    os.remove(self.journal_path)
+                except FileNotFoundError:
+                    pass
 
-        # Connect to SMTP server
+
+def recover_journals(session, journal_dir, stale_after=FLUSH_SECONDS * 3, own=None):
+    # Mark messages recorded in abandoned journals as sent. A journal is
+    # abandoned when no worker holds its flock (same host) and its heartbeat
+    # has stopped for a few flush windows (any host; GCS FUSE has no flock).
+    # own is the scanning worker's journal path, which is never touched, and
+    # empty journals are left alone: they have nothing to recover.
+    recovered = 0
+    now = time.time()
+    for name in sorted(os.listdir(journal_dir)):
+        if not name.endswith('.journal'):
+            continue
+        path = os.path.join(journal_dir, name)
+        if own and os.path.abspath(path) == os.path.abspath(own):
+            continue
         try:
-            with smtplib.SMTP(smtp_host, smtp_port) as server:
-                server.starttls()
-                if smtp_user and smtp_pass:
-                    server.login(smtp_user, smtp_pass)
-
-                for email_row in emails:
-                    try:
-                        # Send email
-                        to_addrs = [r.strip() for r in email_row.recipients.split(',') if r.strip()]
-
-                        server.sendmail(email_row.sender, to_addrs, email_row.body)
-
-                        # Mark as sent
-                        upd = (
-                            update(database.email_queue)
-                            .where(database.email_queue.c.id == email_row.id)
-                            .values(status='sent', last_attempt_at=func.now())
-                        )
-                        session.execute(upd)
-                        logger.info(f"Sent email ID {email_row.id}")
-
-                    except Exception as e:
-                        logger.error(f"Failed to send email ID {email_row.id}: {e}")
-                        # Mark attempt and failure
-                        error_msg = str(e)[:65000]
-
-                        # Calculate status: if attempt_count + 1 >= MAX_ATTEMPTS -> 'failed' else 'pending'
-                        new_attempt_count = email_row.attempt_count + 1
-                        new_status = 'failed' if new_attempt_count >= MAX_ATTEMPTS else 'pending'
-
-                        upd = (
-                            update(database.email_queue)
-                            .where(database.email_queue.c.id == email_row.id)
-                            .values(
-                                attempt_count=database.email_queue.c.attempt_count + 1,
-                                last_attempt_at=func.now(),
-                                error_message=error_msg,
-                                status=new_status
-                            )
-                        )
-                        session.execute(upd)
-        except Exception as e:
-             logger.error(f"Failed to connect to SMTP server: {e}")
-             raise e
+            f = open(path, 'r+')
+        except FileNotFoundError:
+            continue
+        with f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOLCK):
+                    raise
+            if now - os.fstat(f.fileno()).st_mtime < stale_after:
+                continue
+            ids = [int(line) for line in f if line.strip().isdigit()]
+            if not ids:
+                continue
+
+            q = database.email_queue
+            result = session.execute(
+                update(q)
+                .where(q.c.id.in_(ids))
+                .where(q.c.status == 'pending')
+                .values(status='sent', last_attempt_at=func.now(), claimed_by=None, lease_expires_at=None)
+            )
+            session.commit()
+            recovered += result.rowcount
+            logger.warning(f"Recovered {len(ids)} sent email IDs from abandoned journal {name}.")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return recovered
 
+class BlobChunks:
+    # The compressed data of a stored body, read from email_body in
+    # BLOB_READ_SIZE pieces each time it is iterated, so a large attachment
+    # is never held in memory whole
+    def __init__(self, session, body_hash, length, read_size):
+        self.session = session
+        self.body_hash = body_hash
+        self.length = length
+        self.read_size = read_size
+
+    def __iter__(self):
+        b = database.email_body
+        for start in range(0, self.length, self.read_size):
+            piece = self.session.execute(
+                select(func.substr(b.c.data, start + 1, self.read_size)).where(b.c.hash == self.body_hash)
+            ).scalar()
+            self.session.commit()
+            if not piece:
+                raise ValueError(f"Body {self.body_hash} changed while it was being sent")
+            yield bytes(piece)
+
+def load_body(session, email_row, stream_above=None):
+    # The row's message as an EncodedBody (codec None for the inline body of
+    # a legacy row), or None if its stored body is missing. A stored body
+    # larger than stream_above comes with BlobChunks in place of its data.
+    if email_row.body_hash is None:
+        q = database.email_queue
+        data = session.execute(select(q.c.body).where(q.c.id == email_row.id)).scalar()
         session.commit()
+        return bodystore.EncodedBody(None, None, len(data), data) if data is not None else None
+
+    b = database.email_body
+    data = b.c.data if stream_above is None else case((b.c.size <= stream_above, b.c.data))
+    found = session.execute(
+        select(b.c.codec, b.c.size, func.length(b.c.data).label('length'), data.label('data'))
+        .where(b.c.hash == email_row.body_hash)
+    ).first()
+    session.commit()
+    if found is None:
+        return None
+    if found.data is None:
+        return bodystore.EncodedBody(email_row.body_hash, found.codec, found.size,
+                                     BlobChunks(session, email_row.body_hash, found.length, BLOB_READ_SIZE))
+    return bodystore.EncodedBody(email_row.body_hash, found.codec, found.size, found.data)
+
+
+class BodyCache:
+    # Message bodies for one claimed batch. Each stored body is fetched (still
+    # compressed) the first time a row needs it, so a batch of the same
+    # notification to many people reads it once. Bodies over
+    # STREAM_THRESHOLD are only read piece by piece while they are sent.
+    def __init__(self, Session):
+        self.Session = Session
+        self._session = None
+        self._bodies = {}
+
+    def get(self, email_row):
+        # An EncodedBody, or None if the body is missing
+        if self._session is None:
+            self._session = self.Session()
+        if email_row.body_hash is None:
+            return load_body(self._session, email_row)
+        if email_row.body_hash not in self._bodies:
+            self._bodies[email_row.body_hash] = load_body(self._session, email_row, STREAM_THRESHOLD)
+        return self._bodies[email_row.body_hash]
+
+    def close(self):
+        self._bodies = {}
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+def smtp_data(chunks, buffer_size=bodystore.CHUNK_SIZE):
+    # What smtplib does to a whole message before DATA (CRLF line endings,
+    # leading dots doubled), applied to a stream of chunks. Output is
+    # regrouped into pieces of about buffer_size bytes.
+    out, out_size = [], 0
+    partial = b''
+    for chunk in chunks:
+        lines = (partial + chunk).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if line.startswith(b'.'):
+                line = b'.' + line
+            out.append(line + b'\r\n')
+            out_size += len(line) + 2
+        if out_size >= buffer_size:
+            yield b''.join(out)
+            out, out_size = [], 0
+    if partial:
+        if partial.endswith(b'\r'):
+            partial = partial[:-1]
+        if partial.startswith(b'.'):
+            partial = b'.' + partial
+        out.append(partial + b'\r\n')
+    out.append(b'.\r\n')
+    yield b''.join(out)
+
+def reset(server):
+    # RSET after a refusal; like smtplib, ignore a connection that is already gone
+    try:
+        server.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+def sendmail_streaming(server, from_addr, to_addrs, size, chunks):
+    # smtplib.SMTP.sendmail() for a message given as chunks: same envelope
+    # handling and exceptions, but the DATA payload is never held in full.
+    server.ehlo_or_helo_if_needed()
+    esmtp_opts = []
+    if server.does_esmtp and server.has_extn('size'):
+        esmtp_opts.append(f"size={size}")
+
+    code, resp = server.mail(from_addr, esmtp_opts)
+    if code != 250:
+        if code == 421:
+            server.close()
+        else:
+            reset(server)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    refused = {}
+    for addr in to_addrs:
+        code, resp = server.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+        if code == 421:
+            server.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(to_addrs):
+        reset(server)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    server.putcmd('data')
+    code, resp = server.getreply()
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+    for piece in smtp_data(chunks):
+        server.send(piece)
+    code, resp = server.getreply()
+    if code != 250:
+        if code == 421:
+            server.close()
+        else:
+            reset(server)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+def size_limit(extensions):
+    # Largest message the server accepts, from the SIZE keyword of its EHLO
+    # reply (RFC 1870); None if it states no limit
+    params = extensions.get('size') if isinstance(extensions, dict) else None
+    if not isinstance(params, str) or not params.strip().isdigit():
+        return None
+    return int(params) or None
+
+def too_large(delivery, ledger, body, limit):
+    # Fail a message the server has said it won't take, without sending it
+    if limit is None or body.size <= limit:
+        return False
+    ids = ', '.join(str(row.id) for row in delivery.rows)
+    logger.error(f"Email ID {ids} is {body.size} bytes, over the SMTP server's limit of {limit}; not sending it.")
+    ledger.lost(delivery, f"Message size {body.size} exceeds the SMTP server's limit of {limit} bytes")
+    return True
+
+def record_failure(outcomes, email_row, error_msg):
+    # Calculate status: if attempt_count + 1 >= MAX_ATTEMPTS -> 'failed' else 'pending'
+    new_attempt_count = email_row.attempt_count + 1
+    new_status = 'failed' if new_attempt_count >= MAX_ATTEMPTS else 'pending'
+    outcomes.failed(email_row.id, new_status, error_msg, retry_at(new_attempt_count))
+
+def deliver(server, delivery, ledger, body):
+    # Send one Delivery (see plan_deliveries) in a single SMTP transaction and
+    # record its outcome in the batch's RecipientLedger. Returns the number of
+    # rows this settled as sent.
+    # body: the rows' EncodedBody (see BodyCache)
+    ids = [row.id for row in delivery.rows]
+    server.ehlo_or_helo_if_needed()
+    if too_large(delivery, ledger, body, size_limit(server.esmtp_features)):
+        return 0
+    try:
+        # Send email
+        with SMTP_SEND_SECONDS.time(), profiling.phase('smtp_send'):
+            if body.codec is None:
+                refused = server.sendmail(delivery.sender, delivery.to_addrs, body.data)
+            elif body.size <= STREAM_THRESHOLD:
+                refused = server.sendmail(delivery.sender, delivery.to_addrs, bodystore.decode(body.codec, body.data))
+            else:
+                refused = sendmail_streaming(server, delivery.sender, delivery.to_addrs, body.size,
+                                             bodystore.iter_decode(body.codec, body.data))
+
+    except smtplib.SMTPServerDisconnected:
+        # The session is gone, not the message: leave the row untouched so
+        # it is picked up again once the caller has reconnected.
+        raise
 
     except Exception as e:
-        logger.critical(f"Critical error in batch processing: {e}")
+        if is_domain_deferral(e):
+            # The caller postpones the rows along with the rest of the domain
+            raise DomainDeferred(str(e)) from e
+
+        if is_throttle(e):
+            logger.warning(f"Throttled while sending email ID {', '.join(map(str, ids))}: {e}")
+            # Defer without touching attempt_count
+            ledger.deferred(delivery, str(e)[:65000])
+            raise Throttled(str(e)) from e
+
+        logger.error(f"Failed to send email ID {', '.join(map(str, ids))}: {e}")
+        # Mark attempt and failure
+        ledger.failed(delivery, str(e)[:65000])
+        return 0
+
+    logger.info(f"Sent email ID {', '.join(map(str, ids))}")
+    return ledger.sent(delivery, refused if isinstance(refused, dict) else {})
+
+def load_spooled(Session):
+    # In spool mode, pull messages written by enqueue.py into the queue so
+    # they can be claimed. Never lets a spool problem stop the sender.
+    if not flush_spool.SPOOL_DIR:
+        return 0
+    session = Session()
+    try:
+        with profiling.phase('spool_flush'):
+            return flush_spool.load_spool(session, flush_spool.SPOOL_DIR)
+    except Exception as e:
         session.rollback()
+        logger.error(f"Error loading spooled emails: {e}")
+        return 0
+    finally:
+        session.close()
+
+def init_rate_control(Session, rate_per_minute=DEFAULT_RATE_PER_MINUTE, burst=DEFAULT_BURST):
+    # Start from the last safe rate learned by a previous execution. With
+    # parallel Cloud Run tasks each task gets an equal share of it.
+    session = Session()
+    try:
+        start_rate = load_rate(session, rate_per_minute)
+        session.commit()
     finally:
         session.close()
 
+    share = 1.0 / max(1, int(os.environ.get('CLOUD_RUN_TASK_COUNT', 1)))
+    bucket = TokenBucket(start_rate * share, burst)
+    controller = ThrottleController(start_rate, bucket, share=share)
+    return bucket, controller
+
+
+class SenderWorker:
+    # Owns one SMTP connection and delivers leased batches over it.
+    def __init__(self, engine, Session, worker_id, bucket, controller, batch_size=BATCH_SIZE,
+                 journal_dir=JOURNAL_DIR, scheduler=None, wakeup_channel=None):
+        self.engine = engine
+        self.Session = Session
+        self.worker_id = worker_id
+        self.bucket = bucket
+        self.controller = controller
+        self.scheduler = scheduler or DomainScheduler()
+        # Cuts the wait on an empty queue short when enqueue.py signals new mail
+        self.wakeup = wakeup_channel or wakeup.channel()
+        self.batch_size = batch_size
+        self.journal_dir = journal_dir
+        self.journal_path = os.path.join(journal_dir, f"{worker_id}.journal") if journal_dir else None
+        self.outcomes = OutcomeBuffer(self.journal_path)
+        self.rate_dirty = False
+        self.delivered = 0
+        self._last_journal_scan = None
+
+    def claim(self):
+        # Lease long enough to get through the whole batch at the current rate
+        lease_seconds = LEASE_SECONDS + int(self.batch_size * 60 / self.bucket.rate_per_minute)
+        session = self.Session()
+        try:
+            # Settle abandoned journals well before their rows' leases can expire
+            if self.journal_dir and (self._last_journal_scan is None
+                                     or time.monotonic() - self._last_journal_scan >= JOURNAL_SCAN_INTERVAL):
+                self._last_journal_scan = time.monotonic()
+                recover_journals(session, self.journal_dir, own=self.journal_path)
+            if digest.WINDOW_SECONDS:
+                # Fold held notifications into digests before they can be claimed
+                try:
+                    with profiling.phase('digest'):
+                        digest.coalesce(session)
+                except Exception as e:
+                    session.rollback()
+                    logger.error(f"Error building digests: {e}")
+            with CLAIM_SECONDS.time(), profiling.phase('claim'):
+                return claim_batch(session, self.engine, self.worker_id, self.batch_size, lease_seconds)
+        finally:
+            session.close()
+
+    def release(self, ids):
+        session = self.Session()
+        try:
+            release_claims(session, self.worker_id, ids)
+        finally:
+            session.close()
+
+    def flush(self):
+        if not len(self.outcomes) and not self.rate_dirty:
+            return
+        session = self.Session()
+        try:
+            with profiling.phase('write_back'):
+                if self.rate_dirty:
+                    save_rate(session, self.controller.rate)
+                self.outcomes.write(session)
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self.outcomes.clear()
+        self.rate_dirty = False
+
+    def close(self):
+        self.flush()
+        self.outcomes.close()
+
+    def process(self, server, emails):
+        # Rows are delivered round-robin across recipient domains. Outcomes
+        # are buffered and flushed in bulk; whatever is left unresolved when
+        # we bail out is released for other workers.
+        ledger = RecipientLedger(self.outcomes, emails)
+        bodies = BodyCache(self.Session)
+
+        def postpone(delivery, seconds):
+            until = utcnow() + datetime.timedelta(seconds=seconds)
+            ledger.postponed(delivery, f"Recipient domain {delivery.domain} is busy", until)
+
+        try:
+            session = self.Session()
+            try:
+                settled = settled_recipients(session, emails)
+            finally:
+                session.close()
+            queues = plan_deliveries(emails, MAX_RECIPIENTS, settled)
+            for queue in queues.values():
+                for delivery in queue:
+                    ledger.expect(delivery)
+            self.delivered += ledger.settle_unplanned()
+
+            for delivery in self.scheduler.schedule(queues, postpone):
+                try:
+                    self._deliver(server, delivery, bodies, ledger, postpone)
+                finally:
+                    self.scheduler.finish(delivery.domain)
+                if self.outcomes.due():
+                    self.flush()
+        except BaseException:
+            ledger.abandon()
+            try:
+                self.flush()
+            finally:
+                self.release(ledger.unresolved)
+            raise
+        finally:
+            bodies.close()
+
+    def acquire_token(self):
+        # bucket.acquire(), but outcomes buffered before a long wait (the rate
+        # can drop to a message a minute) are still flushed on time
+        while True:
+            wait = self.bucket.try_acquire()
+            if not wait:
+                return
+            if self.outcomes.due():
+                self.flush()
+            due_in = self.outcomes.due_in()
+            time.sleep(wait if due_in is None else min(wait, max(due_in, 0.01)))
+
+    def _deliver(self, server, delivery, bodies, ledger, postpone):
+        ids = {row.id for row in delivery.rows}
+        with profiling.phase('body_load'):
+            body = bodies.get(delivery.rows[0])
+        if body is None:
+            logger.error(f"Body {delivery.rows[0].body_hash} of email ID {', '.join(map(str, sorted(ids)))} is missing.")
+            ledger.lost(delivery, "Message body missing")
+            return
+
+        self.acquire_token()
+        try:
+            sent = deliver(server, delivery, ledger, body)
+        except Throttled:
+            self.controller.on_throttle()
+            self.rate_dirty = True
+            logger.warning(f"Backing off to {self.controller.rate:g} emails/min.")
+            raise
+        except DomainDeferred as e:
+            seconds = self.scheduler.back_off(delivery.domain)
+            logger.warning(f"{delivery.domain} deferred email ID {', '.join(map(str, sorted(ids)))} ({e}); "
+                           f"leaving it alone for {seconds:g}s.")
+            postpone(delivery, seconds)
+            return
+
+        if sent:
+            self.delivered += sent
+            if self.controller.on_success():
+                self.rate_dirty = True
+                logger.info(f"Raising send rate to {self.controller.rate:g} emails/min.")
+
+    def run_once(self):
+        try:
+            emails = self.claim()
+
+            if not emails:
+                logger.info("No pending emails to process.")
+                return self.delivered
+
+            logger.info(f"[{self.worker_id}] Processing batch of {len(emails)} emails at {self.controller.rate:g} emails/min.")
+
+            # Connect to SMTP server
+            try:
+                with open_smtp() as server:
+                    authenticate(server)
+                    self.process(server, emails)
+            except Throttled:
+                # Rest of the batch stays pending for the next run
+                pass
+            except smtplib.SMTPServerDisconnected as e:
+                # Keep what was already delivered; the rest stays pending for the next run
+                logger.warning(f"SMTP server dropped the connection mid-batch: {e}")
+            except Exception as e:
+                logger.error(f"Failed to connect to SMTP server: {e}")
+                self.release({row.id for row in emails})
+                raise e
+            return self.delivered
+        finally:
+            self.close()
+
+    def run(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL,
+            throttle_pause=THROTTLE_PAUSE):
+        # Keep the SMTP session alive and drain the queue continuously until
+        # it has been idle for idle_timeout seconds.
+        try:
+            return self._run(idle_timeout, poll_interval, throttle_pause)
+        finally:
+            self.close()
+
+    def _run(self, idle_timeout, poll_interval, throttle_pause):
+        reconnects = 0
+        idle_since = time.monotonic()
+
+        while True:
+            delivered_before = self.delivered
+            try:
+                with open_smtp() as server:
+                    authenticate(server)
+
+                    while True:
+                        emails = self.claim()
+                        if not emails:
+                            # Don't sit on unrecorded outcomes while idle
+                            self.flush()
+                            if load_spooled(self.Session):
+                                continue
+                            if time.monotonic() - idle_since >= idle_timeout:
+                                logger.info(f"[{self.worker_id}] Queue idle for {idle_timeout}s; exiting after {self.delivered} emails.")
+                                return self.delivered
+                            self.wakeup.wait(poll_interval)
+                            continue
+
+                        self.process(server, emails)
+                        idle_since = time.monotonic()
+
+            except Throttled:
+                # Gmail usually closes the session after a 421, so pause and start a fresh one
+                logger.warning(f"[{self.worker_id}] Pausing {throttle_pause}s after throttle reply.")
+                time.sleep(throttle_pause)
+                idle_since = time.monotonic()
+
+            except smtplib.SMTPServerDisconnected as e:
+                if self.delivered > delivered_before:
+                    reconnects = 0
+                reconnects += 1
+                if reconnects > MAX_RECONNECTS:
+                    logger.critical(f"[{self.worker_id}] SMTP server dropped the connection {reconnects} times in a row; giving up.")
+                    raise
+                logger.warning(f"[{self.worker_id}] SMTP session dropped ({e}); reconnecting.")
+
+
+def run_pool(workers=DEFAULT_WORKERS, daemon=False, rate_per_minute=DEFAULT_RATE_PER_MINUTE,
+             burst=DEFAULT_BURST, idle_timeout=DEFAULT_IDLE_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL,
+             batch_size=BATCH_SIZE, throttle_pause=THROTTLE_PAUSE):
+    # Run `workers` SenderWorkers as threads sharing one rate limiter and
+    # domain scheduler. Each gets its own SMTP connection and (via
+    # scoped_session) its own DB session. Returns the total number of
+    # messages delivered.
+    engine = database.get_engine()
+    Session = database.get_session(engine)
+    bucket, controller = init_rate_control(Session, rate_per_minute, burst)
+    scheduler = DomainScheduler(DOMAIN_RATE_PER_MINUTE, DOMAIN_BURST, DOMAIN_CONCURRENCY,
+                                DOMAIN_MAX_WAIT, DOMAIN_BACKOFF_SECONDS)
+    wakeup_channel = wakeup.channel()
+    if daemon and hasattr(wakeup_channel, 'listen'):
+        # Bind before the workers start, so a taken port fails here, once
+        wakeup_channel.listen()
+    identity = worker_identity()
+    load_spooled(Session)
+
+    def work(n):
+        worker = SenderWorker(engine, Session, f"{identity}-{n}", bucket, controller, batch_size, JOURNAL_DIR,
+                              scheduler, wakeup_channel)
+        if daemon:
+            return worker.run(idle_timeout, poll_interval, throttle_pause)
+        return worker.run_once()
+
+    if daemon:
+        logger.info(f"Starting {workers} sender worker(s): {controller.rate:g}/min, burst {burst}, idle timeout {idle_timeout}s.")
+
+    try:
+        if workers <= 1:
+            return work(0)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sender') as pool:
+            return sum(pool.map(work, range(workers)))
+    finally:
+        metrics.REGISTRY.emit()
+
+def send_batch(workers=DEFAULT_WORKERS):
+    try:
+        run_pool(workers)
+    except Exception as e:
+        logger.critical(f"Critical error in batch processing: {e}")
+
+def run_daemon(rate_per_minute=DEFAULT_RATE_PER_MINUTE, burst=DEFAULT_BURST,
+               idle_timeout=DEFAULT_IDLE_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL,
+               batch_size=BATCH_SIZE, throttle_pause=THROTTLE_PAUSE, workers=DEFAULT_WORKERS):
+    # Keep the engine and authenticated SMTP sessions alive and drain the
+    # queue continuously, paced by a token bucket whose rate adapts to 4xx
+    # throttling. Returns the number of messages delivered once the queue has
+    # been idle for idle_timeout seconds.
+    return run_pool(workers, True, rate_per_minute, burst, idle_timeout, poll_interval,
+                    batch_size, throttle_pause)
+
 if __name__ == "__main__":
-    send_batch()
+    parser = argparse.ArgumentParser(description="Send queued emails from the email_queue table.")
+    parser.add_argument('--daemon', action='store_true', help="Keep running and drain the queue at a paced rate")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE_PER_MINUTE, help="Daemon send rate in messages per minute")
+    parser.add_argument('--burst', type=int, default=DEFAULT_BURST, help="Daemon token bucket burst size")
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT, help="Exit after the queue has been empty this many seconds")
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL, help="Seconds between polls of an empty queue")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="Number of concurrent SMTP connections")
+    parser.add_argument('--profile', nargs='?', const='phases', metavar='MODES',
+                        help="Profile this run: phases (default), cprofile, tracemalloc; see profiling.py")
+    args = parser.parse_args()
+    profiling.start('send_batch', args.profile)
+
+    if args.daemon:
+        run_daemon(args.rate, args.burst, args.idle_timeout, args.poll_interval, workers=args.workers)
+    else:
+        send_batch(args.workers)
@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import socket
+import datetime
+import priority
+
+# Maildir-style spool for the sendmail shim. A message is written to tmp/,
+# fsync'd and renamed into new/, so readers only ever see complete files. The
+# flusher (flush_spool.py) claims files by renaming them into cur/ before
+# loading them into email_queue, and deletes them once committed.
+#
+# Each file holds one JSON envelope line followed by the raw message.
+# This module is imported by enqueue.py, so keep it free of heavy imports.
+
+SUBDIRS = ('tmp', 'new', 'cur')
+
+_counter = 0
+
+def unique_name():
+    global _counter
+    _counter += 1
+    return f"{time.time_ns()}.{os.getpid()}_{_counter}.{socket.gethostname()}"
+
+def ensure_dirs(spool_dir):
+    for sub in SUBDIRS:
+        os.makedirs(os.path.join(spool_dir, sub), exist_ok=True)
+
+def open_spool_file(spool_dir):
+    # Fails with OSError when the spool is unavailable, before anything has
+    # been read from stdin, so the caller can still insert directly.
+    name = unique_name()
+    path = os.path.join(spool_dir, 'tmp', name)
+    return name, open(path, 'xb')
+
+def write_message(spool_dir, body, sender, recipients, lane=priority.NORMAL, message_id=None, hold=False,
+                  chunk_size=65536):
+    # body is a file-like object; it is copied in chunks, never held whole
+    name, f = open_spool_file(spool_dir)
+    tmp_path = f.name
+    try:
+        with f:
+            envelope = {
+                'sender': sender,
+                'recipients': recipients,
+                'priority': lane,
+                'message_id': message_id,
+                # Held for a digest (see digest.py)
+                'hold': hold,
+                'queued_at': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            f.write(json.dumps(envelope).encode('utf-8') + b'\n')
+            while True:
+                chunk = body.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, os.path.join(spool_dir, 'new', name))
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return name
+
+def read_message(path):
+    # Returns (envelope dict, raw message bytes)
+    with open(path, 'rb') as f:
+        envelope = json.loads(f.readline())
+        return envelope, f.read()
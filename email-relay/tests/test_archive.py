@@ -0,0 +1,114 @@
+import os
+import re
+import json
+import base64
+import datetime
+from sqlalchemy import select, event
+from database import email_queue, email_recipient
+import archive
+import bodystore
+from archive import Archive, archive_rows, search
+from prune_queue import prune_queue
+
+OLD = datetime.datetime.now() - datetime.timedelta(days=40)
+
+def queue(session, recipients, status='sent', created_at=OLD, message_id=None):
+    raw = b"Subject: Decision\r\n"
+    if message_id:
+        raw += f"Message-ID: {message_id}\r\n".encode()
+    raw += b"\r\nYour submission was accepted."
+    body = bodystore.encode(raw)
+    bodystore.store(session, body)
+    return session.execute(email_queue.insert().values(
+        sender='j@ex.com', recipients=recipients, body_hash=body.hash, status=status, created_at=created_at
+    )).inserted_primary_key[0]
+
+def test_prune_archives_rows_before_deleting_them(session, tmp_path):
+    partial = queue(session, 'a@uni.edu, b@uni.edu', message_id='<decision-1@journal>')
+    queue(session, 'c@uni.edu', status='failed')
+    queue(session, 'recent@uni.edu', created_at=datetime.datetime.now())
+    session.execute(email_recipient.insert().values(email_id=partial, address='b@uni.edu', status='failed',
+                                                    error_message='550 No such user'))
+    session.commit()
+
+    prune_queue(archive_dir=str(tmp_path))
+
+    assert [r.recipients for r in session.execute(select(email_queue)).fetchall()] == ['recent@uni.edu']
+    assert os.listdir(tmp_path) == [OLD.date().isoformat()]
+
+    found = list(search(str(tmp_path), recipient='B@uni.edu'))
+    assert len(found) == 1
+    record = found[0]
+    assert record['id'] == partial
+    assert record['recipients'] == ['a@uni.edu', 'b@uni.edu']
+    assert record['recipient_outcomes'] == [{'address': 'b@uni.edu', 'status': 'failed', 'error': '550 No such user'}]
+    assert record['subject'] == 'Decision'
+    assert 'body' not in record
+
+    assert [r['id'] for r in search(str(tmp_path), message_id='decision-1@journal')] == [partial]
+    assert [r['status'] for r in search(str(tmp_path), recipient='c@uni.edu')] == ['failed']
+    assert list(search(str(tmp_path), recipient='recent@uni.edu')) == []
+    assert list(search(str(tmp_path), recipient='a@uni.edu', since=datetime.date.today())) == []
+
+def test_search_reads_only_matching_members(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, 'MEMBER_BYTES', 1)
+    ids = [queue(session, f"r{i}@uni.edu") for i in range(5)]
+    session.commit()
+
+    archiver = Archive(str(tmp_path), bodies=True)
+    archive_rows(session, archiver, ids)
+    archiver.close()
+
+    [day] = os.listdir(tmp_path)
+    [index] = [n for n in os.listdir(tmp_path / day) if n.endswith('.idx')]
+    with open(tmp_path / day / index) as f:
+        entries = [json.loads(line) for line in f]
+    # One row per member here; ids in primary-key order
+    assert [(e['first_id'], e['rows']) for e in entries] == [(i, 1) for i in ids]
+
+    reads = []
+    read_member = archive._read_member
+    monkeypatch.setattr(archive, '_read_member', lambda *a: reads.append(a) or read_member(*a))
+    [record] = search(str(tmp_path), recipient='r3@uni.edu')
+    assert len(reads) == 1
+    assert base64.b64decode(record['body']).endswith(b"Your submission was accepted.")
+
+def test_search_matches_bare_address_of_display_name_recipient(session, tmp_path):
+    # OJS's -t mode: recipients taken from the To/Cc headers
+    email_id = queue(session, '"Doe, Jane" <Jane@Uni.edu>, Bob <bob@uni.edu>')
+    session.commit()
+
+    archiver = Archive(str(tmp_path))
+    archive_rows(session, archiver, [email_id])
+    archiver.close()
+
+    assert [r['id'] for r in search(str(tmp_path), recipient='jane@uni.edu')] == [email_id]
+    assert [r['id'] for r in search(str(tmp_path), recipient='Bob <bob@uni.edu>')] == [email_id]
+    assert list(search(str(tmp_path), recipient='doe@uni.edu')) == []
+
+def test_archive_pages_rows_and_reads_only_header_prefixes(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, 'FETCH_SIZE', 2)
+    ids = [queue(session, f"r{i}@uni.edu", message_id=f"<m{i}@journal>") for i in range(3)]
+    ids.append(session.execute(email_queue.insert().values(
+        sender='j@ex.com', recipients='legacy@uni.edu', body=b"Subject: Inline\r\n\r\nOld row", status='sent',
+        created_at=OLD
+    )).inserted_primary_key[0])
+    session.commit()
+
+    statements = []
+    record = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(session.get_bind(), 'before_cursor_execute', record)
+    try:
+        archiver = Archive(str(tmp_path))
+        assert archive_rows(session, archiver, ids) == 4
+        archiver.close()
+    finally:
+        event.remove(session.get_bind(), 'before_cursor_execute', record)
+
+    selects = [s for s in statements if 'FROM email_queue' in s]
+    assert len(selects) == 2
+    # Bodies are only read through a bounded SUBSTR for their headers
+    columns = [re.sub(r'(substr|length)\([^)]*\)', '', s.split('FROM')[0]) for s in selects]
+    assert not any(re.search(r'email_body\.data|email_queue\.body\b', c) for c in columns)
+    assert [r['subject'] for r in search(str(tmp_path), recipient='legacy@uni.edu')] == ['Inline']
+    assert [r['id'] for r in search(str(tmp_path), message_id='m2@journal')] == [ids[2]]
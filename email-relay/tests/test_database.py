@@ -0,0 +1,38 @@
+import datetime
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+import database
+import send_batch
+# conftest replaces get_engine/get_session with the test ones; keep the real engine
+from database import get_engine, metadata, email_queue
+
+def test_database_url_uses_cloud_sql_socket(monkeypatch):
+    monkeypatch.delenv('DB_DRIVER', raising=False)
+    monkeypatch.setenv('DB_HOST', '10.0.0.3')
+    monkeypatch.setattr(database, 'DB_SOCKET', '/cloudsql/proj:region:pkp-ojs')
+    url = database.database_url()
+    assert url.host is None and url.port is None
+    assert url.query == {'unix_socket': '/cloudsql/proj:region:pkp-ojs'}
+
+    monkeypatch.setattr(database, 'DB_SOCKET', None)
+    url = database.database_url()
+    assert (url.host, url.port, url.query) == ('10.0.0.3', 3306, {})
+
+def test_engine_is_shared_and_claims_are_compiled_once():
+    engine = get_engine('sqlite://')
+    assert get_engine('sqlite://') is engine
+    metadata.create_all(engine)
+    session = Session(engine)
+    for i in range(4):
+        session.execute(insert(email_queue).values(sender='j@ex.com', recipients=f"r{i}@uni.edu", body=b'x',
+                                                   next_attempt_at=datetime.datetime(2000, 1, 1)))
+    session.commit()
+
+    send_batch.claim_batch(session, engine, 'w1', limit=2)
+    before = database.stats()
+    assert len(send_batch.claim_batch(session, engine, 'w2', limit=2)) == 2
+    after = database.stats()
+    assert after['statements'] - before['statements'] == 5
+    assert after['compiled'] == before['compiled']
+    assert after['connections'] == before['connections']
+    session.close()
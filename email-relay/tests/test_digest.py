@@ -0,0 +1,109 @@
+import email
+import datetime
+from email import policy
+from unittest.mock import MagicMock, patch
+from sqlalchemy import select
+from database import email_queue
+import bodystore
+import priority
+import digest
+from digest import eligible, coalesce
+from enqueue import enqueue_email
+from send_batch import send_batch
+
+def queue_held(session, recipients, subject, held_until):
+    raw = f"From: Journal <j@ex.com>\r\nTo: {recipients}\r\nSubject: {subject}\r\n\r\nDetails of {subject}.\r\n"
+    body = bodystore.encode(raw.encode())
+    bodystore.store(session, body)
+    session.execute(email_queue.insert().values(
+        sender='j@ex.com', recipients=recipients, body_hash=body.hash, status='pending', priority=priority.NORMAL,
+        coalesce_until=held_until, next_attempt_at=held_until
+    ))
+
+def test_eligibility_rules(monkeypatch):
+    headers = {'Subject': 'Submission moved to copyediting'}
+    assert not eligible(headers, priority.NORMAL, 'a@ex.com')  # disabled by default
+
+    monkeypatch.setattr(digest, 'WINDOW_SECONDS', 600)
+    monkeypatch.setattr(digest, 'EXCLUDE_SUBJECTS', 'review request')
+    assert eligible(headers, priority.NORMAL, 'a@ex.com')
+    assert eligible(headers, priority.BULK, 'a@ex.com')
+    assert not eligible(headers, priority.HIGH, 'a@ex.com')
+    assert not eligible(headers, priority.NORMAL, 'a@ex.com, b@ex.com')
+    assert not eligible({'Subject': 'Review Request'}, priority.NORMAL, 'a@ex.com')
+    assert not eligible({'Subject': 'Hi', 'X-Relay-Digest': 'no'}, priority.NORMAL, 'a@ex.com')
+
+def test_enqueue_holds_eligible_messages(session, monkeypatch):
+    monkeypatch.setattr(digest, 'WINDOW_SECONDS', 600)
+
+    enqueue_email(b"From: j@ex.com\r\nTo: a@ex.com\r\nSubject: Decision recorded\r\n\r\nHi")
+    enqueue_email(b"From: j@ex.com\r\nTo: a@ex.com\r\nSubject: Password reset\r\n\r\nHi")
+
+    normal, high = session.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    assert normal.coalesce_until is not None
+    assert normal.next_attempt_at == normal.coalesce_until > digest.utcnow()
+    assert high.coalesce_until is None
+
+def test_held_messages_are_merged_per_recipient(session):
+    now = datetime.datetime(2030, 1, 1, 12, 0)
+    queue_held(session, 'a@ex.com', 'Revisions requested', now - datetime.timedelta(minutes=1))
+    queue_held(session, 'a@ex.com', 'Moved to copyediting', now + datetime.timedelta(minutes=5))
+    queue_held(session, 'a@ex.com', 'Galley ready', now + datetime.timedelta(minutes=9))
+    queue_held(session, 'b@ex.com', 'Revisions requested', now - datetime.timedelta(minutes=1))
+    session.commit()
+
+    assert coalesce(session, now=now) == 1
+
+    rows = session.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    assert [(r.status, r.digest_id) for r in rows[:3]] == [('merged', rows[4].id)] * 3
+    # A lone held message is simply released
+    assert (rows[3].status, rows[3].coalesce_until) == ('pending', None)
+
+    digest_row = rows[4]
+    assert (digest_row.recipients, digest_row.status, digest_row.next_attempt_at) == ('a@ex.com', 'pending', now)
+    stored = session.execute(select(email_queue.c.body_hash).where(email_queue.c.id == digest_row.id)).scalar()
+    from database import email_body
+    body = session.execute(select(email_body).where(email_body.c.hash == stored)).fetchone()
+    msg = email.message_from_bytes(bodystore.decode(body.codec, body.data), policy=policy.default)
+    assert msg['Subject'] == "3 notifications: Revisions requested and 2 more"
+    summary, parts = msg.get_payload()
+    assert "Details of Galley ready." in summary.get_content()
+    assert parts.get_content_type() == 'multipart/digest'
+    assert [p.get_payload(0)['Subject'] for p in parts.get_payload()] == [
+        'Revisions requested', 'Moved to copyediting', 'Galley ready'
+    ]
+
+def test_sender_sends_one_digest_instead_of_each_notification(session, monkeypatch):
+    monkeypatch.setattr(digest, 'WINDOW_SECONDS', 600)
+    past = digest.utcnow() - datetime.timedelta(minutes=1)
+    for i in range(5):
+        queue_held(session, 'a@ex.com', f"Notification {i}", past)
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.return_value = {}
+
+        send_batch()
+
+    mock_server.sendmail.assert_called_once()
+    statuses = session.execute(select(email_queue.c.status).order_by(email_queue.c.id)).scalars().all()
+    assert statuses == ['merged'] * 5 + ['sent']
+
+def test_expired_holds_wait_for_coalesce_oldest_group_first(session, engine, monkeypatch):
+    from send_batch import claim_batch
+    monkeypatch.setattr(digest, 'WINDOW_SECONDS', 600)
+    now = digest.utcnow()
+    queue_held(session, 'new@ex.com', 'Galley ready', now - datetime.timedelta(minutes=1))
+    queue_held(session, 'old@ex.com', 'Revisions requested', now - datetime.timedelta(minutes=30))
+    session.commit()
+
+    # Holds have run out, but no worker may send them ahead of the digest pass
+    assert claim_batch(session, engine, 'w1') == []
+
+    assert coalesce(session, now=now, groups=1) == 0
+    released = session.execute(
+        select(email_queue.c.recipients).where(email_queue.c.coalesce_until.is_(None))
+    ).scalars().all()
+    assert released == ['old@ex.com']
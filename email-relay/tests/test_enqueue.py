@@ -1,9 +1,15 @@
 import io
+import os
 import sys
 from sqlalchemy import select
 import pytest
-from database import email_queue
-from enqueue import enqueue_email
+from database import email_queue, email_body, email_dedup
+import bodystore
+from enqueue import enqueue_email, enqueue_stream, HeaderBlock, PrefixedReader
+
+def stored_body(conn, row):
+    body = conn.execute(select(email_body).where(email_body.c.hash == row.body_hash)).fetchone()
+    return bodystore.decode(body.codec, body.data)
 
 def test_enqueue_success_headers_only(session):
     # Test default behavior: no args, parse from headers
@@ -17,7 +23,7 @@ def test_enqueue_success_headers_only(session):
     assert result is not None
     assert result.sender == 'header@example.com'
     assert result.recipients == 'header@example.com'
-    assert result.body == raw_email
+    assert stored_body(session, result) == raw_email
     assert result.status == 'pending'
 
 def test_enqueue_with_args_override(session):
@@ -48,3 +54,253 @@ def test_enqueue_multiple_recipients_headers(session):
     assert "a@ex.com" in result.recipients
     assert "b@ex.com" in result.recipients
     assert "c@ex.com" in result.recipients
+
+@pytest.fixture
+def sqlite_file_db(tmp_path, monkeypatch):
+    # The fast path talks DB-API directly, so give it a real database file
+    from sqlalchemy import create_engine
+    from database import metadata
+    path = tmp_path / 'queue.db'
+    file_engine = create_engine(f"sqlite:///{path}")
+    metadata.create_all(file_engine)
+    monkeypatch.setenv('DB_DRIVER', 'sqlite')
+    monkeypatch.setenv('DB_NAME', str(path))
+    yield file_engine
+    file_engine.dispose()
+
+def test_enqueue_stream_parses_headers_when_needed(sqlite_file_db):
+    raw_email = b"From: me@ex.com\r\nTo: a@ex.com\r\nCc: b@ex.com\r\n\r\nBody content\r\n"
+
+    assert enqueue_stream(io.BytesIO(raw_email))
+
+    with sqlite_file_db.connect() as conn:
+        row = conn.execute(select(email_queue)).fetchone()
+        assert row.sender == 'me@ex.com'
+        assert row.recipients == 'a@ex.com, b@ex.com'
+        assert stored_body(conn, row) == raw_email
+        assert row.status == 'pending'
+
+def test_enqueue_stream_skips_parsing_with_envelope_args(sqlite_file_db, monkeypatch):
+    import enqueue
+    def fail(*args, **kwargs):
+        raise AssertionError("stdin should not be read line by line")
+    monkeypatch.setattr(enqueue, 'read_header_block', fail)
+
+    # Larger than the initial peek, so the remainder is streamed
+    raw_email = b"From: header@ex.com\r\n\r\n" + b"x" * 200000
+
+    enqueue_stream(io.BytesIO(raw_email), 'flag@ex.com', ['arg1@ex.com', 'arg2@ex.com'])
+
+    with sqlite_file_db.connect() as conn:
+        row = conn.execute(select(email_queue)).fetchone()
+        assert row.sender == 'flag@ex.com'
+        assert row.recipients == 'arg1@ex.com, arg2@ex.com'
+        assert stored_body(conn, row) == raw_email
+
+def test_enqueue_stream_ignores_empty_input(sqlite_file_db):
+    assert not enqueue_stream(io.BytesIO(b''), 'flag@ex.com', ['a@ex.com'])
+    assert not enqueue_stream(io.BytesIO(b''))
+
+    with sqlite_file_db.connect() as conn:
+        assert conn.execute(select(email_queue)).fetchall() == []
+
+def test_header_block_unfolds_and_collects_repeats():
+    headers = HeaderBlock(b"From: me@ex.com\r\nTo: a@ex.com,\r\n b@ex.com\r\nto: c@ex.com\r\n\r\nBody: no\r\n")
+    assert headers.get('From') == 'me@ex.com'
+    assert headers.get_all('To') == ['a@ex.com, b@ex.com', 'c@ex.com']
+    assert headers.get('Body') is None
+    assert headers.get_all('Bcc', []) == []
+
+def test_enqueue_stream_reads_folded_headers(sqlite_file_db):
+    import priority
+    # Envelope from the headers, then from arguments (the fast path): one parser for both
+    enqueue_stream(io.BytesIO(
+        b"From: j@ex.com\r\nTo: a@ex.com\r\nSubject: Instructions to\r\n reset your password\r\n\r\nHi"
+    ))
+    enqueue_stream(io.BytesIO(b"Subject: Password reset\r\nPrecedence:\r\n\tbulk\r\n\r\nHi"), 'j@ex.com', ['a@ex.com'])
+
+    with sqlite_file_db.connect() as conn:
+        lanes = conn.execute(select(email_queue.c.priority).order_by(email_queue.c.id)).scalars().all()
+    assert lanes == [priority.HIGH, priority.BULK]
+
+    headers = HeaderBlock(b"Content-Type: multipart/mixed;\r\n boundary=x\r\n\r\nSubject: body\r\n")
+    assert headers.get('Content-Type') == 'multipart/mixed; boundary=x'
+    assert headers.get('Subject') is None
+
+def test_prefixed_reader_replays_prefix():
+    stream = io.BytesIO(b"rest of body")
+    reader = PrefixedReader(b"Header: x\r\n\r\n", stream)
+    assert reader.read() == b"Header: x\r\n\r\nrest of body"
+
+def test_enqueue_stream_spools_without_touching_db(tmp_path, monkeypatch):
+    import rawdb
+    import spool
+    def fail():
+        raise AssertionError("spool mode should not connect")
+    monkeypatch.setattr(rawdb, 'connect', fail)
+    spool.ensure_dirs(str(tmp_path))
+
+    raw_email = b"From: me@ex.com\r\nTo: a@ex.com\r\n\r\nBody content"
+    assert enqueue_stream(io.BytesIO(raw_email), spool_dir=str(tmp_path))
+
+    [name] = os.listdir(tmp_path / 'new')
+    envelope, raw = spool.read_message(str(tmp_path / 'new' / name))
+    assert envelope['recipients'] == 'a@ex.com'
+    assert raw == raw_email
+
+def test_enqueue_stream_falls_back_when_spool_unavailable(sqlite_file_db, tmp_path):
+    raw_email = b"From: me@ex.com\r\nTo: a@ex.com\r\n\r\nBody content"
+
+    assert enqueue_stream(io.BytesIO(raw_email), spool_dir=str(tmp_path / 'missing'))
+
+    with sqlite_file_db.connect() as conn:
+        row = conn.execute(select(email_queue)).fetchone()
+        assert stored_body(conn, row) == raw_email
+
+def test_identical_bodies_are_stored_once(sqlite_file_db):
+    raw_email = b"From: me@ex.com\r\nTo: a@ex.com\r\n\r\nSame notification\r\n"
+
+    enqueue_stream(io.BytesIO(raw_email), 'me@ex.com', ['a@ex.com'])
+    enqueue_stream(io.BytesIO(raw_email), 'me@ex.com', ['b@ex.com'])
+
+    with sqlite_file_db.connect() as conn:
+        rows = conn.execute(select(email_queue)).fetchall()
+        bodies = conn.execute(select(email_body)).fetchall()
+    assert len(rows) == 2
+    assert len(bodies) == 1
+    assert rows[0].body_hash == rows[1].body_hash == bodies[0].hash
+    assert bodies[0].size == len(raw_email)
+
+def test_resubmitted_message_id_is_queued_once(session, capsys):
+    raw_email = b"From: j@ex.com\r\nTo: a@ex.com\r\nMessage-ID: <abc@journal.example.org>\r\n\r\nHi"
+
+    enqueue_email(raw_email)
+    enqueue_email(raw_email)
+    # Same Message-ID to someone else is a different delivery
+    enqueue_email(raw_email, args_recipients=['b@ex.com'])
+
+    assert [r.recipients for r in session.execute(select(email_queue)).fetchall()] == ['a@ex.com', 'b@ex.com']
+    assert sorted(r.hits for r in session.execute(select(email_dedup)).fetchall()) == [0, 1]
+    assert "Duplicate" in capsys.readouterr().err
+
+def test_fast_path_dedups_on_content_without_message_id(sqlite_file_db):
+    raw_email = b"From: me@ex.com\r\nTo: a@ex.com\r\n\r\nReview reminder\r\n"
+
+    for _ in range(3):
+        assert enqueue_stream(io.BytesIO(raw_email), 'me@ex.com', ['a@ex.com'])
+    enqueue_stream(io.BytesIO(raw_email + b"Edited"), 'me@ex.com', ['a@ex.com'])
+
+    with sqlite_file_db.connect() as conn:
+        assert len(conn.execute(select(email_queue)).fetchall()) == 2
+        assert sorted(r.hits for r in conn.execute(select(email_dedup)).fetchall()) == [0, 2]
+
+def test_priority_from_option_header_and_heuristics(session):
+    import priority
+    enqueue_email(b"From: j@ex.com\r\nTo: a@ex.com\r\nSubject: Validate Your Account\r\n\r\nHi")
+    enqueue_email(b"From: j@ex.com\r\nTo: a@ex.com\r\nPrecedence: bulk\r\nSubject: News\r\n\r\nHi")
+    enqueue_email(b"From: j@ex.com\r\nTo: a@ex.com\r\nX-Relay-Priority: high\r\nSubject: News\r\n\r\nHi")
+    enqueue_email(b"From: j@ex.com\r\nTo: a@ex.com\r\nSubject: Password Reset\r\n\r\nHi", requested_priority='bulk')
+    enqueue_email(b"From: j@ex.com\r\nTo: a@ex.com\r\nSubject: Review request\r\n\r\nHi")
+
+    lanes = session.execute(select(email_queue.c.priority).order_by(email_queue.c.id)).scalars().all()
+    assert lanes == [priority.HIGH, priority.BULK, priority.HIGH, priority.BULK, priority.NORMAL]
+
+def test_enqueue_stream_classifies_without_parsing_headers(sqlite_file_db, monkeypatch):
+    import enqueue
+    import priority
+    def fail(*args, **kwargs):
+        raise AssertionError("stdin should not be read line by line")
+    monkeypatch.setattr(enqueue, 'read_header_block', fail)
+
+    raw_email = b"From: j@ex.com\r\nX-Relay-Priority: high\r\n\r\nSubject: not a header\r\n"
+    enqueue_stream(io.BytesIO(raw_email), 'j@ex.com', ['a@ex.com'])
+
+    with sqlite_file_db.connect() as conn:
+        assert conn.execute(select(email_queue.c.priority)).scalar() == priority.HIGH
+
+def test_enqueue_signals_the_sender_once_per_burst(session, tmp_path, monkeypatch):
+    import wakeup
+    flag = tmp_path / 'wake'
+    monkeypatch.setattr(wakeup, 'WAKEUP', f'file:{flag}')
+
+    enqueue_email(b"From: a@ex.com\r\nTo: b@ex.com\r\n\r\nOne")
+    enqueue_email(b"From: a@ex.com\r\nTo: b@ex.com\r\n\r\nTwo")
+    assert flag.exists()
+
+    channel = wakeup.channel()
+    assert channel.wait(0) is True
+    assert not flag.exists()
+    assert channel.wait(0) is False
+
+def test_udp_wakeup_is_coalesced(tmp_path):
+    import wakeup
+    listener = wakeup.UDPChannel('127.0.0.1', 0)
+    host, port = listener.listen()
+    try:
+        sender = wakeup.UDPChannel(host, port, stamp_path=str(tmp_path / 'stamp'), coalesce=60)
+        assert sender.notify() is True
+        assert sender.notify() is False
+        assert listener.wait(2) is True
+        assert listener.wait(0) is False
+    finally:
+        listener.close()
+
+def test_cloud_run_wakeup_starts_the_job(tmp_path):
+    import json
+    import wakeup
+    from unittest.mock import patch, MagicMock
+    channel = wakeup.channel('cloudrun:projects/p/locations/r/jobs/email-relay-sender')
+    channel.stamp_path = str(tmp_path / 'stamp')
+
+    token = MagicMock()
+    token.__enter__.return_value = io.BytesIO(json.dumps({'access_token': 'tok'}).encode())
+    with patch('urllib.request.urlopen', side_effect=[token, MagicMock()]) as urlopen:
+        assert channel.notify() is True
+        assert channel.notify() is False
+
+    run = urlopen.call_args_list[1][0][0]
+    assert run.full_url == f"{wakeup.CLOUD_RUN_API}/projects/p/locations/r/jobs/email-relay-sender:run"
+    assert run.get_header('Authorization') == 'Bearer tok'
+
+def test_wakeup_failure_does_not_fail_enqueue(session, monkeypatch):
+    import wakeup
+    monkeypatch.setattr(wakeup, 'WAKEUP', 'file:/nonexistent/dir/wake')
+
+    enqueue_email(b"From: a@ex.com\r\nTo: b@ex.com\r\n\r\nBody")
+
+    assert session.execute(select(email_queue)).fetchone() is not None
+
+def test_enqueue_records_envelope_metadata(session):
+    raw_email = (b"From: j@example.org\r\nTo: A@Uni.edu, b@uni.edu, c@mail.example.com\r\n"
+                 b"Content-Type: multipart/mixed; boundary=x\r\n\r\n--x\r\n\r\nHi\r\n--x--\r\n")
+
+    enqueue_email(raw_email)
+
+    row = session.execute(select(email_queue)).fetchone()
+    assert row.message_size == len(raw_email)
+    assert row.recipient_count == 3
+    assert row.recipient_domains == 'mail.example.com,uni.edu'
+    assert row.has_attachments
+
+def test_attachments_are_judged_from_the_top_level_content_type():
+    from envelope import has_attachments
+    assert has_attachments('multipart/mixed; boundary="b"')
+    assert has_attachments('application/pdf; name="review.pdf"')
+    assert not has_attachments('multipart/alternative; boundary="b"')
+    assert not has_attachments('text/html; charset=utf-8')
+    assert not has_attachments(None)
+
+def test_udp_wakeup_binds_once_across_threads():
+    import threading
+    import wakeup
+    listener = wakeup.UDPChannel('127.0.0.1', 0)
+    addresses = []
+    threads = [threading.Thread(target=lambda: addresses.append(listener.listen())) for _ in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(addresses)) == 1
+    finally:
+        listener.close()
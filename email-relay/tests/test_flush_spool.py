@@ -0,0 +1,90 @@
+import io
+import os
+from sqlalchemy import select
+from database import email_queue, email_body
+import spool
+import bodystore
+from flush_spool import flush_spool
+
+RAW = b"From: me@ex.com\r\nTo: a@ex.com\r\n\r\nBody"
+
+def spool_messages(spool_dir, count):
+    spool.ensure_dirs(spool_dir)
+    return [spool.write_message(spool_dir, io.BytesIO(RAW), 'me@ex.com', f'r{i}@ex.com') for i in range(count)]
+
+def test_write_message_is_atomic_maildir_delivery(tmp_path):
+    name = spool_messages(str(tmp_path), 1)[0]
+
+    assert os.listdir(tmp_path / 'tmp') == []
+    assert os.listdir(tmp_path / 'new') == [name]
+    envelope, raw = spool.read_message(str(tmp_path / 'new' / name))
+    assert envelope['sender'] == 'me@ex.com'
+    assert envelope['recipients'] == 'r0@ex.com'
+    assert raw == RAW
+
+def test_flush_spool_bulk_loads_and_removes_files(session, tmp_path, monkeypatch):
+    import flush_spool as fs
+    spool_messages(str(tmp_path), 5)
+
+    statements = []
+    real_execute = session.execute
+    def execute(stmt, *args, **kwargs):
+        statements.append(stmt)
+        return real_execute(stmt, *args, **kwargs)
+    monkeypatch.setattr(session, 'execute', execute)
+    monkeypatch.setattr(fs, 'FLUSH_BATCH_SIZE', 2)
+
+    assert fs.load_spool(session, str(tmp_path), batch_size=2) == 5
+    # Three batches, each one existence check, one dedup key lookup and
+    # insert, one body lookup, one body insert (first batch) or touch (the
+    # others) and one multi-row INSERT
+    assert len(statements) == 18
+
+    rows = session.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    assert [r.recipients for r in rows] == [f'r{i}@ex.com' for i in range(5)]
+    assert all(r.body is None and r.status == 'pending' for r in rows)
+
+    # The identical bodies are stored once
+    [body] = session.execute(select(email_body)).fetchall()
+    assert {r.body_hash for r in rows} == {body.hash}
+    assert bodystore.decode(body.codec, body.data) == RAW
+    assert os.listdir(tmp_path / 'new') == []
+    assert os.listdir(tmp_path / 'cur') == []
+
+def test_interrupted_flush_is_not_loaded_twice(session, tmp_path):
+    names = spool_messages(str(tmp_path), 2)
+
+    # A previous flush claimed both files and committed the first one, then died
+    for name in names:
+        os.rename(tmp_path / 'new' / name, tmp_path / 'cur' / name)
+        os.utime(tmp_path / 'cur' / name, (0, 0))
+    session.execute(email_queue.insert().values(
+        sender='me@ex.com', recipients='r0@ex.com', body=RAW, status='pending', spool_ref=names[0]
+    ))
+    session.commit()
+
+    assert flush_spool(str(tmp_path)) == 1
+
+    rows = session.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    assert [r.recipients for r in rows] == ['r0@ex.com', 'r1@ex.com']
+    assert os.listdir(tmp_path / 'cur') == []
+
+def test_fresh_claims_are_left_to_their_flusher(session, tmp_path):
+    name = spool_messages(str(tmp_path), 1)[0]
+    os.rename(tmp_path / 'new' / name, tmp_path / 'cur' / name)
+    os.utime(tmp_path / 'cur' / name)
+
+    assert flush_spool(str(tmp_path)) == 0
+    assert os.listdir(tmp_path / 'cur') == [name]
+
+def test_duplicate_spooled_messages_are_loaded_once(session, tmp_path):
+    from database import email_dedup
+    spool.ensure_dirs(str(tmp_path))
+    raw = b"From: me@ex.com\r\nMessage-ID: <1@ex.com>\r\n\r\nBody"
+    for _ in range(3):
+        spool.write_message(str(tmp_path), io.BytesIO(raw), 'me@ex.com', 'a@ex.com', message_id='<1@ex.com>')
+
+    flush_spool(str(tmp_path))
+
+    assert len(session.execute(select(email_queue)).fetchall()) == 1
+    assert session.execute(select(email_dedup.c.hits)).scalar() == 2
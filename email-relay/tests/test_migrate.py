@@ -0,0 +1,58 @@
+import datetime
+from sqlalchemy import create_engine, inspect, text, select
+from database import email_queue
+from migrate import add_missing_columns, add_missing_indexes
+
+def create_original_table(engine):
+    with engine.begin() as conn:
+        # email_queue as originally shipped
+        conn.execute(text(
+            "CREATE TABLE email_queue (id INTEGER PRIMARY KEY, created_at TIMESTAMP, status VARCHAR(7), "
+            "attempt_count INTEGER, last_attempt_at TIMESTAMP, error_message TEXT, sender VARCHAR(255) NOT NULL, "
+            "recipients TEXT NOT NULL, body BLOB NOT NULL)"
+        ))
+
+def test_add_missing_columns_upgrades_old_table():
+    engine = create_engine('sqlite:///:memory:')
+    create_original_table(engine)
+
+    added = add_missing_columns(engine)
+
+    assert 'email_queue.claimed_by' in added
+    assert 'email_queue.lease_expires_at' in added
+    columns = {col['name'] for col in inspect(engine).get_columns('email_queue')}
+    assert {'claimed_by', 'lease_expires_at', 'next_attempt_at'} <= columns
+
+    # Idempotent
+    assert add_missing_columns(engine) == []
+
+def test_next_attempt_at_backfilled_for_existing_rows():
+    engine = create_engine('sqlite:///:memory:')
+    create_original_table(engine)
+    created = datetime.datetime(2024, 1, 1, 12, 0)
+    with engine.begin() as conn:
+        conn.execute(email_queue.insert().values(
+            sender='s', recipients='r', body=b'b', status='pending', attempt_count=0, created_at=created
+        ))
+
+    add_missing_columns(engine)
+    assert {'idx_status_created', 'idx_status_next_attempt'} <= set(add_missing_indexes(engine))
+
+    with engine.connect() as conn:
+        row = conn.execute(select(email_queue.c.next_attempt_at, email_queue.c.priority)).fetchone()
+    assert row.next_attempt_at == created
+    assert row.priority == 1
+
+def test_monthly_partitions_cover_range():
+    from migrate import monthly_partitions, partition_definitions
+
+    partitions = monthly_partitions(datetime.datetime(2024, 11, 17), datetime.datetime(2025, 1, 1))
+    assert partitions == [
+        ('p202411', datetime.datetime(2024, 12, 1)),
+        ('p202412', datetime.datetime(2025, 1, 1)),
+        ('p202501', datetime.datetime(2025, 2, 1)),
+    ]
+
+    ddl = partition_definitions(partitions[:1])
+    assert "PARTITION p202411 VALUES LESS THAN (UNIX_TIMESTAMP('2024-12-01 00:00:00'))" in ddl
+    assert ddl.endswith("PARTITION pmax VALUES LESS THAN MAXVALUE")
@@ -0,0 +1,40 @@
+import io
+import json
+import pstats
+import pytest
+import profiling
+from profiling import Profiler, parse_modes
+
+def test_parse_modes():
+    assert parse_modes('') == set()
+    assert parse_modes('1') == {'phases'}
+    assert parse_modes('phases, cProfile') == {'phases', 'cprofile'}
+    with pytest.raises(ValueError):
+        parse_modes('phases,perf')
+
+def test_profiler_writes_summary_and_dump(tmp_path):
+    profiler = Profiler('send_batch', {'phases', 'cprofile'}, profile_dir=str(tmp_path)).start()
+    for _ in range(2):
+        with profiler.phase('claim'):
+            pass
+    with profiler.phase('smtp_send'):
+        sum(range(10000))
+
+    out = io.StringIO()
+    profiler.finish(stream=out)
+    assert profiler.finish(stream=out) is None
+
+    [line] = out.getvalue().splitlines()
+    entry = json.loads(line)
+    assert entry['severity'] == 'INFO'
+    assert entry['profile'] == 'send_batch'
+    assert entry['phases']['claim']['count'] == 2
+    assert set(entry['phases']) == {'claim', 'smtp_send'}
+    assert entry['message'].startswith('profile send_batch: wall ')
+    pstats.Stats(entry['cprofile_path'])
+
+def test_phase_is_a_no_op_when_off(monkeypatch):
+    monkeypatch.setattr(profiling, 'current', None)
+    assert profiling.start('enqueue', '') is None
+    with profiling.phase('insert'):
+        pass
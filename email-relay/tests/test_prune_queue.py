@@ -1,7 +1,8 @@
 import datetime
 from sqlalchemy import select
-from database import email_queue
-from prune_queue import prune_queue
+from database import email_queue, email_body
+import bodystore
+from prune_queue import prune_queue, drop_expired_partitions
 
 def test_prune_queue(session):
     now = datetime.datetime.now()
@@ -29,3 +30,99 @@ def test_prune_queue(session):
     statuses = [r.status for r in rows]
     assert 'sent' in statuses # recent_sent
     assert 'failed' in statuses # recent_failed
+
+def test_prune_queue_deletes_in_chunks(session, monkeypatch):
+    import prune_queue as pq
+    sleeps = []
+    monkeypatch.setattr(pq.time, 'sleep', lambda s: sleeps.append(s))
+
+    old = datetime.datetime.now() - datetime.timedelta(days=40)
+    for _ in range(5):
+        session.execute(email_queue.insert().values(
+            sender='s', recipients='r', body=b'b', status='sent', created_at=old
+        ))
+    session.commit()
+
+    prune_queue(chunk_size=2, pause=0.5)
+
+    assert session.execute(select(email_queue)).fetchall() == []
+    # Pauses only between full chunks: 2 + 2 + 1
+    assert sleeps == [0.5, 0.5]
+
+def test_prune_queue_stops_at_time_budget(session, monkeypatch):
+    import prune_queue as pq
+    monkeypatch.setattr(pq.time, 'sleep', lambda s: None)
+
+    old = datetime.datetime.now() - datetime.timedelta(days=40)
+    for _ in range(3):
+        session.execute(email_queue.insert().values(
+            sender='s', recipients='r', body=b'b', status='sent', created_at=old
+        ))
+    session.commit()
+
+    prune_queue(chunk_size=1, time_budget=0)
+
+    # Nothing deleted; left for the next run
+    assert len(session.execute(select(email_queue)).fetchall()) == 3
+
+def test_prune_queue_removes_unreferenced_bodies(session):
+    old = datetime.datetime.now() - datetime.timedelta(days=40)
+    kept, orphan, fresh = (bodystore.encode(raw) for raw in (b'kept', b'orphan', b'fresh'))
+    for body in (kept, orphan, fresh):
+        bodystore.store(session, body)
+    session.execute(email_body.update().where(email_body.c.hash != fresh.hash).values(last_used_at=old))
+    # Still referenced by a recent row; the orphan's row is pruned
+    session.execute(email_queue.insert().values(sender='s', recipients='r', body_hash=kept.hash, status='sent'))
+    session.execute(email_queue.insert().values(
+        sender='s', recipients='r', body_hash=orphan.hash, status='sent', created_at=old
+    ))
+    session.commit()
+
+    prune_queue()
+
+    hashes = set(session.execute(select(email_body.c.hash)).scalars())
+    # fresh is unreferenced but inside the grace period
+    assert hashes == {kept.hash, fresh.hash}
+
+def test_prune_queue_removes_recipient_outcomes(session):
+    from database import email_recipient
+    old = datetime.datetime.now() - datetime.timedelta(days=31)
+    session.execute(email_queue.insert().values(
+        id=1, sender='s', recipients='a, b', body=b'b', status='sent', created_at=old
+    ))
+    session.execute(email_recipient.insert(), [
+        {'email_id': 1, 'address': 'a', 'status': 'sent'},
+        {'email_id': 1, 'address': 'b', 'status': 'failed'},
+    ])
+    session.commit()
+
+    prune_queue()
+
+    assert session.execute(select(email_recipient)).fetchall() == []
+
+def test_prune_queue_expires_dedup_keys_and_logs_hits(session, caplog):
+    import logging
+    from database import email_dedup
+    now = datetime.datetime.now()
+    session.execute(email_dedup.insert(), [
+        {'dedup_key': 'old', 'created_at': now - datetime.timedelta(days=2), 'hits': 3},
+        {'dedup_key': 'new', 'created_at': now, 'hits': 1},
+    ])
+    session.commit()
+
+    with caplog.at_level(logging.INFO):
+        prune_queue()
+
+    assert session.execute(select(email_dedup.c.dedup_key)).scalars().all() == ['new']
+    assert "dropped 3 duplicate submissions of 1 emails" in caplog.text
+
+def test_partition_drops_stop_at_the_deadline(session, monkeypatch):
+    import archive
+    import migrate
+    monkeypatch.setattr(migrate, 'get_partitions', lambda engine: [
+        ('p202401', datetime.datetime(2024, 2, 1)), ('pmax', None)
+    ])
+
+    # Past the deadline nothing is archived, dropped or even looked at
+    assert drop_expired_partitions(None, datetime.datetime(2024, 6, 1), deadline=0) == ([], False)
+    assert archive.archive_partition(session, None, 'p202401', 10, deadline=0) == (0, False)
@@ -0,0 +1,111 @@
+import io
+import json
+import datetime
+from unittest.mock import MagicMock, patch
+from sqlalchemy import text
+from database import email_queue
+import bodystore
+import metrics
+import priority
+import queue_stats
+from queue_stats import collect, queries
+from send_batch import send_batch
+
+NOW = datetime.datetime(2030, 1, 1, 12, 0)
+
+def queue(session, status='pending', lane=priority.NORMAL, age_minutes=0, due_in_minutes=0, held=False, raw=b"Hi"):
+    body = bodystore.encode(raw)
+    bodystore.store(session, body)
+    next_attempt = NOW + datetime.timedelta(minutes=due_in_minutes)
+    session.execute(email_queue.insert().values(
+        sender='j@ex.com', recipients='a@ex.com', body_hash=body.hash, status=status, priority=lane,
+        created_at=NOW - datetime.timedelta(minutes=age_minutes),
+        next_attempt_at=next_attempt, coalesce_until=next_attempt if held else None
+    ))
+    return body.size
+
+def test_collect_reports_queue_depth_age_and_bytes(session):
+    size = queue(session, age_minutes=30)
+    size += queue(session, lane=priority.HIGH, age_minutes=5, raw=b"Hello")
+    queue(session, lane=priority.BULK, due_in_minutes=10, held=True)
+    queue(session, status='failed', age_minutes=60)
+    queue(session, status='failed', age_minutes=60 * 48)
+    queue(session, status='sent')
+    session.commit()
+
+    stats = collect(session, now=NOW)
+
+    assert stats['pending'] == {'high': 1, 'normal': 1, 'bulk': 1}
+    assert stats['due'] == 2
+    assert stats['held'] == 1
+    assert stats['oldest_pending_age_seconds'] == 30 * 60
+    assert stats['pending_bytes'] == size + bodystore.encode(b"Hi").size
+    assert stats['failed_last_day'] == 1
+    assert queue_stats.PENDING.value(lane='bulk') == 1
+    assert queue_stats.OLDEST_AGE.value() == 30 * 60
+
+def test_stats_queries_use_indexes(session):
+    # None of the aggregates may scan email_queue
+    for name, stmt in queries(NOW).items():
+        sql = str(stmt.compile(session.get_bind(), compile_kwargs={'literal_binds': True}))
+        plan = [row[-1] for row in session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+        scans = [step for step in plan if step.startswith('SCAN email_queue')]
+        assert not scans, f"{name}: {plan}"
+
+def test_metrics_render_and_log():
+    registry = metrics.Registry()
+    sent = registry.counter('test_sent', "Sent")
+    latency = registry.histogram('test_latency_seconds', "Latency", buckets=(0.1, 1.0))
+    sent.inc(lane='normal')
+    sent.inc(2, lane='normal')
+    latency.observe(0.05)
+    latency.observe(0.5)
+
+    assert registry.render().splitlines() == [
+        '# TYPE email_relay_test_latency_seconds histogram',
+        '# HELP email_relay_test_latency_seconds Latency',
+        'email_relay_test_latency_seconds_bucket{le="0.1"} 1',
+        'email_relay_test_latency_seconds_bucket{le="1"} 2',
+        'email_relay_test_latency_seconds_bucket{le="+Inf"} 2',
+        'email_relay_test_latency_seconds_count 2',
+        'email_relay_test_latency_seconds_sum 0.55',
+        '# TYPE email_relay_test_sent counter',
+        '# HELP email_relay_test_sent Sent',
+        'email_relay_test_sent_total{lane="normal"} 3',
+        '# EOF',
+    ]
+
+    stream = io.StringIO()
+    metrics.log_entry('email_relay_test_sent', 1, {'lane': 'normal'}, stream=stream)
+    entry = json.loads(stream.getvalue())
+    assert entry['metric'] == 'email_relay_test_sent'
+    assert entry['labels'] == {'lane': 'normal'}
+    assert entry['severity'] == 'INFO'
+
+def test_sender_counts_and_times_deliveries(session):
+    body = bodystore.encode(b"Hi")
+    bodystore.store(session, body)
+    session.execute(email_queue.insert().values(sender='j@ex.com', recipients='a@ex.com', body_hash=body.hash))
+    session.commit()
+    sent = metrics.counter('messages_sent', "")
+    before = sent.value() or 0
+    connects = metrics.histogram('smtp_connect_seconds', "")
+    connects_before = (connects.value() or {}).get('count', 0)
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.return_value = {}
+
+        send_batch()
+
+    assert sent.value() == before + 1
+    assert connects.value()['count'] == connects_before + 1
+
+def test_pending_bytes_counts_inline_bodies(session):
+    size = queue(session, raw=b"Stored")
+    session.execute(email_queue.insert().values(sender='j@ex.com', recipients='b@ex.com', body=b"Inline",
+                                                status='pending'))
+    session.commit()
+
+    assert collect(session, now=NOW)['pending_bytes'] == size + len(b"Inline")
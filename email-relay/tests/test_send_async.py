@@ -0,0 +1,136 @@
+import os
+import sys
+import asyncio
+import datetime
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker, scoped_session
+import database
+from database import email_queue
+import bodystore
+import send_batch
+import send_async
+from send_async import ByteBudget
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'benchmarks')))
+from fake_smtp import FakeSMTPServer
+
+@pytest.fixture
+def file_engine(tmp_path, monkeypatch):
+    # The engine runs database steps on worker threads, so use real
+    # per-thread sessions on a file database
+    engine = create_engine(f"sqlite:///{tmp_path / 'queue.db'}")
+    database.metadata.create_all(engine)
+    monkeypatch.setattr(database, 'get_engine', lambda db_url=None: engine)
+    monkeypatch.setattr(database, 'get_session', lambda e: scoped_session(sessionmaker(bind=e)))
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def fake_smtp(monkeypatch):
+    servers = []
+    def start(**kwargs):
+        server = FakeSMTPServer(**kwargs).start()
+        servers.append(server)
+        monkeypatch.setenv('SMTP_HOST', server.address[0])
+        monkeypatch.setenv('SMTP_PORT', str(server.address[1]))
+        return server
+    yield start
+    for server in servers:
+        server.stop()
+
+def queue(engine, recipients, raw=None):
+    with engine.begin() as conn:
+        if raw is None:
+            conn.execute(email_queue.insert().values(
+                sender='s@ex.com', recipients=recipients, body=b'Subject: inline\r\n\r\nHi', status='pending'))
+            return
+        body = bodystore.encode(raw)
+        conn.execute(database.insert_ignore(engine, database.email_body, {
+            'hash': body.hash, 'codec': body.codec, 'size': body.size, 'data': body.data}))
+        conn.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients=recipients, body_hash=body.hash, status='pending'))
+
+def test_async_engine_drains_the_queue(file_engine, fake_smtp):
+    server = fake_smtp()
+    notice = b"Subject: New issue\r\n\r\n" + b"Table of contents\r\n" * 50
+    for i in range(8):
+        queue(file_engine, f"r{i}@uni{i % 3}.example.edu", notice)
+    queue(file_engine, 'legacy@ex.com')
+    queue(file_engine, ', '.join(f"c{i}@ex.org" for i in range(5)), b"Subject: Big list\r\n\r\nHello")
+
+    delivered = send_async.run(sessions=4, rate_per_minute=6000, burst=100, batch_size=4)
+
+    assert delivered == 10
+    assert sorted(rcpt for _, rcpt in server.delivered) == sorted(
+        [f"r{i}@uni{i % 3}.example.edu" for i in range(8)] + ['legacy@ex.com'] + [f"c{i}@ex.org" for i in range(5)]
+    )
+    with file_engine.connect() as conn:
+        rows = conn.execute(select(email_queue)).fetchall()
+    assert {(r.status, r.claimed_by) for r in rows} == {('sent', None)}
+
+def test_async_engine_keeps_retry_semantics(file_engine, fake_smtp, monkeypatch):
+    monkeypatch.setattr(send_batch, 'DOMAIN_BACKOFF_SECONDS', 120)
+    fake_smtp(domain_limits={'busy.example.edu': 1})
+    queue(file_engine, 'a@busy.example.edu', b"Subject: one\r\n\r\nHi")
+    queue(file_engine, 'b@busy.example.edu', b"Subject: two\r\n\r\nHi")
+
+    delivered = send_async.run(sessions=1, rate_per_minute=6000, burst=100)
+
+    assert delivered == 1
+    with file_engine.connect() as conn:
+        first, second = conn.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    assert first.status == 'sent'
+    # Deferred by the domain: postponed without using an attempt, as with send_batch
+    assert (second.status, second.attempt_count, second.claimed_by) == ('pending', 0, None)
+    assert second.next_attempt_at > datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def test_async_engine_counts_failed_attempts(file_engine, fake_smtp):
+    fake_smtp(refuse_rate=1.0)
+    queue(file_engine, 'gone@ex.com', b"Subject: hi\r\n\r\nHi")
+
+    assert send_async.run(sessions=2, rate_per_minute=6000, burst=100) == 0
+
+    with file_engine.connect() as conn:
+        row = conn.execute(select(email_queue)).fetchone()
+    assert (row.status, row.attempt_count) == ('pending', 1)
+    assert '550' in row.error_message
+
+def test_async_engine_journals_sends_and_recovers_abandoned_journals(file_engine, fake_smtp, tmp_path, monkeypatch):
+    journals = tmp_path / 'journals'
+    journals.mkdir()
+    monkeypatch.setattr(send_batch, 'JOURNAL_DIR', str(journals))
+    server = fake_smtp()
+    queue(file_engine, 'a@ex.com', b"Subject: one\r\n\r\nHi")
+    queue(file_engine, 'b@ex.com', b"Subject: two\r\n\r\nHi")
+    with file_engine.begin() as conn:
+        first_id = conn.execute(select(email_queue.c.id).order_by(email_queue.c.id)).scalar()
+
+    # A crashed worker had sent the first message but not recorded it
+    abandoned = journals / 'crashed-worker.journal'
+    abandoned.write_text(f"{first_id}\n")
+    os.utime(abandoned, (0, 0))
+
+    assert send_async.run(sessions=2, rate_per_minute=6000, burst=100) == 1
+
+    assert [rcpt for _, rcpt in server.delivered] == ['b@ex.com']
+    with file_engine.connect() as conn:
+        assert {r.status for r in conn.execute(select(email_queue))} == {'sent'}
+    # Batch journals are removed once their outcomes are written
+    assert list(journals.iterdir()) == []
+
+def test_byte_budget_bounds_bodies_in_flight():
+    async def scenario():
+        budget = ByteBudget(100)
+        await budget.acquire(60)
+        second = asyncio.ensure_future(budget.acquire(60))
+        await asyncio.sleep(0.01)
+        assert not second.done()
+        await budget.release(60)
+        await asyncio.wait_for(second, 1)
+        await budget.release(60)
+        # Larger than the whole budget: goes alone
+        await asyncio.wait_for(budget.acquire(500), 1)
+        assert budget.used == 500
+
+    asyncio.run(scenario())
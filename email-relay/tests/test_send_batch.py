@@ -1,8 +1,14 @@
+import os
 import datetime
+import time
+import smtplib
 from unittest.mock import MagicMock, patch
-from sqlalchemy import select, func
-from database import email_queue
-from send_batch import send_batch
+import pytest
+from sqlalchemy import select, func, event
+from database import email_queue, email_recipient, relay_state
+import bodystore
+from send_batch import (send_batch, run_daemon, claim_batch, OutcomeBuffer, TokenBucket, ThrottleController, load_rate,
+                        sendmail_streaming, load_body)
 
 def test_send_batch_success(session):
     # Insert pending email
@@ -64,3 +70,761 @@ def test_send_batch_max_attempts(session):
         row = session.execute(select(email_queue)).fetchone()
         assert row.status == 'failed'
         assert row.attempt_count == 3
+
+def test_token_bucket_paces_after_burst():
+    clock = [0.0]
+    sleeps = []
+    def sleep(s):
+        sleeps.append(s)
+        clock[0] += s
+
+    bucket = TokenBucket(60, 2, clock=lambda: clock[0], sleep=sleep)
+    bucket.acquire()
+    bucket.acquire()
+    assert sleeps == [] # burst is free
+
+    bucket.acquire()
+    assert sleeps == [pytest.approx(1.0)] # 60/min -> one token per second
+
+def test_daemon_drains_queue_and_exits_when_idle(session):
+    for i in range(3):
+        session.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients=f'r{i}@ex.com', body=b'test', status='pending'
+        ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+
+        processed = run_daemon(rate_per_minute=6000, burst=10, idle_timeout=0, poll_interval=0, batch_size=2)
+
+        assert processed == 3
+        assert mock_smtp.call_count == 1 # one session for the whole run
+        assert mock_server.sendmail.call_count == 3
+
+    rows = session.execute(select(email_queue)).fetchall()
+    assert all(r.status == 'sent' for r in rows)
+
+def test_daemon_reconnects_when_session_dropped(session):
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='r@ex.com', body=b'test', status='pending'
+    ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.side_effect = [smtplib.SMTPServerDisconnected("gone"), {}]
+
+        run_daemon(rate_per_minute=6000, burst=10, idle_timeout=0, poll_interval=0)
+
+        assert mock_smtp.call_count == 2
+
+    row = session.execute(select(email_queue)).fetchone()
+    assert row.status == 'sent'
+    assert row.attempt_count == 0 # a dropped session is not a delivery failure
+
+def test_throttle_controller_aimd():
+    controller = ThrottleController(20, min_rate=2, max_rate=22, success_window=3)
+    assert controller.on_throttle()
+    assert controller.rate == 10
+
+    for _ in range(2):
+        assert not controller.on_success()
+    assert controller.on_success()
+    assert controller.rate == 11
+
+    for _ in range(5):
+        controller.on_throttle()
+    assert controller.rate == 2 # clamped at min_rate
+
+def test_send_batch_throttle_defers_without_attempt(session):
+    for i in range(2):
+        session.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients=f'r{i}@ex.com', body=b'test', status='pending'
+        ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.side_effect = smtplib.SMTPSenderRefused(421, b'4.7.0 Try again later', 's@ex.com')
+
+        send_batch()
+
+        # Stops at the first throttle reply
+        assert mock_server.sendmail.call_count == 1
+
+    rows = session.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    assert [r.status for r in rows] == ['pending', 'pending']
+    assert [r.attempt_count for r in rows] == [0, 0]
+    assert "4.7.0" in rows[0].error_message
+
+    # Halved rate is persisted for the next execution
+    assert load_rate(session, None) == 10
+    assert session.execute(select(relay_state)).fetchone().value == '10.0'
+
+def test_daemon_resumes_from_saved_rate_after_throttle(session, monkeypatch):
+    import send_batch as sb
+    monkeypatch.setattr(sb.time, 'sleep', lambda s: None)
+    # Throttled rows are due again after THROTTLE_PAUSE
+    monkeypatch.setattr(sb, 'THROTTLE_PAUSE', 0)
+
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='r@ex.com', body=b'test', status='pending'
+    ))
+    session.execute(relay_state.insert().values(name='send_rate_per_minute', value='30'))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.side_effect = [smtplib.SMTPDataError(421, b'4.7.0 Slow down'), {}]
+
+        run_daemon(rate_per_minute=6000, burst=10, idle_timeout=0, poll_interval=0)
+
+        # Fresh session after the pause
+        assert mock_smtp.call_count == 2
+
+    row = session.execute(select(email_queue)).fetchone()
+    assert row.status == 'sent'
+    assert row.attempt_count == 0
+    assert load_rate(session, None) == 15
+
+def test_claim_batch_leases_rows(session, engine):
+    for i in range(3):
+        session.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients=f'r{i}@ex.com', body=b'test', status='pending'
+        ))
+    session.commit()
+
+    claimed = claim_batch(session, engine, 'worker-a', limit=2)
+    assert len(claimed) == 2
+
+    rows = session.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    assert [r.claimed_by for r in rows] == ['worker-a', 'worker-a', None]
+    assert rows[0].lease_expires_at is not None
+
+    # Leased rows are invisible to other workers
+    other = claim_batch(session, engine, 'worker-b', limit=10)
+    assert [r.id for r in other] == [rows[2].id]
+
+def test_claim_batch_reclaims_expired_lease(session, engine):
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='r@ex.com', body=b'test', status='pending',
+        claimed_by='crashed-worker', lease_expires_at=datetime.datetime(2000, 1, 1)
+    ))
+    session.commit()
+
+    claimed = claim_batch(session, engine, 'worker-b')
+    assert len(claimed) == 1
+    row = session.execute(select(email_queue)).fetchone()
+    assert row.claimed_by == 'worker-b'
+
+def test_send_batch_clears_lease(session):
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='r@ex.com', body=b'test', status='pending'
+    ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_smtp.return_value.__enter__.return_value = MagicMock()
+        send_batch()
+
+    row = session.execute(select(email_queue)).fetchone()
+    assert row.status == 'sent'
+    assert row.claimed_by is None
+    assert row.lease_expires_at is None
+
+def test_send_batch_releases_claims_when_smtp_unreachable(session):
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='r@ex.com', body=b'test', status='pending'
+    ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_smtp.side_effect = ConnectionRefusedError("no route")
+        send_batch()
+
+    row = session.execute(select(email_queue)).fetchone()
+    assert row.status == 'pending'
+    assert row.attempt_count == 0
+    assert row.claimed_by is None
+
+def test_worker_pool_delivers_each_row_once(tmp_path, monkeypatch):
+    import database
+    import threading
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker, scoped_session
+
+    # Real per-thread sessions on a file database instead of the shared fixture session
+    file_engine = create_engine(f"sqlite:///{tmp_path / 'queue.db'}")
+    database.metadata.create_all(file_engine)
+    monkeypatch.setattr(database, 'get_engine', lambda db_url=None: file_engine)
+    monkeypatch.setattr(database, 'get_session', lambda e: scoped_session(sessionmaker(bind=e)))
+
+    with file_engine.begin() as conn:
+        conn.execute(email_queue.insert(), [
+            {'sender': 's@ex.com', 'recipients': f'r{i}@ex.com', 'body': b'test', 'status': 'pending'}
+            for i in range(12)
+        ])
+
+    sent_to = []
+    lock = threading.Lock()
+    def sendmail(sender, to_addrs, body):
+        with lock:
+            sent_to.extend(to_addrs)
+        return {}
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_smtp.return_value.__enter__.return_value.sendmail.side_effect = sendmail
+        delivered = run_daemon(rate_per_minute=60, burst=100, idle_timeout=0, poll_interval=0,
+                               batch_size=2, workers=3)
+
+    assert delivered == 12
+    assert sorted(sent_to) == sorted(f'r{i}@ex.com' for i in range(12))
+    with file_engine.connect() as conn:
+        statuses = {r.status for r in conn.execute(select(email_queue))}
+    assert statuses == {'sent'}
+
+@pytest.fixture
+def statements(engine):
+    issued = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        issued.append(statement.split()[0].upper())
+    event.listen(engine, 'before_cursor_execute', record)
+    yield issued
+    event.remove(engine, 'before_cursor_execute', record)
+
+def test_send_batch_writes_back_statuses_in_bulk(session, statements):
+    for i in range(10):
+        session.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients=f'r{i}@ex.com', body=b'test', status='pending'
+        ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        # Every third message fails
+        mock_server.sendmail.side_effect = [Exception("boom") if i % 3 == 0 else {} for i in range(10)]
+
+        del statements[:]
+        send_batch()
+
+    # rate lookup, claim (a select per lane + update + fetch), a read of
+    # each (legacy, inline) body, then one UPDATE for the successes and one
+    # executemany for the failures
+    assert statements == ['SELECT'] + ['SELECT'] * 3 + ['UPDATE', 'SELECT'] + ['SELECT'] * 10 + ['UPDATE', 'UPDATE']
+
+    rows = session.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    assert [r.status for r in rows].count('sent') == 6
+    assert [r.attempt_count for r in rows if r.status == 'pending'] == [1, 1, 1, 1]
+
+def test_outcome_buffer_flushes_by_size_and_age():
+    clock = [0.0]
+    outcomes = OutcomeBuffer(max_size=3, max_age=10, clock=lambda: clock[0])
+    assert not outcomes.due()
+
+    outcomes.sent(1)
+    outcomes.failed(2, 'pending', 'err', None)
+    assert not outcomes.due()
+    outcomes.deferred(3, 'throttled')
+    assert outcomes.due()
+
+    outcomes.clear()
+    outcomes.sent(4)
+    clock[0] = 10
+    assert outcomes.due()
+
+def test_abandoned_journal_is_recovered_without_resending(session, tmp_path, monkeypatch):
+    import send_batch as sb
+    monkeypatch.setattr(sb, 'JOURNAL_DIR', str(tmp_path))
+
+    for i in range(2):
+        session.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients=f'r{i}@ex.com', body=b'test', status='pending',
+            claimed_by='crashed-worker', lease_expires_at=datetime.datetime(2000, 1, 1)
+        ))
+    session.commit()
+    first_id = session.execute(select(email_queue.c.id).order_by(email_queue.c.id)).first().id
+
+    # The crashed worker had sent the first message but not flushed it yet
+    journal = tmp_path / 'crashed-worker.journal'
+    journal.write_text(f"{first_id}\n")
+    os.utime(journal, (0, 0))
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        send_batch()
+
+        assert [c.args[1] for c in mock_server.sendmail.call_args_list] == [['r1@ex.com']]
+
+    rows = session.execute(select(email_queue)).fetchall()
+    assert {r.status for r in rows} == {'sent'}
+    # Abandoned journal consumed; our own journal removed on clean exit
+    assert list(tmp_path.iterdir()) == []
+
+def test_live_journal_survives_a_scan_after_an_idle_spell(session, tmp_path):
+    import send_batch as sb
+    session.execute(email_queue.insert().values(sender='s@ex.com', recipients='r@ex.com', body=b'test'))
+    session.commit()
+    email_id = session.execute(select(email_queue.c.id)).scalar()
+
+    journal = tmp_path / 'live-worker.journal'
+    outcomes = OutcomeBuffer(str(journal))
+    outcomes.sent(email_id)
+    outcomes.write(session)
+    session.commit()
+    outcomes.clear()
+
+    # Idle (or slowly paced) for longer than the staleness window: the
+    # worker's own scan skips its journal, and empty journals are never removed
+    os.utime(journal, (0, 0))
+    assert sb.recover_journals(session, str(tmp_path), own=str(journal)) == 0
+    assert journal.exists()
+
+    # Another worker scanning sees the flock, even with unflushed sends
+    session.execute(email_queue.update().values(status='pending'))
+    session.commit()
+    outcomes.sent(email_id)
+    os.utime(journal, (0, 0))
+    assert sb.recover_journals(session, str(tmp_path)) == 0
+    assert journal.read_text() == f"{email_id}\n"
+
+    outcomes.clear()
+    journal.unlink()
+    outcomes.close()
+
+def test_failed_row_backs_off_behind_fresh_mail(session):
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='poison@ex.com', body=b'test', status='pending'
+    ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.side_effect = Exception("SMTP Error")
+        send_batch()
+
+    poisoned = session.execute(select(email_queue)).fetchone()
+    assert poisoned.status == 'pending'
+    delay = poisoned.next_attempt_at - datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    # First retry: RETRY_BASE_SECONDS (300s) +/- 50%
+    assert datetime.timedelta(seconds=100) < delay < datetime.timedelta(seconds=460)
+
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='fresh@ex.com', body=b'test', status='pending'
+    ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        send_batch()
+
+        # Only the fresh row is due
+        assert [c.args[1] for c in mock_server.sendmail.call_args_list] == [['fresh@ex.com']]
+
+def test_retry_at_grows_exponentially_with_cap(monkeypatch):
+    import send_batch as sb
+    monkeypatch.setattr(sb.random, 'uniform', lambda a, b: 1.0)
+    now = datetime.datetime(2025, 1, 1)
+
+    delays = [(sb.retry_at(n, now) - now).total_seconds() for n in (1, 2, 3, 20)]
+    assert delays == [300, 600, 1200, sb.RETRY_MAX_SECONDS]
+
+def test_stored_body_is_fetched_once_per_batch(session, statements):
+    body = bodystore.encode(b"Subject: Notice\r\n\r\nSame for everyone")
+    bodystore.store(session, body)
+    for i in range(3):
+        session.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients=f'r@ex{i}.com', body_hash=body.hash, status='pending'
+        ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+
+        del statements[:]
+        send_batch()
+
+    assert [c[0][2] for c in mock_server.sendmail.call_args_list] == [b"Subject: Notice\r\n\r\nSame for everyone"] * 3
+    # rate lookup, claim (a select per lane + update + fetch), one body
+    # lookup, write-back
+    assert statements == ['SELECT'] + ['SELECT'] * 3 + ['UPDATE', 'SELECT', 'SELECT', 'UPDATE']
+
+def test_large_body_is_streamed_with_dot_stuffing(session, monkeypatch):
+    import send_batch as sb
+    monkeypatch.setattr(sb, 'STREAM_THRESHOLD', 10)
+    raw = b"Subject: Big\n\n.leading dot\nline two\r\n" + b"x" * 100000
+    body = bodystore.encode(raw)
+    bodystore.store(session, body)
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='r@ex.com', body_hash=body.hash, status='pending'
+    ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.has_extn.return_value = True
+        mock_server.mail.return_value = (250, b'ok')
+        mock_server.rcpt.return_value = (250, b'ok')
+        mock_server.getreply.side_effect = [(354, b'go ahead'), (250, b'queued')]
+
+        send_batch()
+
+    mock_server.sendmail.assert_not_called()
+    mock_server.mail.assert_called_once_with('s@ex.com', [f'size={len(raw)}'])
+    sent = b''.join(c[0][0] for c in mock_server.send.call_args_list)
+    assert sent == b"Subject: Big\r\n\r\n..leading dot\r\nline two\r\n" + b"x" * 100000 + b"\r\n.\r\n"
+    assert session.execute(select(email_queue.c.status)).scalar() == 'sent'
+
+def test_streaming_raises_like_sendmail_when_all_recipients_refused():
+    server = MagicMock()
+    server.mail.return_value = (250, b'ok')
+    server.rcpt.return_value = (550, b'no such user')
+
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        sendmail_streaming(server, 's@ex.com', ['r@ex.com'], 4, [b'body'])
+    server.rset.assert_called_once()
+    server.send.assert_not_called()
+
+def test_plan_deliveries_merges_same_body_per_domain():
+    from collections import namedtuple
+    from send_batch import plan_deliveries
+    Row = namedtuple('Row', 'id sender recipients body body_hash attempt_count')
+    rows = [
+        Row(1, 's@ex.com', 'a@uni.edu', None, 'h1', 0),
+        Row(2, 's@ex.com', 'b@other.org', None, 'h1', 0),
+        Row(3, 's@ex.com', 'Bee <b@UNI.edu>', None, 'h1', 0),
+        Row(4, 's@ex.com', 'c@uni.edu', None, 'h2', 0),    # different body
+        Row(5, 's@ex.com', 'd@uni.edu', b'inline', None, 0),  # legacy row
+        Row(6, 's@ex.com', 'e@uni.edu', None, 'h1', 0),    # over the cap
+    ]
+
+    queues = plan_deliveries(rows, max_recipients=2)
+
+    assert list(queues) == ['uni.edu', 'other.org']
+    assert [[r.id for r in d.rows] for d in queues['uni.edu']] == [[1, 3], [4], [5], [6]]
+    assert queues['uni.edu'][0].to_addrs == ['a@uni.edu', 'Bee <b@UNI.edu>']
+
+def test_domain_scheduler_round_robins_and_postpones():
+    from collections import deque
+    from send_batch import DomainScheduler
+    clock = [0.0]
+    scheduler = DomainScheduler(rate_per_minute=60, burst=2, concurrency=0, max_wait=5,
+                                clock=lambda: clock[0], sleep=lambda s: clock.__setitem__(0, clock[0] + s))
+    queues = {'big.edu': deque(['big1', 'big2', 'big3']), 'small.org': deque(['small1'])}
+    scheduler.back_off('slow.net')
+    queues['slow.net'] = deque(['slow1'])
+    postponed = []
+
+    order = []
+    for delivery in scheduler.schedule(queues, lambda d, s: postponed.append((d, s))):
+        order.append(delivery)
+        scheduler.finish('big.edu' if delivery.startswith('big') else 'small.org')
+
+    # Interleaved, big.edu's third message waits a second for a token, and
+    # the paused domain is handed back instead of holding up the batch
+    assert order == ['big1', 'small1', 'big2', 'big3']
+    assert clock[0] == 1.0
+    assert postponed == [('slow1', scheduler.backoff_seconds)]
+
+def test_rows_for_one_domain_share_a_transaction(session):
+    body = bodystore.encode(b"Subject: Issue published\r\n\r\nNew issue")
+    bodystore.store(session, body)
+    for i in range(3):
+        session.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients=f'r{i}@uni.edu', body_hash=body.hash, status='pending'
+        ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.return_value = {'r1@uni.edu': (550, b'no such user')}
+
+        send_batch()
+
+    mock_server.sendmail.assert_called_once()
+    assert mock_server.sendmail.call_args[0][1] == ['r0@uni.edu', 'r1@uni.edu', 'r2@uni.edu']
+    rows = session.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    assert [(r.status, r.attempt_count) for r in rows] == [('sent', 0), ('pending', 1), ('sent', 0)]
+
+def test_greylisting_domain_is_postponed_without_global_backoff(session):
+    for recipients in ('a@greylist.edu', 'b@greylist.edu', 'c@fine.org'):
+        session.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients=recipients, body=b'test', status='pending'
+        ))
+    session.commit()
+
+    def sendmail(sender, to_addrs, body):
+        if to_addrs[0].endswith('@greylist.edu'):
+            raise smtplib.SMTPRecipientsRefused({to_addrs[0]: (450, b'4.2.0 Greylisted')})
+        return {}
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.side_effect = sendmail
+
+        send_batch()
+
+    # One try at the greylisting domain, then the rest of it is left alone
+    assert [c[0][1] for c in mock_server.sendmail.call_args_list] == [['a@greylist.edu'], ['c@fine.org']]
+    rows = session.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    assert [r.status for r in rows] == ['pending', 'pending', 'sent']
+    assert [r.attempt_count for r in rows] == [0, 0, 0]
+    assert all(r.next_attempt_at > datetime.datetime.utcnow() for r in rows[:2])
+    assert session.execute(select(relay_state)).fetchall() == []
+
+def test_claim_shares_batch_between_lanes_by_weight(session, engine):
+    for lane in (0, 1, 2):
+        for i in range(10):
+            session.execute(email_queue.insert().values(
+                sender='s@ex.com', recipients=f'r{i}@ex.com', body=b'test', status='pending', priority=lane
+            ))
+    session.commit()
+
+    emails = claim_batch(session, engine, 'w1', limit=10, weights={0: 6, 1: 3, 2: 1})
+    lanes = session.execute(
+        select(email_queue.c.priority).where(email_queue.c.id.in_([e.id for e in emails]))
+    ).scalars().all()
+    assert sorted(lanes) == [0] * 6 + [1] * 3 + [2]
+
+    # An idle lane's share goes to the others
+    session.execute(email_queue.delete().where(email_queue.c.priority == 0))
+    session.execute(email_queue.update().values(claimed_by=None, lease_expires_at=None))
+    session.commit()
+    emails = claim_batch(session, engine, 'w2', limit=10, weights={0: 6, 1: 3, 2: 1})
+    assert len(emails) == 10
+
+def test_high_priority_message_jumps_5000_bulk_rows(session):
+    from enqueue import enqueue_email
+    session.execute(email_queue.insert(), [
+        {'sender': 'journal@ex.com', 'recipients': f'reader{i}@ex.com', 'body': b'issue', 'status': 'pending',
+         'priority': 2}
+        for i in range(5000)
+    ])
+    session.commit()
+
+    enqueue_email(b"From: journal@ex.com\r\nTo: user@ex.com\r\nSubject: Password Reset Confirmation\r\n\r\nReset")
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+
+        send_batch()
+
+    recipients = [c[0][1] for c in mock_server.sendmail.call_args_list]
+    assert recipients[0] == ['user@ex.com']
+    assert len(recipients) == 10
+
+def test_daemon_wakes_on_signal_instead_of_polling(session, monkeypatch):
+    import send_batch as sb
+    waits = []
+
+    class Channel:
+        def wait(self, timeout):
+            waits.append(timeout)
+            if len(waits) == 1:
+                # enqueue.py signalling new mail mid-wait
+                session.execute(email_queue.insert().values(
+                    sender='s@ex.com', recipients='r@ex.com', body=b'test', status='pending'
+                ))
+                session.commit()
+                return True
+            time.sleep(0.05)
+            return False
+
+    monkeypatch.setattr(sb.wakeup, 'channel', lambda spec=None: Channel())
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+
+        delivered = run_daemon(rate_per_minute=6000, burst=10, idle_timeout=0.2, poll_interval=30)
+
+    assert delivered == 1
+    assert waits[0] == 30
+
+def test_large_envelope_is_sent_in_chunks(session, monkeypatch):
+    import send_batch as sb
+    monkeypatch.setattr(sb, 'MAX_RECIPIENTS', 2)
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='a@x.org, b@y.org, c@x.org, d@y.org, e@x.org', body=b'test', status='pending'
+    ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.return_value = {}
+
+        send_batch()
+
+    # Packed in domain order
+    chunks = [call[0][1] for call in mock_server.sendmail.call_args_list]
+    assert sorted(chunks) == [['a@x.org', 'c@x.org'], ['d@y.org'], ['e@x.org', 'b@y.org']]
+    assert session.execute(select(email_queue.c.status)).scalar() == 'sent'
+    # Fully delivered: nothing to track per recipient
+    assert session.execute(select(func.count()).select_from(email_recipient)).scalar() == 0
+
+def test_retry_goes_only_to_refused_recipients(session):
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='a@ex.com, b@ex.com, c@ex.com', body=b'test', status='pending'
+    ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.return_value = {'b@ex.com': (452, b'4.5.3 Too many recipients'),
+                                             'c@ex.com': (550, b'5.1.1 No such user')}
+        send_batch()
+
+        row = session.execute(select(email_queue)).fetchone()
+        assert (row.status, row.attempt_count) == ('pending', 1)
+        statuses = dict(session.execute(select(email_recipient.c.address, email_recipient.c.status)).fetchall())
+        assert statuses == {'a@ex.com': 'sent', 'b@ex.com': 'pending', 'c@ex.com': 'failed'}
+
+        session.execute(email_queue.update().values(next_attempt_at=datetime.datetime(2000, 1, 1)))
+        session.commit()
+        mock_server.sendmail.reset_mock()
+        mock_server.sendmail.return_value = {}
+        send_batch()
+
+    mock_server.sendmail.assert_called_once()
+    assert mock_server.sendmail.call_args[0][1] == ['b@ex.com']
+    assert session.execute(select(email_queue.c.status)).scalar() == 'sent'
+    statuses = dict(session.execute(select(email_recipient.c.address, email_recipient.c.status)).fetchall())
+    assert statuses == {'a@ex.com': 'sent', 'b@ex.com': 'sent', 'c@ex.com': 'failed'}
+
+def test_throttle_mid_envelope_keeps_delivered_chunks(session, monkeypatch):
+    import send_batch as sb
+    monkeypatch.setattr(sb, 'MAX_RECIPIENTS', 2)
+    monkeypatch.setattr(sb, 'THROTTLE_PAUSE', 0)
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='a@ex.com, b@ex.com, c@ex.com, d@ex.com', body=b'test', status='pending'
+    ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.side_effect = [{}, smtplib.SMTPSenderRefused(421, b'4.7.0 Try again later', 's@ex.com')]
+        send_batch()
+
+        row = session.execute(select(email_queue)).fetchone()
+        assert (row.status, row.attempt_count) == ('pending', 0)
+
+        mock_server.sendmail.reset_mock()
+        mock_server.sendmail.side_effect = None
+        mock_server.sendmail.return_value = {}
+        send_batch()
+
+    mock_server.sendmail.assert_called_once()
+    assert mock_server.sendmail.call_args[0][1] == ['c@ex.com', 'd@ex.com']
+    assert session.execute(select(email_queue.c.status)).scalar() == 'sent'
+
+def test_persistent_4xx_is_a_failed_attempt_not_a_throttle(session):
+    for recipient in ('stuck@ex.com', 'next@ex.com'):
+        session.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients=recipient, body=b'test', status='pending'
+        ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        def sendmail(from_addr, to_addrs, msg):
+            if to_addrs == ['stuck@ex.com']:
+                raise smtplib.SMTPDataError(451, b'4.3.0 Temporary local problem')
+            return {}
+        mock_server.sendmail.side_effect = sendmail
+        send_batch()
+
+    stuck, following = session.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    # Backs off like any failure instead of holding the head of the queue
+    assert (stuck.status, stuck.attempt_count) == ('pending', 1)
+    assert stuck.next_attempt_at > datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    assert following.status == 'sent'
+
+def test_repeated_throttle_deferrals_count_as_an_attempt(session, monkeypatch):
+    import send_batch as sb
+    monkeypatch.setattr(sb, 'MAX_DEFERRALS', 2)
+    session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='r@ex.com', body=b'test', status='pending'
+    ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.sendmail.side_effect = smtplib.SMTPSenderRefused(421, b'4.7.0 Try again later', 's@ex.com')
+        counts = []
+        for _ in range(3):
+            send_batch()
+            row = session.execute(select(email_queue)).fetchone()
+            counts.append((row.attempt_count, row.deferral_count))
+            # Throttled rows wait THROTTLE_PAUSE; make it due again
+            session.execute(email_queue.update().values(next_attempt_at=datetime.datetime(2000, 1, 1)))
+            session.commit()
+
+    assert counts == [(0, 1), (0, 2), (1, 0)]
+
+def test_claim_stops_at_byte_budget(session, engine):
+    for size in (400, 500, 300, 100):
+        session.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients='r@ex.com', body=b'x' * size, message_size=size, status='pending'
+        ))
+    session.commit()
+
+    claimed = claim_batch(session, engine, 'w1', limit=10, max_bytes=1000)
+    assert [row.message_size for row in claimed] == [400, 500]
+
+    # A message larger than the whole budget is still claimed, alone
+    claimed = claim_batch(session, engine, 'w2', limit=10, max_bytes=200)
+    assert [row.message_size for row in claimed] == [300]
+
+def test_large_body_is_read_from_the_database_in_pieces(session, monkeypatch):
+    import send_batch as sb
+    monkeypatch.setattr(sb, 'BLOB_READ_SIZE', 1000)
+    raw = os.urandom(50000)
+    body = bodystore.encode(raw)
+    bodystore.store(session, body)
+    row = session.execute(email_queue.insert().values(
+        sender='s@ex.com', recipients='r@ex.com', body_hash=body.hash, status='pending'
+    ).returning(email_queue.c.id, email_queue.c.body_hash)).fetchone()
+
+    loaded = load_body(session, row, stream_above=10)
+    pieces = list(loaded.data)
+    assert len(pieces) == -(-len(body.data) // 1000)
+    assert b''.join(bodystore.iter_decode(loaded.codec, loaded.data)) == raw
+    assert load_body(session, row).data == body.data
+
+def test_message_over_server_size_limit_fails_without_sending(session):
+    for size in (100, 5000):
+        session.execute(email_queue.insert().values(
+            sender='s@ex.com', recipients='r@ex.com', body=b'x' * size, message_size=size, status='pending'
+        ))
+    session.commit()
+
+    with patch('smtplib.SMTP') as mock_smtp:
+        mock_server = MagicMock()
+        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_server.esmtp_features = {'size': '1000', '8bitmime': ''}
+        mock_server.sendmail.return_value = {}
+
+        send_batch()
+
+    mock_server.sendmail.assert_called_once()
+    rows = session.execute(select(email_queue).order_by(email_queue.c.id)).fetchall()
+    assert [row.status for row in rows] == ['sent', 'failed']
+    assert "limit of 1000 bytes" in rows[1].error_message
@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import threading
+
+# "Work available" signal from enqueue.py to the sender, so new mail goes out
+# within seconds instead of at the next scheduled run. Cloud Scheduler stays
+# as a safety net. The transport is chosen with RELAY_WAKEUP:
+#
+#   file:/path/to/flag        a flag file on storage both sides can see
+#   udp:host:port             a datagram to a running sender daemon
+#   cloudrun:projects/P/locations/R/jobs/J
+#                             start an execution of the sender job
+#
+# Unset means no signal; the sender only polls. Bursts are coalesced: a file
+# flag that hasn't been consumed yet is not raised again, and the other
+# transports send at most one signal per RELAY_WAKEUP_COALESCE seconds from
+# each host.
+#
+# Imported by enqueue.py, so keep module-level imports light.
+
+WAKEUP = os.environ.get('RELAY_WAKEUP', '')
+COALESCE_SECONDS = float(os.environ.get('RELAY_WAKEUP_COALESCE', 30))
+STAMP_PATH = os.environ.get(
+    'RELAY_WAKEUP_STAMP', os.path.join(os.environ.get('TMPDIR', '/tmp'), 'email-relay-wakeup.stamp')
+)
+CLOUD_RUN_API = 'https://run.googleapis.com/v2'
+METADATA_TOKEN_URL = 'http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token'
+
+def coalesced(stamp_path, window, now=None):
+    # True when a signal went out less than `window` seconds ago; otherwise
+    # records that one is going out now
+    now = time.time() if now is None else now
+    try:
+        if now - os.path.getmtime(stamp_path) < window:
+            return True
+    except FileNotFoundError:
+        pass
+    with open(stamp_path, 'a'):
+        pass
+    os.utime(stamp_path, (now, now))
+    return False
+
+
+class NullChannel:
+    def notify(self):
+        return False
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+
+class FileChannel:
+    # The flag file exists while a wake-up is pending; wait() consumes it
+    def __init__(self, path, poll_interval=0.2):
+        self.path = path
+        self.poll_interval = poll_interval
+
+    def notify(self):
+        try:
+            os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        return True
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                os.remove(self.path)
+                return True
+            except FileNotFoundError:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+
+
+class UDPChannel:
+    def __init__(self, host, port, stamp_path=STAMP_PATH, coalesce=COALESCE_SECONDS):
+        self.host = host
+        self.port = port
+        self.stamp_path = stamp_path
+        self.coalesce = coalesce
+        self._sock = None
+        # One channel is shared by every worker thread of a pool
+        self._lock = threading.Lock()
+
+    def notify(self):
+        if coalesced(self.stamp_path, self.coalesce):
+            return False
+        import socket
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b'wake', (self.host, self.port))
+        return True
+
+    def listen(self):
+        # Bind the receiving side; returns the bound (host, port)
+        with self._lock:
+            if self._sock is None:
+                import socket
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.bind((self.host, self.port))
+                sock.setblocking(False)
+                self._sock = sock
+            return self._sock.getsockname()
+
+    def wait(self, timeout):
+        import select
+        self.listen()
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        if not readable:
+            return False
+        # Any number of queued signals is one wake-up
+        while True:
+            try:
+                self._sock.recv(64)
+            except (BlockingIOError, InterruptedError):
+                return True
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+
+
+class CloudRunJobChannel:
+    # Starts an execution of the sender job through the Cloud Run Admin API,
+    # authenticated as the instance's service account (which needs
+    # run.jobs.run, e.g. roles/run.invoker, on the job). Keep the coalescing
+    # window below the sender's idle timeout: mail enqueued while a triggered
+    # sender is still running is picked up by that sender.
+    def __init__(self, job, stamp_path=STAMP_PATH, coalesce=COALESCE_SECONDS, timeout=5):
+        self.job = job
+        self.stamp_path = stamp_path
+        self.coalesce = coalesce
+        self.timeout = timeout
+
+    def notify(self):
+        if coalesced(self.stamp_path, self.coalesce):
+            return False
+        import json
+        import urllib.request
+
+        request = urllib.request.Request(METADATA_TOKEN_URL, headers={'Metadata-Flavor': 'Google'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            token = json.load(response)['access_token']
+
+        request = urllib.request.Request(
+            f"{CLOUD_RUN_API}/{self.job}:run", data=b'{}', method='POST',
+            headers={'Authorization': f"Bearer {token}", 'Content-Type': 'application/json'}
+        )
+        urllib.request.urlopen(request, timeout=self.timeout).close()
+        return True
+
+    def wait(self, timeout):
+        # The trigger starts a new execution; a running sender just polls
+        time.sleep(timeout)
+        return False
+
+
+def channel(spec=None):
+    spec = WAKEUP if spec is None else spec
+    if not spec:
+        return NullChannel()
+    kind, _, target = spec.partition(':')
+    if kind == 'file':
+        return FileChannel(target)
+    if kind == 'udp':
+        host, _, port = target.rpartition(':')
+        return UDPChannel(host or '127.0.0.1', int(port))
+    if kind == 'cloudrun':
+        return CloudRunJobChannel(target)
+    raise ValueError(f"Unknown RELAY_WAKEUP transport {spec!r}")
+
+def notify(spec=None):
+    # For enqueue.py: signal the sender, never failing the enqueue itself
+    try:
+        return channel(spec).notify()
+    except Exception as e:
+        print(f"Could not wake the sender ({e}); it will pick the email up on its next run.", file=sys.stderr)
+        return False
@@ -129,18 +129,25 @@ resource "google_artifact_registry_repository" "cloud_run_source_deploy" {
 }
 
 # Build and push PKP OJS container image to Artifact Registry
+# Image tag: a hash of the container source tree and the build args, so the
+# image is only rebuilt when one of them changes
+data "external" "pkp_ojs_image_tag" {
+  program = ["python3", "${path.module}/scripts/submit_build.py", "--external"]
+  query = {
+    source_path = local.pkp_ojs_container_local_path
+    env_vars    = jsonencode(local.pkp_ojs_env_all_values)
+  }
+}
+
 resource "null_resource" "pkp_ojs_container_build" {
-  # Trigger a new build whenever the container source changes
+  # Trigger a new build whenever the container source or build args change.
+  # submit_build.py also skips the build if the tag is already in the registry.
   triggers = {
-    container_source = sha256(join("", [
-      for file in fileset(local.pkp_ojs_container_local_path, "**") :
-      filesha256("${local.pkp_ojs_container_local_path}/${file}")
-    ]))
-    timestamp = replace(timestamp(), ":", "")
+    image_tag = data.external.pkp_ojs_image_tag.result.tag
   }
 
   provisioner "local-exec" {
-    command = "${path.module}/scripts/submit_build.py --registry-uri ${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri} --tag ${self.triggers.timestamp} --env-vars '${replace(jsonencode(local.pkp_ojs_env_all_values), "'", "'\\''")}' --source-path ${local.pkp_ojs_container_local_path} --project-id ${local.project_id} --region ${local.region}"
+    command = "${path.module}/scripts/submit_build.py --registry-uri ${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri} --tag ${self.triggers.image_tag} --env-vars '${replace(jsonencode(local.pkp_ojs_env_all_values), "'", "'\\''")}' --source-path ${local.pkp_ojs_container_local_path} --project-id ${local.project_id} --region ${local.region}"
   }
 
   depends_on = [
@@ -300,8 +307,8 @@ resource "google_cloud_run_v2_service" "icat_pkp_ojs_server" {
         }
       }
 
-      # Use the timestamped image from the build
-      image = "${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri}/icat-pkp-ojs:${null_resource.pkp_ojs_container_build.triggers.timestamp}"
+      # Use the content-tagged image from the build
+      image = "${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri}/icat-pkp-ojs:${null_resource.pkp_ojs_container_build.triggers.image_tag}"
       name  = "icat-pkp-ojs-1"
       ports {
         container_port = 8080
@@ -427,8 +434,8 @@ resource "google_cloud_run_v2_job" "icat_pkp_ojs_scheduled" {
   template {
     template {
       containers {
-        # Use the timestamped image from the build
-        image = "${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri}/icat-pkp-ojs:${null_resource.pkp_ojs_container_build.triggers.timestamp}"
+        # Use the content-tagged image from the build
+        image = "${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri}/icat-pkp-ojs:${null_resource.pkp_ojs_container_build.triggers.image_tag}"
 
         # Run the scheduled tasks script
         command = ["pkp-run-scheduled"]
@@ -563,8 +570,8 @@ resource "google_cloud_run_v2_job" "icat_pkp_ojs_upgrade" {
   template {
     template {
       containers {
-        # Use the timestamped image from the build
-        image = "${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri}/icat-pkp-ojs:${null_resource.pkp_ojs_container_build.triggers.timestamp}"
+        # Use the content-tagged image from the build
+        image = "${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri}/icat-pkp-ojs:${null_resource.pkp_ojs_container_build.triggers.image_tag}"
 
         # Run the upgrade script
         command = ["pkp-upgrade"]
@@ -699,8 +706,8 @@ resource "google_cloud_run_v2_job" "icat_pkp_ojs_automate_transition" {
   template {
     template {
       containers {
-        # Use the timestamped image from the build
-        image = "${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri}/icat-pkp-ojs:${null_resource.pkp_ojs_container_build.triggers.timestamp}"
+        # Use the content-tagged image from the build
+        image = "${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri}/icat-pkp-ojs:${null_resource.pkp_ojs_container_build.triggers.image_tag}"
 
         # Run the automation script
         command = ["php", "tools/automateCopyeditingTransition.php"]
@@ -835,8 +842,8 @@ resource "google_cloud_run_v2_job" "icat_pkp_ojs_automate_revisions" {
   template {
     template {
       containers {
-        # Use the timestamped image from the build
-        image = "${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri}/icat-pkp-ojs:${null_resource.pkp_ojs_container_build.triggers.timestamp}"
+        # Use the content-tagged image from the build
+        image = "${google_artifact_registry_repository.cloud_run_source_deploy.registry_uri}/icat-pkp-ojs:${null_resource.pkp_ojs_container_build.triggers.image_tag}"
 
         # Run the automation script
         command = ["php", "tools/automateRequestRevisions.php"]
@@ -4,22 +4,263 @@
 # flake8: noqa: E501
 
 import argparse
+import gzip
+import hashlib
 import json
+import re
 import subprocess
 import sys
 import os
+import tarfile
+
+# Directories that never go into the image
+IGNORED_DIRS = {".git"}
+# Docker always needs these, whatever .dockerignore says
+ALWAYS_INCLUDED = {"Dockerfile", ".dockerignore"}
+# mtime of every entry in the context tarball (1980-01-01, the zip epoch,
+# which every tool handles)
+CONTEXT_MTIME = 315532800
+# Entries in the context size report
+REPORT_TOP = 10
+
+
+def glob_regex(pattern):
+    # Regex for a .dockerignore/.gitignore glob: * and ? stay within one
+    # path segment, ** spans any number of them
+    out = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        c = pattern[i]
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            chars = pattern[i + 1:end]
+            out.append("[" + ("^" + chars[1:] if chars.startswith("!") else chars) + "]")
+            i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return re.compile("^" + "".join(out) + "$")
+
+
+def read_ignore_file(path, anchored):
+    # [(regex, negated, dir_only)] from an ignore file, [] if it is missing.
+    # .dockerignore patterns are relative to the context root (anchored);
+    # in .gcloudignore, as in .gitignore, a pattern without a slash matches
+    # at any depth. gcloud's "#!include:FILE" directive is followed.
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return []
+    rules = []
+    for line in lines:
+        if line.startswith("#!include:"):
+            rules += read_ignore_file(os.path.join(os.path.dirname(path), line[len("#!include:"):].strip()), anchored)
+            continue
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:].strip()
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if line.startswith("./"):
+            line = line[2:]
+        if not anchored and "/" not in line:
+            line = "**/" + line
+        rules.append((glob_regex(line.lstrip("/")), negated, dir_only))
+    return rules
+
+
+def is_ignored(rel_path, rules, is_dir=False):
+    # The last rule matching the path, or one of its parent directories, decides
+    parts = rel_path.split("/")
+    parents = ["/".join(parts[:n]) for n in range(1, len(parts))]
+    ignored = False
+    for regex, negated, dir_only in rules:
+        candidates = parents + [rel_path] if is_dir or not dir_only else parents
+        if any(regex.match(candidate) for candidate in candidates):
+            ignored = not negated
+    return ignored
+
+
+def context_files(source_path):
+    # Sorted [(relative path, absolute path)] of the files that go into the
+    # build context: .dockerignore (what docker build would use) and
+    # .gcloudignore (what gcloud builds submit would upload) both apply
+    rule_sets = [
+        read_ignore_file(os.path.join(source_path, ".dockerignore"), anchored=True),
+        read_ignore_file(os.path.join(source_path, ".gcloudignore"), anchored=False),
+    ]
+    can_prune = not any(negated for rules in rule_sets for _, negated, _ in rules)
+    found = []
+    for root, dirs, files in os.walk(source_path):
+        rel_root = os.path.relpath(root, source_path).replace(os.sep, "/")
+        rel_root = "" if rel_root == "." else rel_root + "/"
+        kept_dirs = []
+        for name in sorted(dirs):
+            if name in IGNORED_DIRS:
+                continue
+            if os.path.islink(os.path.join(root, name)):
+                # os.walk doesn't follow it; pack the link itself, as
+                # gcloud builds submit does
+                if not any(is_ignored(rel_root + name, rules, is_dir=True) for rules in rule_sets):
+                    found.append((rel_root + name, os.path.join(root, name)))
+                continue
+            # Without "!" exceptions nothing inside an ignored directory can come back
+            if can_prune and any(is_ignored(rel_root + name, rules, is_dir=True) for rules in rule_sets):
+                continue
+            kept_dirs.append(name)
+        dirs[:] = kept_dirs
+        for name in files:
+            rel_path = rel_root + name
+            if rel_path in ALWAYS_INCLUDED or not any(is_ignored(rel_path, rules) for rules in rule_sets):
+                found.append((rel_path, os.path.join(root, name)))
+    return sorted(found)
+
+
+def content_hash(source_path, env_vars):
+    # Deterministic hash of the build context (paths, executable bits,
+    # contents) and the build args. The build args include random secrets
+    # (e.g. PKP_APP_KEY), so the published tag can't be used to check
+    # guesses of the other values.
+    digest = hashlib.sha256()
+    for rel_path, path in context_files(source_path):
+        if os.path.islink(path):
+            kind, data = "link", os.readlink(path).encode()
+        else:
+            kind = "exec" if os.access(path, os.X_OK) else "file"
+            with open(path, "rb") as f:
+                data = hashlib.sha256(f.read()).hexdigest().encode()
+        digest.update(f"{kind}\0{rel_path}\0".encode() + data + b"\0")
+    digest.update(json.dumps(env_vars, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def build_context(files, out_path):
+    # Reproducible .tgz of the context: sorted entries, fixed mtimes and
+    # owners, modes reduced to 0644/0755, no gzip timestamp. The same tree
+    # always gives the same bytes. Returns its sha256.
+    with open(out_path, "wb") as raw:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode="w", format=tarfile.GNU_FORMAT) as tar:
+                for rel_path, path in files:
+                    info = tar.gettarinfo(path, arcname=rel_path)
+                    info.mtime = CONTEXT_MTIME
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ""
+                    if info.isreg():
+                        info.mode = 0o755 if info.mode & 0o111 else 0o644
+                        with open(path, "rb") as f:
+                            tar.addfile(info, f)
+                    else:
+                        tar.addfile(info)
+    digest = hashlib.sha256()
+    with open(out_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def human_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def report_context(files, tarball_size):
+    # Print the context size and what contributes most to it
+    sizes = [(os.lstat(path).st_size, rel_path) for rel_path, path in files]
+    total = sum(size for size, _ in sizes)
+    print(f"Build context: {len(files)} files, {human_size(total)} ({human_size(tarball_size)} compressed)")
+
+    by_top = {}
+    for size, rel_path in sizes:
+        top = rel_path.split("/", 1)[0] + ("/" if "/" in rel_path else "")
+        by_top[top] = by_top.get(top, 0) + size
+    print("Largest top-level entries:")
+    for top, size in sorted(by_top.items(), key=lambda item: -item[1])[:REPORT_TOP]:
+        print(f"  {human_size(size):>10}  {top}")
+    print("Largest files:")
+    for size, rel_path in sorted(sizes, reverse=True)[:REPORT_TOP]:
+        print(f"  {human_size(size):>10}  {rel_path}")
+
+
+def upload_context(tarball, digest, bucket, project_id):
+    # Upload the context to the bucket under its hash, unless an identical
+    # one is already there. Returns the gs:// URI.
+    uri = f"{bucket.rstrip('/')}/context-{digest[:32]}.tgz"
+    exists = subprocess.run(
+        ["gcloud", "storage", "objects", "describe", uri, "--project", project_id],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    ).returncode == 0
+    if exists:
+        print(f"Build context {uri} already uploaded.")
+    else:
+        subprocess.check_call(["gcloud", "storage", "cp", tarball, uri, "--project", project_id])
+    return uri
+
+
+def image_tag(source_path, env_vars):
+    return f"src-{content_hash(source_path, env_vars)[:24]}"
+
+
+def image_exists(image, project_id):
+    # True if the tag is already in Artifact Registry
+    result = subprocess.run(
+        ["gcloud", "artifacts", "docker", "images", "describe", image,
+         "--project", project_id, "--format", "value(image_summary.digest)"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return result.returncode == 0
+
+
+def print_external_tag():
+    # Terraform "external" data source protocol: a JSON query on stdin
+    # ({"source_path": ..., "env_vars": <JSON string>}), a JSON object of
+    # strings on stdout
+    query = json.load(sys.stdin)
+    source_path = os.path.abspath(query["source_path"])
+    tag = image_tag(source_path, json.loads(query["env_vars"]))
+    json.dump({"tag": tag}, sys.stdout)
 
 
 def main():
+    if "--external" in sys.argv[1:]:
+        print_external_tag()
+        return
+
     parser = argparse.ArgumentParser(description="Submit a Cloud Build job for PKP OJS container.")
     parser.add_argument("--registry-uri", required=True, help="Artifact Registry URI")
-    parser.add_argument("--tag", required=True, help="Image tag (e.g., timestamp)")
+    parser.add_argument("--tag", help="Image tag (default: a hash of the source tree and build args)")
     parser.add_argument("--env-vars", required=True, help="JSON string of environment variables")
     parser.add_argument("--source-path", required=True, help="Path to container source code")
     parser.add_argument("--project-id", required=True, help="Google Cloud Project ID")
     parser.add_argument("--region", required=True, help="Google Cloud Region")
-    parser.add_argument("--keep-config", action="store_true", help="Keep the generated Cloud Build config file")
+    parser.add_argument("--force", action="store_true", help="Build even if the image tag already exists")
+    parser.add_argument("--source-bucket", help="gs:// location for build contexts (default: gs://PROJECT_cloudbuild/source)")
+    parser.add_argument("--keep-config", action="store_true", help="Keep the generated Cloud Build config file and context tarball")
     parser.add_argument("--no-submit", action="store_true", help="Generate config file but do not submit the build")
+    parser.add_argument("--external", action="store_true",
+                        help="Print the image tag for a Terraform external data source (query on stdin) and exit")
 
     args = parser.parse_args()
 
@@ -40,28 +281,44 @@ def main():
     for k, v in env_vars.items():
         build_args.extend(["--build-arg", f"{k}={v}"])
 
-    image_timestamp = f"{args.registry_uri}/icat-pkp-ojs:{args.tag}"
+    tag = args.tag or image_tag(source_path, env_vars)
+    image_tagged = f"{args.registry_uri}/icat-pkp-ojs:{tag}"
     image_latest = f"{args.registry_uri}/icat-pkp-ojs:latest"
 
-    # Cloud Build configuration
+    if not args.force and not args.no_submit and image_exists(image_tagged, args.project_id):
+        print(f"Image {image_tagged} already exists; skipping build.")
+        return
+
+    # Cloud Build configuration. The previous image is pulled first so its
+    # layers can be reused (--cache-from); BUILDKIT_INLINE_CACHE stores the
+    # cache metadata BuildKit needs for that in the pushed image itself.
     cloudbuild_config = {
         "steps": [
             {
                 "name": "gcr.io/cloud-builders/docker",
+                "entrypoint": "bash",
+                "args": ["-c", f"docker pull {image_latest} || exit 0"]
+            },
+            {
+                "name": "gcr.io/cloud-builders/docker",
+                "env": ["DOCKER_BUILDKIT=1"],
                 "args": [
                     "build",
-                    "-t", image_timestamp,
+                    "-t", image_tagged,
                     "-t", image_latest,
+                    "--cache-from", image_latest,
+                    "--build-arg", "BUILDKIT_INLINE_CACHE=1",
                 ] + build_args + ["."]
             }
         ],
         "images": [
-            image_timestamp,
+            image_tagged,
             image_latest
         ]
     }
 
     config_filename = "cloudbuild.json"
+    context_filename = "context.tgz"
     
     try:
         with open(config_filename, "w") as f:
@@ -69,18 +326,26 @@ def main():
         
         print(f"Generated {config_filename}")
 
+        # Package only what the build needs, instead of letting gcloud upload the whole checkout
+        files = context_files(source_path)
+        context_digest = build_context(files, context_filename)
+        report_context(files, os.path.getsize(context_filename))
+
+        if args.no_submit:
+            print("No-submit flag set; skipping upload and build submission.")
+            return
+
+        bucket = args.source_bucket or f"gs://{args.project_id}_cloudbuild/source"
+        context_uri = upload_context(context_filename, context_digest, bucket, args.project_id)
+
         cmd = [
-            "gcloud", "builds", "submit", source_path,
+            "gcloud", "builds", "submit", context_uri,
             "--config", config_filename,
             "--project", args.project_id,
             "--region", args.region
         ]
 
         print(f"Running: {' '.join(cmd)}")
-
-        if args.no_submit:
-            print("No-submit flag set; skipping build submission.")
-            return
         
         subprocess.check_call(cmd)
 
@@ -91,9 +356,11 @@ def main():
         print(f"Unexpected error: {e}", file=sys.stderr)
         sys.exit(1)
     finally:
-        if not args.keep_config and os.path.exists(config_filename):
-            os.remove(config_filename)
-            print(f"Removed {config_filename}")
+        if not args.keep_config:
+            for filename in (config_filename, context_filename):
+                if os.path.exists(filename):
+                    os.remove(filename)
+                    print(f"Removed {filename}")
 
 if __name__ == "__main__":
     main()